@@ -3,7 +3,6 @@ import signal
 from syslog import syslog, openlog
 from dbus.mainloop.glib import DBusGMainLoop
 import swupd
-import random
 import traceback
 
 import sys
@@ -0,0 +1,433 @@
+#
+# artifactcache.py - Resumable downloads into an on-device artifact cache
+#
+# Update images are downloaded with HTTP range requests in fixed size
+# chunks.  Each chunk is checked (against the chunk digests given with
+# the download, if any) and made durable before the download state is
+# updated, so a download cut short by the end of a download window, a
+# dropped connection or a restart carries on from the last good chunk.
+# Completed artifacts are kept within a storage budget, the least
+# recently used being evicted first.
+#
+import os
+import json
+import time
+import errno
+import hashlib
+import threading
+from syslog import syslog
+
+import journal
+import multihash
+import shaper
+
+CACHE_DIR = '/data/igupd/cache'
+CACHE_BUDGET = 256 * 1024 * 1024
+CACHE_CHUNK_SIZE = 1024 * 1024
+STATE_SUFFIX = '.json'
+DATA_SUFFIX = '.swu'
+
+HTTP_TIMEOUT = 30
+READ_SIZE = 64 * 1024
+RETRY_MIN = 2
+RETRY_MAX = 60
+# Consecutive bad chunks before the download is given up
+MAX_CHUNK_FAILURES = 5
+
+
+class CacheError(Exception):
+    '''
+    A download that cannot succeed by retrying
+    '''
+    pass
+
+
+def artifact_key(url, sha256=None):
+    '''
+    Artifacts with a known digest are shared between URLs
+    '''
+    if sha256:
+        return sha256.lower()
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def write_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    journal.sync_dir(path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class ArtifactCache(object):
+    '''
+    A directory of artifacts, each a data file and a JSON state file
+    recording where it came from, the digests of the chunks written so
+    far and when it was last used
+    '''
+    def __init__(self, directory=CACHE_DIR, budget=CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.stats = {'evictions' : 0, 'evicted_bytes' : 0}
+
+    def state_path(self, key):
+        return os.path.join(self.directory, key + STATE_SUFFIX)
+
+    def data_path(self, key):
+        return os.path.join(self.directory, key + DATA_SUFFIX)
+
+    def load(self, key):
+        try:
+            with open(self.state_path(key), 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return state if isinstance(state, dict) and state.get('key') == key else None
+
+    def save(self, state):
+        state['last_used'] = time.time()
+        write_state(self.state_path(state['key']), state)
+
+    def entries(self):
+        '''
+        Return the state of every artifact in the cache
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        states = []
+        for name in names:
+            if name.endswith(STATE_SUFFIX):
+                state = self.load(name[:-len(STATE_SUFFIX)])
+                if state is not None:
+                    states.append(state)
+        return states
+
+    def size_of(self, key):
+        try:
+            return os.path.getsize(self.data_path(key))
+        except OSError:
+            return 0
+
+    def used_bytes(self):
+        return sum(self.size_of(state['key']) for state in self.entries())
+
+    def open(self, url, sha256=None, chunks=None, chunk_size=CACHE_CHUNK_SIZE, fallback_url=None):
+        '''
+        Return the state of the artifact for a download, carrying on
+        from a previous one for the same artifact if there is one.
+        fallback_url, of the full image for a delta, is kept with it.
+        '''
+        key = artifact_key(url, sha256)
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            state = self.load(key)
+            if state is None or state.get('chunk_size') != chunk_size or \
+                    state.get('chunks') != chunks or \
+                    (sha256 is None and state.get('url') != url):
+                remove_file(self.data_path(key))
+                state = {'key' : key, 'size' : None, 'digests' : [],
+                         'validator' : None, 'complete' : False}
+            state.update({'url' : url, 'sha256' : sha256, 'chunks' : chunks,
+                          'chunk_size' : chunk_size, 'fallback_url' : fallback_url,
+                          'pending' : True})
+            self.save(state)
+        return state
+
+    def reserve(self, key, size):
+        '''
+        Make room for an artifact of size bytes, evicting the least
+        recently used others.  Complete artifacts not yet released are
+        being installed, and are kept.
+        '''
+        if size > self.budget:
+            raise CacheError('Artifact of {} bytes exceeds the cache budget of {} bytes'.format(
+                size, self.budget))
+        with self.lock:
+            others = [s for s in self.entries() if s['key'] != key]
+            used = sum(self.size_of(s['key']) for s in others)
+            others = [s for s in others if not (s.get('pending') and s.get('complete'))]
+            others.sort(key=lambda s: s.get('last_used', 0))
+            while others and used + size > self.budget:
+                victim = others.pop(0)
+                victim_size = self.size_of(victim['key'])
+                syslog('Artifact cache: evicting {} ({} bytes)'.format(victim.get('url'), victim_size))
+                self.remove(victim['key'])
+                used -= victim_size
+                self.stats['evictions'] += 1
+                self.stats['evicted_bytes'] += victim_size
+
+    def remove(self, key):
+        remove_file(self.state_path(key))
+        remove_file(self.data_path(key))
+
+    def pending(self):
+        '''
+        Return the states of downloads not yet handed over, most
+        recently used first
+        '''
+        states = [s for s in self.entries() if s.get('pending')]
+        states.sort(key=lambda s: s.get('last_used', 0), reverse=True)
+        return states
+
+    def release(self, key):
+        '''
+        The artifact has been handed over; keep it until it is evicted
+        '''
+        with self.lock:
+            state = self.load(key)
+            if state is not None:
+                state['pending'] = False
+                self.save(state)
+
+
+class RangeDownload(object):
+    '''
+    Download one artifact into the cache, carrying on from the verified
+    chunks already there.  run() blocks, so it is used off the main loop;
+    stop() ends it at the next read.
+    '''
+    def __init__(self, cache, url, sha256=None, chunks=None,
+                 chunk_size=CACHE_CHUNK_SIZE, timeout=HTTP_TIMEOUT, proxy=None, fallback_url=None):
+        self.cache = cache
+        self.timeout = timeout
+        self.proxy = proxy
+        self.state = cache.open(url, sha256, chunks, chunk_size, fallback_url)
+        self.key = self.state['key']
+        self.path = cache.data_path(self.key)
+        self.stop_event = threading.Event()
+        self.chunk_failures = 0
+        # Other copies of the artifact (e.g. on peers) tried before the
+        # URL; only used for artifacts with a known digest
+        self.mirrors = []
+        self.stats = {'downloaded_bytes' : 0, 'resumed_bytes' : 0, 'requests' : 0,
+                      'resumes' : 0, 'restarts' : 0, 'chunk_failures' : 0,
+                      'mirror_bytes' : 0}
+        # Set by recover() on the first run, which reads the whole artifact
+        self.offset = None
+
+    def recover(self):
+        '''
+        Check the chunks already downloaded and drop anything after the
+        last good one, e.g. a chunk torn by a power loss.  Returns the
+        offset to carry on from.
+        '''
+        state = self.state
+        chunk_size = state['chunk_size']
+        good = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for digest in state['digests']:
+                    if hashlib.sha256(f.read(chunk_size)).hexdigest() != digest:
+                        break
+                    good += 1
+        except (IOError, OSError):
+            pass
+        if good < len(state['digests']):
+            syslog('Artifact cache: {} has {} bad chunks, downloading them again'.format(
+                state['url'], len(state['digests']) - good))
+            del state['digests'][good:]
+            state['complete'] = False
+            self.cache.save(state)
+        offset = min(good * chunk_size, state['size'] or 0)
+        with open(self.path, 'ab') as f:
+            f.truncate(offset)
+        return offset
+
+    def restart(self):
+        '''
+        The artifact on the server changed; start again from the beginning
+        '''
+        self.stats['restarts'] += 1
+        self.offset = 0
+        self.state.update({'size' : None, 'digests' : [], 'validator' : None})
+        with open(self.path, 'ab') as f:
+            f.truncate(0)
+        self.cache.save(self.state)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def resume(self):
+        self.stop_event.clear()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def complete(self):
+        return self.state['complete']
+
+    def progress(self):
+        return self.offset or 0, self.state['size']
+
+    def fetch(self):
+        '''
+        Make one request for the rest of the artifact and write what
+        arrives.  Returns True once the whole artifact has been written.
+        '''
+        from urllib.request import Request
+        from urllib.error import HTTPError
+
+        state = self.state
+        if state['size'] is not None and self.offset >= state['size']:
+            return True
+        mirror = self.mirror()
+        request = Request(mirror or state['url'])
+        if self.offset:
+            request.add_header('Range', 'bytes={}-'.format(self.offset))
+            if state['validator'] and not mirror:
+                request.add_header('If-Range', state['validator'])
+        self.stats['requests'] += 1
+        try:
+            # Mirrors are local, so they are not shaped
+            response = shaper.open_url(request, self.timeout, None if mirror else self.proxy)
+        except HTTPError as e:
+            if e.code == 416 and self.offset and self.offset == state['size']:
+                return True
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise CacheError('HTTP error {} for {}'.format(e.code, mirror or state['url']))
+            raise
+        try:
+            return self.receive(response, mirror)
+        finally:
+            response.close()
+
+    def mirror(self):
+        if self.mirrors and self.state['sha256']:
+            return self.mirrors[0]
+        return None
+
+    def receive(self, response, mirror=None):
+        state = self.state
+        headers = response.headers
+        if self.offset:
+            content_range = headers.get('Content-Range', '')
+            if response.getcode() == 206 and content_range.startswith(
+                    'bytes {}-'.format(self.offset)):
+                self.stats['resumes'] += 1
+                size = int(content_range.rsplit('/', 1)[1])
+            else:
+                # The server sent the whole artifact: it does not do
+                # ranges, or the artifact changed
+                syslog('Artifact cache: {} cannot be resumed, starting again'.format(state['url']))
+                self.restart()
+        if not self.offset:
+            size = int(headers['Content-Length'])
+        validator = None
+        if not mirror:
+            validator = headers.get('ETag') or headers.get('Last-Modified')
+        if state['size'] is None:
+            self.cache.reserve(self.key, size)
+            state['size'] = size
+            state['validator'] = validator
+            self.cache.save(state)
+        elif size != state['size']:
+            self.restart()
+            raise IOError('Size of {} changed'.format(state['url']))
+
+        chunk_size = state['chunk_size']
+        with open(self.path, 'r+b') as f:
+            f.seek(self.offset)
+            chunk = bytearray()
+            while not self.stopped() and self.offset < size:
+                want = min(chunk_size, size - self.offset) - len(chunk)
+                data = response.read(min(READ_SIZE, want))
+                if not data:
+                    raise IOError('Connection closed after {} of {} bytes'.format(
+                        self.offset + len(chunk), size))
+                chunk += data
+                self.stats['downloaded_bytes'] += len(data)
+                if mirror:
+                    self.stats['mirror_bytes'] += len(data)
+                if len(chunk) == min(chunk_size, size - self.offset):
+                    self.commit(f, chunk)
+                    chunk = bytearray()
+        # A partial chunk is downloaded again next time
+        return self.offset >= size
+
+    def commit(self, f, chunk):
+        '''
+        Check a chunk and make it durable before recording it
+        '''
+        state = self.state
+        index = len(state['digests'])
+        digest = hashlib.sha256(chunk).hexdigest()
+        if state['chunks'] is not None and (index >= len(state['chunks']) or
+                state['chunks'][index] != digest):
+            self.stats['chunk_failures'] += 1
+            self.chunk_failures += 1
+            if self.chunk_failures >= MAX_CHUNK_FAILURES:
+                raise CacheError('Chunk {} of {} keeps failing verification'.format(
+                    index, state['url']))
+            raise IOError('Chunk {} of {} failed verification'.format(index, state['url']))
+        self.chunk_failures = 0
+        f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        state['digests'].append(digest)
+        self.offset += len(chunk)
+        self.cache.save(state)
+
+    def finish(self):
+        state = self.state
+        if state['sha256']:
+            digest = multihash.file_digests(self.path, ('sha256',))['sha256']
+            if digest != state['sha256'].lower():
+                self.cache.remove(self.key)
+                raise CacheError('Digest of {} does not match'.format(state['url']))
+        state['complete'] = True
+        self.cache.save(state)
+        syslog('Artifact cache: {} complete, {} bytes downloaded, {} resumed'.format(
+            state['url'], self.stats['downloaded_bytes'], self.stats['resumed_bytes']))
+        return self.path
+
+    def run(self, retry_min=RETRY_MIN, retry_max=RETRY_MAX):
+        '''
+        Download until the artifact is complete, retrying with back off,
+        or until stopped.  Returns the path of the artifact, or None if
+        stopped.  Raises CacheError if the download cannot succeed.
+        '''
+        from http.client import HTTPException
+
+        if self.offset is None:
+            self.offset = self.recover()
+            self.stats['resumed_bytes'] = self.offset
+        if self.complete():
+            return self.path
+        delay = retry_min
+        while not self.stopped():
+            offset = self.offset
+            mirror = self.mirror()
+            try:
+                done = self.fetch()
+            except (CacheError, IOError, OSError, ValueError, KeyError, HTTPException) as e:
+                if mirror is None and isinstance(e, CacheError):
+                    raise
+                syslog('Artifact cache: download of {} interrupted at {} bytes: {}'.format(
+                    mirror or self.state['url'], self.offset, e))
+                if mirror is not None:
+                    # Carry on from the next mirror, or the URL
+                    self.mirrors.pop(0)
+                    self.chunk_failures = 0
+                    continue
+                done = False
+            if done:
+                return self.finish()
+            if self.offset > offset:
+                delay = retry_min
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, retry_max)
+        return None
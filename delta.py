@@ -0,0 +1,290 @@
+#
+# delta.py - Block level delta images built from the active side
+#
+# A delta artifact describes a target image (normally a .swu) as a
+# list of fixed size blocks, each with an rsync style rolling weak hash
+# and a SHA-256.  Only blocks that are not expected on the device are
+# included in the artifact.  The device finds the others in its active
+# volumes with a rolling hash scan, which also finds blocks that have
+# moved, e.g. a rootfs image at an unaligned offset in the .swu.  The
+# rolling is done in Python a byte at a time, so it is kept to a window
+# after each match; past that the scan steps a whole block at a time.
+# make_delta() scans the same way, so whatever the device would not
+# find is sent in the artifact.
+#
+import os
+import time
+import struct
+import hashlib
+import itertools
+from syslog import syslog
+
+DELTA_MAGIC = b'IGDELTA1'
+# magic, block size, target size, block count, target SHA-256
+DELTA_HEADER = struct.Struct('>8sIQI32s')
+# weak hash, SHA-256, flags
+DELTA_ENTRY = struct.Struct('>I32sB')
+DELTA_FLAG_LITERAL = 1
+DELTA_BLOCK_SIZE = 4096
+DELTA_SUFFIX = '.swudelta'
+
+WEAK_MOD = 1 << 16
+SCAN_READ_SIZE = 1 << 20
+# Bytes rolled through after the last match before stepping whole blocks
+SCAN_ROLL_WINDOW = 64 * 1024
+# Seconds the device may scan before the delta is given up on
+SCAN_TIME_LIMIT = 120
+
+
+class DeltaError(Exception):
+    pass
+
+
+class DeltaScanLimit(DeltaError):
+    '''
+    The local volumes could not be scanned in time.  Nothing has been
+    written, so the full image can be installed instead.
+    '''
+    pass
+
+
+def weak_parts(data):
+    '''
+    Return the two halves of the rsync weak checksum of data:
+    a = sum(x[i]), b = sum((len - i) * x[i]), both modulo 2^16
+    '''
+    a = sum(data) % WEAK_MOD
+    # sum((len - i) * x[i]) is the sum of the prefix sums
+    b = sum(itertools.accumulate(data)) % WEAK_MOD
+    return a, b
+
+
+def weak_hash(data):
+    a, b = weak_parts(data)
+    return (b << 16) | a
+
+
+def is_delta(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(DELTA_MAGIC)) == DELTA_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise DeltaError('Delta artifact is truncated')
+    return data
+
+
+class ChunkIndex(object):
+    '''
+    Locations in local files of the blocks wanted for a target image.
+    If deadline (in clock() seconds) is given, scan() raises
+    DeltaScanLimit once it has passed.
+    '''
+    def __init__(self, block_size=DELTA_BLOCK_SIZE, roll_window=SCAN_ROLL_WINDOW,
+                 deadline=None, clock=time.monotonic):
+        self.block_size = block_size
+        self.roll_window = roll_window
+        self.deadline = deadline
+        self.clock = clock
+        self.found = {}
+        self.scanned_bytes = 0
+
+    def scan(self, path, wanted):
+        '''
+        Look for wanted blocks, a dict of weak hash to a set of SHA-256
+        digests, in path.  Blocks found are removed from wanted, and the
+        scan stops once nothing more is wanted.  After a match the scan
+        moves on a whole block, so unchanged data costs one hash per
+        block.  Changed data is rolled through a byte at a time for up
+        to roll_window bytes from the start of the file or the last
+        match, which finds data that has moved; after that the scan
+        steps a whole block at a time until the next match.
+        '''
+        size = self.block_size
+        buf = bytearray()
+        base = 0
+        pos = 0
+        rolled = 0
+        a = b = None
+        eof = False
+        with open(path, 'rb') as f:
+            while wanted:
+                if len(buf) - pos <= size and not eof:
+                    if self.deadline is not None and self.clock() >= self.deadline:
+                        raise DeltaScanLimit('Scan of local volumes stopped after {} bytes'.format(
+                            self.scanned_bytes))
+                    # Keep the window and the byte after it in the buffer
+                    del buf[:pos]
+                    base += pos
+                    pos = 0
+                    data = f.read(SCAN_READ_SIZE)
+                    if not data:
+                        eof = True
+                    buf.extend(data)
+                    self.scanned_bytes += len(data)
+                    continue
+                if len(buf) - pos < size:
+                    break
+                if a is None:
+                    a, b = weak_parts(memoryview(buf)[pos:pos + size])
+                strongs = wanted.get((b << 16) | a)
+                if strongs:
+                    strong = hashlib.sha256(memoryview(buf)[pos:pos + size]).digest()
+                    if strong in strongs:
+                        self.found[strong] = (path, base + pos)
+                        strongs.discard(strong)
+                        if not strongs:
+                            del wanted[(b << 16) | a]
+                        pos += size
+                        rolled = 0
+                        a = None
+                        continue
+                if rolled >= self.roll_window:
+                    pos += size
+                    a = None
+                    continue
+                if len(buf) - pos == size:
+                    break
+                x_out = buf[pos]
+                a = (a - x_out + buf[pos + size]) % WEAK_MOD
+                b = (b - size * x_out + a) % WEAK_MOD
+                pos += 1
+                rolled += 1
+
+
+def target_blocks(path, block_size):
+    '''
+    Yield (weak, strong, data) for each block of path
+    '''
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block_size), b''):
+            yield weak_hash(data), hashlib.sha256(data).digest(), data
+
+
+def make_delta(sources, target, out, block_size=DELTA_BLOCK_SIZE):
+    '''
+    Write a delta artifact for the target image to the file object out,
+    against the images in the list sources as they are on the device.
+    Returns the number of literal bytes included.
+    '''
+    entries = []
+    wanted = {}
+    sha = hashlib.sha256()
+    target_size = 0
+    for weak, strong, data in target_blocks(target, block_size):
+        sha.update(data)
+        target_size += len(data)
+        entries.append((weak, strong, len(data)))
+        if len(data) == block_size:
+            wanted.setdefault(weak, set()).add(strong)
+    index = ChunkIndex(block_size)
+    for source in sources:
+        index.scan(source, wanted)
+
+    out.write(DELTA_HEADER.pack(DELTA_MAGIC, block_size, target_size, len(entries), sha.digest()))
+    literal = []
+    for weak, strong, length in entries:
+        flags = 0
+        if strong not in index.found or length < block_size:
+            flags = DELTA_FLAG_LITERAL
+        literal.append(flags)
+        out.write(DELTA_ENTRY.pack(weak, strong, flags))
+    literal_bytes = 0
+    for flags, (weak, strong, data) in zip(literal, target_blocks(target, block_size)):
+        if flags & DELTA_FLAG_LITERAL:
+            out.write(data)
+            literal_bytes += len(data)
+    return literal_bytes
+
+
+class DeltaReconstructor(object):
+    '''
+    Rebuild a target image from a delta artifact and the local source
+    volumes, writing it to a stream (e.g. the swupdate install socket)
+    as it goes.  Blocks the artifact expects to be local but which are
+    not found are requested from fetch_block(index, strong), if given.
+    The scan of the source volumes is given up on after time_limit
+    seconds.
+    '''
+    def __init__(self, sources, fetch_block=None, time_limit=SCAN_TIME_LIMIT):
+        self.sources = sources
+        self.fetch_block = fetch_block
+        self.time_limit = time_limit
+        self.stats = {}
+
+    def apply(self, artifact, out):
+        '''
+        Read the artifact from the file object artifact and write the
+        target image to out.  Raises DeltaError if the image cannot be
+        rebuilt exactly, or DeltaScanLimit, before anything is written,
+        if the scan takes too long.  Returns the statistics for this
+        update.
+        '''
+        start = time.time()
+        header = read_exact(artifact, DELTA_HEADER.size)
+        magic, block_size, target_size, count, target_sha = DELTA_HEADER.unpack(header)
+        if magic != DELTA_MAGIC:
+            raise DeltaError('Not a delta artifact')
+        manifest = read_exact(artifact, DELTA_ENTRY.size * count)
+        entries = [DELTA_ENTRY.unpack_from(manifest, i * DELTA_ENTRY.size) for i in range(count)]
+        downloaded = len(header) + len(manifest)
+
+        wanted = {}
+        for weak, strong, flags in entries:
+            if not flags & DELTA_FLAG_LITERAL:
+                wanted.setdefault(weak, set()).add(strong)
+        index = ChunkIndex(block_size, deadline=time.monotonic() + self.time_limit)
+        for source in self.sources:
+            if not wanted:
+                break
+            try:
+                index.scan(source, wanted)
+            except (IOError, OSError) as e:
+                syslog('delta: cannot scan {}: {}'.format(source, e))
+
+        files = {}
+        sha = hashlib.sha256()
+        reused = 0
+        fetched = 0
+        written = 0
+        try:
+            for i, (weak, strong, flags) in enumerate(entries):
+                length = min(block_size, target_size - written)
+                if flags & DELTA_FLAG_LITERAL:
+                    data = read_exact(artifact, length)
+                    downloaded += length
+                elif strong in index.found:
+                    path, offset = index.found[strong]
+                    if path not in files:
+                        files[path] = os.open(path, os.O_RDONLY)
+                    data = os.pread(files[path], length, offset)
+                    reused += length
+                elif self.fetch_block is not None:
+                    data = self.fetch_block(i, strong)
+                    fetched += len(data)
+                else:
+                    raise DeltaError('Block {} is not available locally'.format(i))
+                if hashlib.sha256(data).digest() != strong:
+                    raise DeltaError('Block {} does not match'.format(i))
+                sha.update(data)
+                out.write(data)
+                written += len(data)
+        finally:
+            for fd in files.values():
+                os.close(fd)
+        if written != target_size or sha.digest() != target_sha:
+            raise DeltaError('Rebuilt image does not match')
+
+        self.stats = {'target_bytes' : target_size, 'reused_bytes' : reused,
+                      'downloaded_bytes' : downloaded + fetched,
+                      'saved_bytes' : target_size - downloaded - fetched,
+                      'scanned_bytes' : index.scanned_bytes,
+                      'duration' : time.time() - start}
+        syslog('delta: rebuilt {target_bytes} bytes, {reused_bytes} from local volumes, '
+               '{downloaded_bytes} downloaded, {saved_bytes} saved, in {duration:.1f}s'.format(**self.stats))
+        return self.stats
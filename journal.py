@@ -0,0 +1,175 @@
+#
+# journal.py - Append-only journal of the update state
+#
+import os
+import json
+import zlib
+import errno
+from syslog import syslog
+
+JOURNAL_NAME = 'state.journal'
+# Changes are written this many seconds after the first one, so that a
+# burst of changes costs a single fsync
+JOURNAL_SYNC_DELAY = 2
+# The journal is rewritten as a single record once it has this many
+JOURNAL_MAX_RECORDS = 64
+
+
+def encode_record(changes):
+    data = json.dumps(changes, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % (zlib.crc32(data) & 0xffffffff) + data + b'\n'
+
+
+def decode_record(line):
+    '''
+    Return the changes in a journal line, or None if it is damaged,
+    e.g. torn by a power loss while it was written
+    '''
+    if not line.endswith(b'\n') or len(line) < 10:
+        return None
+    data = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(data) & 0xffffffff:
+            return None
+        changes = json.loads(data.decode('utf-8'))
+    except ValueError:
+        return None
+    return changes if isinstance(changes, dict) else None
+
+
+def sync_dir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StateJournal(object):
+    '''
+    Record changes to the update state as checksummed JSON lines
+    appended to a file, and rebuild the state from it after a restart.
+
+    Changes are kept in memory until sync(), which happens after
+    JOURNAL_SYNC_DELAY seconds on the main loop (if one is given) or
+    straight away when a change asks for it.  A damaged tail, from a
+    write cut short, is ignored when the journal is replayed.
+    '''
+    def __init__(self, path, loop=None, sync_delay=JOURNAL_SYNC_DELAY,
+                 max_records=JOURNAL_MAX_RECORDS):
+        self.path = path
+        self.loop = loop
+        self.sync_delay = sync_delay
+        self.max_records = max_records
+        self.state = {}
+        self.pending = []
+        self.records = 0
+        self.sync_id = None
+        self.stats = {'records' : 0, 'syncs' : 0, 'compactions' : 0, 'damaged' : 0}
+
+    def replay(self):
+        '''
+        Read the journal and return the state it records
+        '''
+        state = {}
+        records = 0
+        damaged = False
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    changes = decode_record(line)
+                    if changes is None:
+                        damaged = True
+                        break
+                    state.update(changes)
+                    records += 1
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                syslog('journal: failed to read {}: {}'.format(self.path, e))
+        self.state = state
+        self.records = records
+        if damaged:
+            # Drop the damaged tail, so that new records follow good ones
+            self.stats['damaged'] += 1
+            syslog('journal: ignoring damaged records after {} in {}'.format(records, self.path))
+            self.compact()
+        return dict(state)
+
+    def record(self, changes, sync=False):
+        '''
+        Add changes to the state.  With sync they are on flash when
+        this returns.
+        '''
+        self.state.update(changes)
+        self.pending.append(encode_record(changes))
+        self.stats['records'] += 1
+        if sync or self.loop is None:
+            self.sync()
+        elif self.sync_id is None:
+            self.sync_id = self.loop.call_later(self.sync_delay, self.sync_timeout)
+
+    def sync_timeout(self):
+        self.sync_id = None
+        self.sync()
+
+    def sync(self):
+        if self.sync_id is not None:
+            self.loop.cancel(self.sync_id)
+            self.sync_id = None
+        if not self.pending:
+            return
+        try:
+            if self.records + len(self.pending) > self.max_records:
+                self.compact()
+                return
+            self.make_dir()
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self.records += len(self.pending)
+            self.pending = []
+            self.stats['syncs'] += 1
+        except (IOError, OSError) as e:
+            syslog('journal: failed to write {}: {}'.format(self.path, e))
+
+    def compact(self):
+        '''
+        Replace the journal with a single record of the current state
+        '''
+        try:
+            self.make_dir()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(encode_record(self.state))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            sync_dir(self.path)
+            self.records = 1
+            self.pending = []
+            self.stats['compactions'] += 1
+        except (IOError, OSError) as e:
+            syslog('journal: failed to compact {}: {}'.format(self.path, e))
+
+    def reset(self):
+        '''
+        Forget the recorded state
+        '''
+        if self.sync_id is not None:
+            self.loop.cancel(self.sync_id)
+            self.sync_id = None
+        self.state = {}
+        self.pending = []
+        self.records = 0
+        try:
+            os.remove(self.path)
+            sync_dir(self.path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                syslog('journal: failed to remove {}: {}'.format(self.path, e))
+
+    def make_dir(self):
+        d = os.path.dirname(self.path)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
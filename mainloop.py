@@ -0,0 +1,56 @@
+#
+# mainloop.py - Helpers for scheduling work on the GLib main loop
+#
+import math
+import timersched
+
+import sys
+PYTHON3 = sys.version_info >= (3, 0)
+if PYTHON3:
+    from gi.repository import GLib as glib
+else:
+    import gobject as glib
+
+
+def arm_timer(seconds, callback):
+    # Round up, so the timer never fires before the earliest deadline
+    return glib.timeout_add(int(math.ceil(seconds * 1000)), callback)
+
+
+# All timeouts share this scheduler and its single GLib timer
+scheduler = timersched.TimerScheduler(arm_timer, glib.source_remove)
+
+
+def call_later(seconds, callback, *args):
+    '''
+    Run callback once from the main loop after the given delay.
+    Returns a handle which can be passed to cancel().
+    '''
+    return scheduler.schedule(seconds, callback, args)
+
+
+def watch_readable(fd, callback):
+    '''
+    Call callback(fd, condition) from the main loop whenever fd is
+    readable or hung up, for as long as the callback returns True.
+    '''
+    return glib.io_add_watch(fd, glib.IO_IN | glib.IO_HUP | glib.IO_ERR, callback)
+
+
+def watch_child(pid, callback):
+    '''
+    Call callback(pid, status) from the main loop once the child process
+    exits.  GLib reaps it.
+    '''
+    return glib.child_watch_add(pid, callback)
+
+
+def cancel(source_id):
+    if isinstance(source_id, timersched.TimerHandle):
+        source_id.cancel()
+    else:
+        glib.source_remove(source_id)
+
+
+def pending_timers():
+    return scheduler.pending()
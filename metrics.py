@@ -0,0 +1,217 @@
+#
+# metrics.py - Counters, gauges and histograms for the update pipeline
+#
+# Metrics are updated in place from the main loop (and the odd worker
+# thread, where a lost increment would not matter), so recording one
+# costs no more than the stats dicts kept elsewhere.  They are read over
+# D-Bus and may also be written to a file in the Prometheus text format,
+# for node_exporter's textfile collector.
+#
+import os
+import re
+import time
+import bisect
+from syslog import syslog
+
+PREFIX = 'igupd_'
+# Seconds, from a quick local install to a slow cellular download
+PHASE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+# Characters Prometheus does not allow in a metric name
+NAME_PATTERN = re.compile(r'[^a-zA-Z0-9_]')
+
+
+class Counter(object):
+    kind = COUNTER
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, None, self.value)]
+
+
+class Gauge(Counter):
+    kind = GAUGE
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(object):
+    '''
+    Count observations in fixed buckets, each the observations less
+    than or equal to its bound, plus one for the rest
+    '''
+    kind = HISTOGRAM
+
+    def __init__(self, name, help, buckets=PHASE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        '''
+        Return (name, le, value) with the cumulative bucket counts, as
+        Prometheus has them
+        '''
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            samples.append((self.name + '_bucket', bound, total))
+        samples.append((self.name + '_sum', None, self.sum))
+        samples.append((self.name + '_count', None, self.count))
+        return samples
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Registry(object):
+    '''
+    The metrics of one process.  Metrics are created on first use, so
+    the code recording them need not know whether they exist yet.
+    Collectors are called before the metrics are read, to copy in
+    values kept elsewhere (e.g. the swupdate restart counters).
+    '''
+    def __init__(self, prefix=PREFIX, clock=time.monotonic):
+        self.prefix = prefix
+        self.clock = clock
+        self.metrics = {}
+        self.order = []
+        self.collectors = []
+        self.running = {}
+        self.last_text = None
+
+    def add(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if existing.kind != metric.kind:
+                raise ValueError('{} is already a {}'.format(metric.name, existing.kind))
+            return existing
+        self.metrics[metric.name] = metric
+        self.order.append(metric.name)
+        return metric
+
+    def counter(self, name, help=''):
+        return self.add(Counter(self.prefix + name, help))
+
+    def gauge(self, name, help=''):
+        return self.add(Gauge(self.prefix + name, help))
+
+    def histogram(self, name, help='', buckets=PHASE_BUCKETS):
+        return self.add(Histogram(self.prefix + name, help, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def set_stats(self, prefix, stats):
+        '''
+        Copy a stats dict kept elsewhere in as gauges named
+        <prefix>_<key>, or <key> with no prefix, for use from a
+        collector.  Values that are not numbers are left out.
+        '''
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (int, float)):
+                continue
+            name = '{}_{}'.format(prefix, key) if prefix else key
+            self.gauge(NAME_PATTERN.sub('_', name)).set(value)
+
+    def begin(self, phase):
+        '''
+        Start timing a phase, for the histogram <phase>_seconds
+        '''
+        if phase not in self.running:
+            self.running[phase] = self.clock()
+
+    def end(self, phase):
+        '''
+        Record the time since begin(phase).  Returns it, or None if the
+        phase was not running.
+        '''
+        started = self.running.pop(phase, None)
+        if started is None:
+            return None
+        duration = self.clock() - started
+        self.histogram(phase + '_seconds', 'Time spent in the {} phase'.format(phase)).observe(duration)
+        return duration
+
+    def cancel(self, phase):
+        '''
+        Stop timing a phase without recording it
+        '''
+        self.running.pop(phase, None)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                syslog('Metrics collector failed: {}'.format(e))
+        return [self.metrics[name] for name in self.order]
+
+    def snapshot(self):
+        '''
+        Return the metrics as a flat dict, for D-Bus.  Histogram buckets
+        are keyed <name>_bucket.le.<bound>.
+        '''
+        values = {}
+        for metric in self.collect():
+            for name, le, value in metric.samples():
+                if le is not None:
+                    name = '{}.le.{}'.format(name, le)
+                values[name] = value
+        return values
+
+    def prometheus_text(self):
+        lines = []
+        for metric in self.collect():
+            if metric.help:
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, le, value in metric.samples():
+                if le is not None:
+                    name = '{}{{le="{}"}}'.format(name, le)
+                lines.append('{} {}'.format(name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''
+        Write the metrics to path, replacing it atomically so a scrape
+        never sees part of a file.  Nothing is written if they have not
+        changed since the last write.  Returns True if the file was
+        written.
+        '''
+        text = self.prometheus_text()
+        if text == self.last_text and os.path.exists(path):
+            return False
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+        self.last_text = text
+        return True
@@ -0,0 +1,238 @@
+#
+# migrate.py - Incremental migration of /data to the other boot side
+#
+import os
+import stat
+import json
+import time
+import errno
+import shutil
+import hashlib
+from syslog import syslog
+
+COPY_BLOCK_SIZE = 1 << 16
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def lstat_or_none(path):
+    try:
+        return os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def copy_owner(st, path, dst_st=None):
+    '''
+    Give path the owner, group and permissions in st, as the migrate
+    script does, unless dst_st shows it already has them
+    '''
+    if dst_st is None or (dst_st.st_uid, dst_st.st_gid) != (st.st_uid, st.st_gid):
+        os.lchown(path, st.st_uid, st.st_gid)
+    # After chown, which clears the setuid and setgid bits
+    if not stat.S_ISLNK(st.st_mode) and \
+            (dst_st is None or stat.S_IMODE(dst_st.st_mode) != stat.S_IMODE(st.st_mode)):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def copy_file(src, dst, st=None):
+    '''
+    Copy a file via a temporary file and rename, returning its sha256.
+    The owner and group are copied from st, the lstat() of src.
+    '''
+    h = hashlib.sha256()
+    tmp = dst + '.migrate-tmp'
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(COPY_BLOCK_SIZE), b''):
+                h.update(chunk)
+                fdst.write(chunk)
+    shutil.copystat(src, tmp)
+    copy_owner(st or os.lstat(src), tmp)
+    os.rename(tmp, dst)
+    return h.hexdigest()
+
+
+def remove_path(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class DataMigration(object):
+    '''
+    Mirror the data directory of the running side to the other side.
+
+    A manifest records the size, mtime and sha256 of every file already
+    copied to the destination, so that the bulk of the data can be
+    pre-staged as soon as an update is installed and only the changes
+    since then are copied at reboot time.  A file is only skipped if
+    the copy on the destination still has the recorded size and mtime,
+    and anything on the destination not in the source is removed.
+    The manifest should be kept outside the source.
+    '''
+    def __init__(self, src, dst, manifest_path):
+        self.src = src
+        self.dst = dst
+        self.manifest_path = manifest_path
+        self.manifest = {}
+        self.stats = {}
+        self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and \
+                    manifest.get('src') == self.src and manifest.get('dst') == self.dst:
+                self.manifest = manifest['files']
+        except (IOError, OSError, ValueError, KeyError):
+            self.manifest = {}
+
+    def save_manifest(self):
+        if not os.path.isdir(os.path.dirname(self.manifest_path)):
+            os.makedirs(os.path.dirname(self.manifest_path))
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version' : MANIFEST_VERSION, 'src' : self.src,
+                       'dst' : self.dst, 'files' : self.manifest}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.manifest_path)
+
+    def reset(self):
+        '''
+        Forget what was staged, e.g. for a new update, whose destination
+        may have been changed since by the side it belongs to
+        '''
+        self.manifest = {}
+        try:
+            os.remove(self.manifest_path)
+        except OSError:
+            pass
+
+    def sync(self):
+        '''
+        Bring the destination up to date with the source.  Returns a dict
+        of statistics for this pass.
+        '''
+        start = time.time()
+        stats = {'bytes_copied' : 0, 'files_copied' : 0, 'files_skipped' : 0,
+                 'files_removed' : 0}
+        seen = set()
+        for root, dirs, files in os.walk(self.src):
+            rel_root = os.path.relpath(root, self.src)
+            dst_root = os.path.normpath(os.path.join(self.dst, rel_root))
+            if not os.path.isdir(dst_root):
+                remove_path(dst_root)
+                os.makedirs(dst_root)
+            for name in dirs + files:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                src_path = os.path.join(root, name)
+                if os.path.abspath(src_path) in (os.path.abspath(self.manifest_path),
+                                                 os.path.abspath(self.manifest_path + '.tmp')):
+                    continue
+                seen.add(rel)
+                self.sync_entry(rel, src_path, os.path.join(dst_root, name), stats)
+
+        for root, dirs, files in os.walk(self.dst):
+            rel_root = os.path.relpath(root, self.dst)
+            for name in dirs + files:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                if rel not in seen:
+                    remove_path(os.path.join(root, name))
+                    stats['files_removed'] += 1
+            dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(rel_root, d)) in seen]
+        for rel in [r for r in self.manifest if r not in seen]:
+            del self.manifest[rel]
+
+        self.save_manifest()
+        stats['duration'] = time.time() - start
+        self.stats = stats
+        return stats
+
+    def sync_entry(self, rel, src_path, dst_path, stats):
+        st = os.lstat(src_path)
+        entry = self.manifest.get(rel)
+        dst_st = lstat_or_none(dst_path)
+        if stat.S_ISDIR(st.st_mode):
+            if dst_st is None or not stat.S_ISDIR(dst_st.st_mode):
+                remove_path(dst_path)
+                os.mkdir(dst_path)
+                dst_st = None
+            copy_owner(st, dst_path, dst_st)
+            self.manifest[rel] = ['d']
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(src_path)
+            if entry != ['l', target] or dst_st is None or not stat.S_ISLNK(dst_st.st_mode) or \
+                    os.readlink(dst_path) != target:
+                remove_path(dst_path)
+                os.symlink(target, dst_path)
+                dst_st = None
+                stats['files_copied'] += 1
+            else:
+                stats['files_skipped'] += 1
+            copy_owner(st, dst_path, dst_st)
+            self.manifest[rel] = ['l', target]
+        elif stat.S_ISREG(st.st_mode):
+            # The destination copy must still be the one recorded; the
+            # other side may have changed it while it was running
+            if entry and entry[0] == 'f' and entry[1] == st.st_size and dst_st is not None and \
+                    stat.S_ISREG(dst_st.st_mode) and dst_st.st_size == entry[1] and \
+                    dst_st.st_mtime == entry[2]:
+                if entry[2] == st.st_mtime:
+                    copy_owner(st, dst_path, dst_st)
+                    stats['files_skipped'] += 1
+                    return
+                # Touched but possibly unchanged; compare contents
+                digest = file_sha256(src_path)
+                if digest == entry[3]:
+                    shutil.copystat(src_path, dst_path)
+                    copy_owner(st, dst_path)
+                    self.manifest[rel] = ['f', st.st_size, st.st_mtime, digest]
+                    stats['files_skipped'] += 1
+                    return
+            if dst_st is not None and stat.S_ISDIR(dst_st.st_mode):
+                remove_path(dst_path)
+            digest = copy_file(src_path, dst_path, st)
+            self.manifest[rel] = ['f', st.st_size, st.st_mtime, digest]
+            stats['files_copied'] += 1
+            stats['bytes_copied'] += st.st_size
+        # Sockets, fifos and devices are not migrated
+
+    def prestage(self):
+        '''
+        Copy the bulk of the data ahead of the reboot
+        '''
+        syslog('migrate: pre-staging {} to {}'.format(self.src, self.dst))
+        stats = self.sync()
+        syslog('migrate: pre-staged {bytes_copied} bytes in {files_copied} files, '
+               '{files_skipped} unchanged, in {duration:.1f}s'.format(**stats))
+        return stats
+
+    def finalize(self):
+        '''
+        Copy the changes made since pre-staging.  Returns True on success.
+        '''
+        try:
+            stats = self.sync()
+        except (IOError, OSError) as e:
+            syslog('migrate: final migration failed: {}'.format(e))
+            return False
+        syslog('migrate: final delta of {bytes_copied} bytes in {files_copied} files, '
+               '{files_skipped} unchanged, {files_removed} removed, in {duration:.1f}s'.format(**stats))
+        return True
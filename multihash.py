@@ -0,0 +1,106 @@
+#
+# multihash.py - Single pass, multi-digest hashing of files and volumes
+#
+import mmap
+import hashlib
+import threading
+from syslog import syslog
+
+# Reads are a multiple of the page size and of the flash erase block size
+HASH_BLOCK_SIZE = 1 << 20
+HASH_ALGORITHMS = ('md5', 'sha256')
+HASH_WORKERS = 2
+
+
+def file_digests(path, algorithms=HASH_ALGORITHMS, size=None,
+                 block_size=HASH_BLOCK_SIZE, use_mmap=False):
+    '''
+    Compute several digests of a file or device in one pass over the
+    data.  If size is given only that many bytes are hashed, e.g. the
+    image length written into a larger volume.  Returns a dict of
+    algorithm name to hex digest.
+    '''
+    hashes = [hashlib.new(a) for a in algorithms]
+    with open(path, 'rb', 0) as f:
+        view = None
+        if use_mmap:
+            try:
+                mm = mmap.mmap(f.fileno(), size or 0, access=mmap.ACCESS_READ)
+                view = memoryview(mm)
+            except (ValueError, EnvironmentError) as e:
+                # Character devices such as UBI volumes cannot be mapped
+                syslog('multihash: mmap of {} failed, reading: {}'.format(path, e))
+        if view is not None:
+            for offset in range(0, len(view), block_size):
+                chunk = view[offset:offset + block_size]
+                for h in hashes:
+                    h.update(chunk)
+                chunk.release()
+            view.release()
+            mm.close()
+        else:
+            buf = bytearray(block_size)
+            buf_view = memoryview(buf)
+            remaining = size
+            while remaining is None or remaining > 0:
+                nbytes = f.readinto(buf)
+                if not nbytes:
+                    break
+                if remaining is not None:
+                    nbytes = min(nbytes, remaining)
+                    remaining -= nbytes
+                chunk = buf_view[:nbytes]
+                for h in hashes:
+                    h.update(chunk)
+    return dict((a, h.hexdigest()) for a, h in zip(algorithms, hashes))
+
+
+def files_digests(paths, algorithms=HASH_ALGORITHMS, workers=HASH_WORKERS, sizes=None, **kwargs):
+    '''
+    Hash several files concurrently; hashlib releases the GIL while
+    hashing, so the volumes are processed in parallel across cores.
+    sizes optionally limits each path to a number of bytes.  Returns a
+    dict of path to digests.
+    '''
+    # Only needed once an update has been installed
+    from concurrent.futures import ThreadPoolExecutor
+    sizes = sizes or {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((p, executor.submit(file_digests, p, algorithms, size=sizes.get(p), **kwargs))
+            for p in paths)
+        return dict((p, f.result()) for p, f in futures.items())
+
+
+class DigestCache(object):
+    '''
+    Cache of volume digests keyed by volume and update generation, so
+    a volume is read back only once per installed update.
+    '''
+    def __init__(self, algorithms=HASH_ALGORITHMS):
+        self.algorithms = algorithms
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def get_many(self, paths, generation, **kwargs):
+        with self.lock:
+            result = dict((p, self.digests[(p, generation)]) for p in paths
+                if (p, generation) in self.digests)
+        missing = [p for p in paths if p not in result]
+        if missing:
+            computed = files_digests(missing, self.algorithms, **kwargs)
+            with self.lock:
+                for p, d in computed.items():
+                    self.digests[(p, generation)] = d
+            result.update(computed)
+        return result
+
+    def get(self, path, generation, **kwargs):
+        return self.get_many([path], generation, **kwargs)[path]
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.digests.clear()
+            else:
+                for key in [k for k in self.digests if k[0] == path]:
+                    del self.digests[key]
@@ -0,0 +1,119 @@
+#
+# pathwait.py - Wait for a file system path to appear without polling
+#
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from syslog import syslog
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 4096
+
+BACKOFF_MIN = 0.01
+BACKOFF_MAX = 0.5
+
+_libc = None
+
+
+def _inotify_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+class PathWatcher(object):
+    '''
+    Watch a directory with inotify for the creation of a single entry.
+    When inotify is not available, fall back to checking for the path
+    with a bounded exponential backoff.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.dirname, self.name = os.path.split(path)
+        self.name = self.name.encode('utf-8')
+        self.fd = None
+        self.backoff = BACKOFF_MIN
+        try:
+            libc = _inotify_libc()
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, self.dirname.encode('utf-8'), IN_CREATE | IN_MOVED_TO) < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, 'inotify_add_watch failed')
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            syslog('pathwait: inotify unavailable, polling for {}: {}'.format(path, e))
+
+    def fileno(self):
+        return self.fd
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def next_backoff(self):
+        '''
+        Return the next polling interval when inotify is not in use
+        '''
+        delay = self.backoff
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+        return delay
+
+    def check_events(self):
+        '''
+        Drain pending inotify events and return True if one of them
+        refers to the watched entry.
+        '''
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return found
+                raise
+            if not data:
+                return found
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\x00')
+                offset += length
+                if name == self.name or mask & IN_Q_OVERFLOW:
+                    found = True
+
+    def wait(self, timeout):
+        '''
+        Block until the path exists or the timeout (seconds) expires.
+        Returns True if the path exists.
+        '''
+        deadline = time.time() + timeout
+        while not self.exists():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self.fd is not None:
+                rd, wr, ex = select.select([self.fd], [], [], remaining)
+                if rd:
+                    self.check_events()
+            else:
+                time.sleep(min(self.next_backoff(), remaining))
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
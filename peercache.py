@@ -0,0 +1,315 @@
+#
+# peercache.py - Share verified update artifacts between gateways on a LAN
+#
+# A gateway that has downloaded and verified an artifact serves it over
+# HTTP to the other gateways at the site.  A gateway about to download
+# an artifact asks for it first with a UDP query (to a multicast group
+# by default), and downloads it from the first gateway that answers,
+# falling back to the server.  Artifacts are found by their SHA-256, so
+# the data from a peer is checked chunk by chunk and as a whole, and
+# its swupdate signature is verified with the configured public key
+# before it is used or served on.  Both sockets are bound to the
+# gateway's LAN address, so nothing is served on its WAN or cellular
+# link.
+#
+import os
+import re
+import json
+import time
+import errno
+import shutil
+import socket
+import struct
+import hashlib
+import tempfile
+import threading
+from syslog import syslog
+
+import procrun
+import swuimage
+from swuimage import VerifyError
+
+PEER_GROUP = '239.255.77.77'
+PEER_PORT = 51877
+PEER_HTTP_PORT = 51878
+PEER_QUERY_TIMEOUT = 1.0
+PEER_PATH = '/artifacts/'
+PEER_READ_SIZE = 64 * 1024
+MAX_MESSAGE = 2048
+SIOCGIFADDR = 0x8915
+# Only receive the group on the interface it was joined on (Linux)
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+CMD_OPENSSL = 'openssl'
+VERIFY_TIMEOUT = 30
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def verify_swu(path, public_key_file, timeout=VERIFY_TIMEOUT):
+    '''
+    Check an .swu image as swupdate would before installing it: the
+    signature of sw-description with the public key, and the SHA-256 of
+    every other file against those listed in sw-description.  Raises
+    VerifyError if it does not pass.
+    '''
+    if not public_key_file or not os.path.isfile(public_key_file):
+        raise VerifyError('No public key to verify images with')
+    with open(path, 'rb') as f:
+        entries = list(swuimage.cpio_entries(f))
+        names = [e[0] for e in entries]
+        if not names or names[0] != swuimage.SW_DESCRIPTION or swuimage.SW_DESCRIPTION_SIG not in names:
+            raise VerifyError('Image is not signed')
+        files = dict((name, (offset, size)) for name, offset, size in entries)
+        description = swuimage.read_entry(f, *files[swuimage.SW_DESCRIPTION])
+        signature = swuimage.read_entry(f, *files[swuimage.SW_DESCRIPTION_SIG])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            desc_path = os.path.join(tmpdir, swuimage.SW_DESCRIPTION)
+            sig_path = os.path.join(tmpdir, swuimage.SW_DESCRIPTION_SIG)
+            with open(desc_path, 'wb') as d:
+                d.write(description)
+            with open(sig_path, 'wb') as s:
+                s.write(signature)
+            result = procrun.run([CMD_OPENSSL, 'dgst', '-sha256', '-verify', public_key_file,
+                '-signature', sig_path, desc_path], timeout)
+        finally:
+            shutil.rmtree(tmpdir)
+        if result.returncode != 0:
+            raise VerifyError('Bad signature: {}'.format(
+                result.stderr.decode('utf-8', 'replace').strip()))
+
+        listed = set(h.lower() for h in swuimage.SHA256_PATTERN.findall(description.decode('utf-8', 'replace')))
+        for name, offset, size in entries:
+            if name in (swuimage.SW_DESCRIPTION, swuimage.SW_DESCRIPTION_SIG):
+                continue
+            if swuimage.hash_entry(f, offset, size) not in listed:
+                raise VerifyError('{} is not in the signed sw-description'.format(name))
+
+
+def interface_address(name):
+    '''
+    Return the IPv4 address of a network interface.  Raises IOError if
+    it has none.
+    '''
+    import fcntl
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode('utf-8')))
+    finally:
+        sock.close()
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+class PeerCache(object):
+    '''
+    Serve verified artifacts in an artifactcache.ArtifactCache to other
+    gateways, and find artifacts on them.  Everything is bound to
+    address, the gateway's LAN address.  targets are the addresses
+    queries are sent to; by default the multicast group.
+    '''
+    def __init__(self, cache, public_key_file, address, http_port=PEER_HTTP_PORT,
+                 discovery_port=PEER_PORT, group=PEER_GROUP, targets=None):
+        if not address:
+            raise ValueError('The peer cache needs a LAN address to bind to')
+        self.cache = cache
+        self.public_key_file = public_key_file
+        self.address = address
+        self.http_address = (address, http_port)
+        # Multicast queries are sent to the group, not to the address
+        self.discovery_address = (group or address, discovery_port)
+        self.group = group
+        self.targets = targets if targets is not None else [(group, discovery_port)]
+        self.http_server = None
+        self.http_port = None
+        self.sock = None
+        self.stats = {'queries' : 0, 'hits' : 0, 'misses' : 0, 'answered' : 0,
+                      'served' : 0, 'bytes_served' : 0, 'bytes_from_peers' : 0,
+                      'verified' : 0, 'verify_failures' : 0}
+
+    def start(self):
+        self.start_http()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.discovery_address)
+        if self.group:
+            mreq = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(self.address))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+        self.sock = sock
+        t = threading.Thread(target=self.answer)
+        t.daemon = True
+        t.start()
+        syslog('Peer cache serving on {}:{}'.format(self.address, self.http_port))
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def discovery_port(self):
+        return self.sock.getsockname()[1]
+
+    def servable(self, key):
+        '''
+        Return the state of an artifact that may be served, or None
+        '''
+        if not KEY_PATTERN.match(key):
+            return None
+        state = self.cache.load(key)
+        # Only artifacts found by their digest, which peers check
+        if state is None or not state.get('complete') or not state.get('verified') or \
+                (state.get('sha256') or '').lower() != key:
+            return None
+        return state
+
+    def verify(self, key):
+        '''
+        Verify the signature of a complete artifact before it is used or
+        served.  Returns True if it passed.
+        '''
+        state = self.cache.load(key)
+        if state is None or not state.get('complete'):
+            return False
+        try:
+            verify_swu(self.cache.data_path(key), self.public_key_file)
+        except (VerifyError, IOError, OSError) as e:
+            syslog('Peer cache: {} failed verification: {}'.format(state.get('url'), e))
+            self.stats['verify_failures'] += 1
+            return False
+        state['verified'] = True
+        self.cache.save(state)
+        self.stats['verified'] += 1
+        return True
+
+    def find(self, key, timeout=PEER_QUERY_TIMEOUT):
+        '''
+        Ask the other gateways for an artifact.  Returns the URL to
+        download it from on the first to answer, or None.
+        '''
+        nonce = hashlib.sha256(os.urandom(16)).hexdigest()[:16]
+        query = json.dumps({'type' : 'query', 'key' : key, 'id' : nonce}).encode('utf-8')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.address))
+            sock.bind((self.address, 0))
+            self.stats['queries'] += 1
+            for target in self.targets:
+                try:
+                    sock.sendto(query, target)
+                except socket.error as e:
+                    syslog('Peer cache: query to {} failed: {}'.format(target, e))
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, addr = sock.recvfrom(MAX_MESSAGE)
+                except socket.timeout:
+                    break
+                try:
+                    reply = json.loads(data.decode('utf-8'))
+                    if reply.get('type') == 'have' and reply.get('id') == nonce and \
+                            reply.get('key') == key:
+                        self.stats['hits'] += 1
+                        # The address the answer came from, not one it claims
+                        return 'http://{}:{}{}{}'.format(addr[0], int(reply['port']), PEER_PATH, key)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    pass
+        finally:
+            sock.close()
+        self.stats['misses'] += 1
+        return None
+
+    def answer(self):
+        '''
+        Answer queries for artifacts this gateway can serve
+        '''
+        sock = self.sock
+        while True:
+            try:
+                data, addr = sock.recvfrom(MAX_MESSAGE)
+            except (socket.error, AttributeError):
+                return
+            try:
+                query = json.loads(data.decode('utf-8'))
+                if query.get('type') != 'query':
+                    continue
+                key = str(query['key'])
+                if self.servable(key) is None:
+                    continue
+                reply = {'type' : 'have', 'key' : key, 'id' : query.get('id'),
+                         'port' : self.http_port}
+                sock.sendto(json.dumps(reply).encode('utf-8'), addr)
+                self.stats['answered'] += 1
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            except socket.error as e:
+                syslog('Peer cache: reply to {} failed: {}'.format(addr, e))
+
+    def start_http(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        peers = self
+
+        class ArtifactHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                key = self.path[len(PEER_PATH):] if self.path.startswith(PEER_PATH) else ''
+                state = peers.servable(key)
+                if state is None:
+                    self.send_error(404)
+                    return
+                path = peers.cache.data_path(key)
+                try:
+                    f = open(path, 'rb')
+                except (IOError, OSError):
+                    self.send_error(404)
+                    return
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    start = 0
+                    m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                    if m:
+                        start = int(m.group(1))
+                        if start >= size:
+                            self.send_response(416)
+                            self.send_header('Content-Range', 'bytes */{}'.format(size))
+                            self.end_headers()
+                            return
+                        self.send_response(206)
+                        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+                    else:
+                        self.send_response(200)
+                    self.send_header('Content-Length', str(size - start))
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.end_headers()
+                    f.seek(start)
+                    peers.stats['served'] += 1
+                    try:
+                        for data in iter(lambda: f.read(PEER_READ_SIZE), b''):
+                            self.wfile.write(data)
+                            peers.stats['bytes_served'] += len(data)
+                    except socket.error as e:
+                        if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                            raise
+
+        class ArtifactServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.http_server = ArtifactServer(self.http_address, ArtifactHandler)
+        self.http_port = self.http_server.server_address[1]
+        t = threading.Thread(target=self.http_server.serve_forever)
+        t.daemon = True
+        t.start()
@@ -0,0 +1,139 @@
+#
+# procrun.py - Run helper commands with timeouts and bounded output
+#
+import os
+import time
+import errno
+import selectors
+import subprocess
+import collections
+from syslog import syslog
+
+# Output beyond this many bytes per stream is discarded
+PROC_OUTPUT_LIMIT = 64 * 1024
+PROC_READ_SIZE = 4096
+
+ProcResult = collections.namedtuple('ProcResult',
+    ['returncode', 'stdout', 'stderr', 'duration', 'truncated', 'timed_out'])
+
+# Timing statistics per command name
+stats = {}
+
+
+def record(cmd, result):
+    name = os.path.basename(cmd[0])
+    s = stats.setdefault(name, {'calls' : 0, 'failures' : 0, 'timeouts' : 0,
+                                'total_duration' : 0.0, 'max_duration' : 0.0})
+    s['calls'] += 1
+    if result.returncode != 0:
+        s['failures'] += 1
+    if result.timed_out:
+        s['timeouts'] += 1
+    s['total_duration'] += result.duration
+    s['max_duration'] = max(s['max_duration'], result.duration)
+
+
+def get_stats():
+    return dict((name, dict(s)) for name, s in stats.items())
+
+
+def open_pidfd(pid):
+    '''
+    Return a pidfd for the process where the kernel supports it, so its
+    exit can be waited for alongside its output.
+    '''
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def run(cmd, timeout=5, output_limit=PROC_OUTPUT_LIMIT, line_callback=None):
+    '''
+    Run cmd and collect its output without helper threads.  The process
+    is killed once timeout seconds have passed.  Each output stream is
+    capped at output_limit bytes; if line_callback is given it is called
+    with every line of stdout as it arrives.  Returns a ProcResult; the
+    returncode is None if the command could not be run.
+    '''
+    start = time.time()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    except OSError as e:
+        syslog("Failed to run proc {}: '{}'".format(cmd[0], e))
+        result = ProcResult(None, b'', str(e).encode('utf-8'), time.time() - start, False, False)
+        record(cmd, result)
+        return result
+
+    output = {proc.stdout : bytearray(), proc.stderr : bytearray()}
+    truncated = False
+    timed_out = False
+    partial = b''
+    pidfd = open_pidfd(proc.pid)
+    exited = False
+    sel = selectors.DefaultSelector()
+    for pipe in output:
+        sel.register(pipe, selectors.EVENT_READ)
+    if pidfd is not None:
+        sel.register(pidfd, selectors.EVENT_READ)
+    deadline = start + timeout
+    try:
+        while len(sel.get_map()) > (0 if pidfd is None or exited else 1):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                timed_out = True
+                break
+            # Once the process has exited only drain what is already
+            # buffered, in case a child of it still holds the pipes open.
+            events = sel.select(0 if exited else remaining)
+            if not events:
+                if exited:
+                    break
+                continue
+            for key, mask in events:
+                if key.fileobj == pidfd:
+                    sel.unregister(pidfd)
+                    exited = True
+                    continue
+                try:
+                    data = os.read(key.fd, PROC_READ_SIZE)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    data = b''
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                buf = output[key.fileobj]
+                room = output_limit - len(buf)
+                if len(data) > room:
+                    truncated = True
+                buf.extend(data[:max(room, 0)])
+                if line_callback and key.fileobj is proc.stdout:
+                    lines = (partial + data).split(b'\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        line_callback(line.decode('utf-8', 'replace'))
+        if partial and line_callback:
+            line_callback(partial.decode('utf-8', 'replace'))
+        try:
+            proc.wait(max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        if timed_out and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    finally:
+        sel.close()
+        if pidfd is not None:
+            os.close(pidfd)
+        proc.stdout.close()
+        proc.stderr.close()
+
+    result = ProcResult(proc.returncode, bytes(output[proc.stdout]), bytes(output[proc.stderr]),
+        time.time() - start, truncated, timed_out)
+    record(cmd, result)
+    if result.returncode != 0:
+        syslog("{} exited with {} after {:.3f}s{}".format(cmd[0], result.returncode,
+            result.duration, ' (timed out)' if timed_out else ''))
+    return result
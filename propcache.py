@@ -0,0 +1,59 @@
+#
+# propcache.py - Cached D-Bus properties with coalesced change signals
+#
+# Clients read the properties with Get/GetAll, which only looks up the
+# cache, and follow them with org.freedesktop.DBus.Properties
+# .PropertiesChanged rather than polling.  All the changes made while
+# handling one event go out in one signal.
+#
+
+# Delay before changes are signalled; 0 is the next main loop iteration
+PROPERTIES_CHANGED_DELAY = 0
+
+
+class PropertyCache(object):
+    '''
+    Hold the current value of each property.  Values that change are
+    passed to handler(changed) as one dict, from a main loop timer, so
+    however many changes are made before it runs they are delivered
+    together.
+    '''
+    def __init__(self, loop, handler, delay=PROPERTIES_CHANGED_DELAY):
+        self.loop = loop
+        self.handler = handler
+        self.delay = delay
+        self.values = {}
+        self.changed = {}
+        self.timer_id = None
+        self.updates = 0
+        self.emitted = 0
+
+    def update(self, values):
+        '''
+        Set properties from a dict.  Unchanged values are not signalled.
+        '''
+        for name, value in values.items():
+            self.updates += 1
+            if name in self.values and self.values[name] == value:
+                continue
+            self.values[name] = value
+            self.changed[name] = value
+        if self.changed and self.timer_id is None:
+            self.timer_id = self.loop.call_later(self.delay, self.flush)
+
+    def set(self, name, value):
+        self.update({name : value})
+
+    def get_all(self):
+        return dict(self.values)
+
+    def flush(self):
+        self.timer_id = None
+        changed = self.changed
+        self.changed = {}
+        if changed:
+            self.emitted += 1
+            self.handler(changed)
+
+    def stats(self):
+        return {'updates' : self.updates, 'emitted' : self.emitted, 'pending' : len(self.changed)}
@@ -2,42 +2,318 @@
 # schedule.py - Functions to handle scheduling of downloads and reboots
 #
 import time
-import threading
 import json
+import bisect
+import struct
+import hashlib
+import calendar
 import datetime
 import os
 from syslog import syslog
+try:
+    import zoneinfo
+except ImportError:
+    # Named time zones need Python 3.9; schedules then use local time only
+    zoneinfo = None
 
 HOURS_PER_DAY = 24
 DAYS_PER_WEEK = 7
+HOURS_PER_WEEK = HOURS_PER_DAY * DAYS_PER_WEEK
+MINUTES_PER_HOUR = 60
+MINUTES_PER_DAY = HOURS_PER_DAY * MINUTES_PER_HOUR
+SECONDS_PER_MINUTE = 60
+SECONDS_PER_HOUR = 3600
+SECONDS_PER_DAY = 86400
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The end of the next window is always less than this far ahead
+SCHEDULE_LOOKAHEAD = 15 * SECONDS_PER_DAY
+# How long a table of compiled windows is used before it is rebuilt
+SCHEDULE_REFRESH = 7 * SECONDS_PER_DAY
+
+# A spread start is never delayed by more than this part of the window
+SPREAD_WINDOW_FRACTION = 0.5
+
+# Maximum number of compiled schedules kept
+SCHEDULE_CACHE_SIZE = 16
+
+#
+# parse_time_of_day() - Parse 'HH:MM' into minutes after midnight
+#
+def parse_time_of_day(s):
+    hour, minute = s.strip().split(':')
+    hour = int(hour)
+    minute = int(minute)
+    if hour not in range(0, HOURS_PER_DAY + 1) or minute not in range(0, MINUTES_PER_HOUR) or \
+            (hour == HOURS_PER_DAY and minute > 0):
+        raise ValueError('Invalid time {}'.format(s))
+    return hour * MINUTES_PER_HOUR + minute
+
+#
+# parse_time_range() - Parse the hours of a schedule entry into the
+#     start and end minute of the window.  'H' and 'H-H' are whole
+#     hours, inclusive of the last; 'HH:MM-HH:MM' has minute resolution
+#     and excludes the end, which may be '24:00' or earlier than the
+#     start for a window spanning midnight.
+#
+def parse_time_range(hours):
+    parts = hours.split('-')
+    if len(parts) > 2:
+        raise ValueError('Invalid hours {}'.format(hours))
+    if ':' in hours:
+        if len(parts) != 2:
+            raise ValueError('Invalid hours {}'.format(hours))
+        start = parse_time_of_day(parts[0])
+        end = parse_time_of_day(parts[1])
+        if start >= MINUTES_PER_DAY or start == end:
+            raise ValueError('Invalid hours {}'.format(hours))
+        if end < start:
+            end += MINUTES_PER_DAY
+        return start, end
+    hour_low = int(parts[0])
+    hour_high = int(parts[1]) if len(parts) > 1 else hour_low
+    if hour_low not in range(0, HOURS_PER_DAY) or hour_high not in range(0, HOURS_PER_DAY):
+        raise ValueError('Invalid hours {}'.format(hours))
+    if hour_low > hour_high:
+        raise ValueError('Invalid hours {}'.format(hours))
+    return hour_low * MINUTES_PER_HOUR, (hour_high + 1) * MINUTES_PER_HOUR
+
+#
+# parse_days() - Parse '*', a day number (0 is Monday) or a list of
+#     day numbers
+#
+def parse_days(day):
+    if day == '*':
+        return list(range(0, DAYS_PER_WEEK))
+    days = [int(d) for d in day] if isinstance(day, list) else [int(day)]
+    for d in days:
+        if d not in range(0, DAYS_PER_WEEK):
+            raise ValueError('Invalid day {}'.format(day))
+    if not days:
+        raise ValueError('No days given')
+    return days
+
+#
+# parse_schedule_entry() - Parse one schedule entry into a list of
+#     days, the start and end minute of the window and the time zone
+#     name (None for local time).  An entry is either { day : hours }
+#     or { 'days' : day, 'hours' : hours, 'tz' : name }, where 'tz' is
+#     optional.  Raises ValueError if the entry is invalid.
+#
+def parse_schedule_entry(entry):
+    try:
+        if 'hours' in entry:
+            day = entry.get('days', '*')
+            hours = entry['hours']
+            tz = entry.get('tz')
+        else:
+            day = list(entry.keys())[0]
+            hours = list(entry.values())[0]
+            tz = None
+        days = parse_days(day)
+        start, end = parse_time_range(hours)
+    except (AttributeError, IndexError, TypeError) as e:
+        raise ValueError(str(e))
+    if tz is not None:
+        get_zone(tz)
+    return days, start, end, tz
+
+class LocalZone(object):
+    '''
+    The system time zone, as used by the C library
+    '''
+    name = None
+
+    def utcoffset(self, ts):
+        return time.localtime(ts).tm_gmtoff
+
+class NamedZone(object):
+    '''
+    A time zone from the tz database
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.tz = zoneinfo.ZoneInfo(name)
+
+    def utcoffset(self, ts):
+        offset = datetime.datetime.fromtimestamp(ts, self.tz).utcoffset()
+        return int(offset.total_seconds())
+
+LOCAL_ZONE = LocalZone()
+_zones = {}
+
+#
+# get_zone() - Return the zone for a time zone name, or local time for
+#     None.  Raises ValueError for an unknown zone.
+#
+def get_zone(name):
+    if name is None:
+        return LOCAL_ZONE
+    zone = _zones.get(name)
+    if zone is None:
+        if zoneinfo is None:
+            raise ValueError('Time zone {} not supported'.format(name))
+        try:
+            zone = NamedZone(name)
+        except (KeyError, ValueError, TypeError, OSError):
+            raise ValueError('Unknown time zone {}'.format(name))
+        _zones[name] = zone
+    return zone
+
+#
+# wall_to_timestamp() - Convert a naive wall clock time in a zone to a
+#     timestamp.  A time that occurs twice when the clocks go back is
+#     the first occurrence; a time skipped when the clocks go forward
+#     is the moment of the change.
+#
+def wall_to_timestamp(zone, wall):
+    guess = calendar.timegm(wall.timetuple())
+    offsets = sorted(set(zone.utcoffset(guess + d) for d in (-SECONDS_PER_DAY, SECONDS_PER_DAY)))
+    valid = [guess - o for o in offsets if zone.utcoffset(guess - o) == o]
+    if valid:
+        return min(valid)
+    if len(offsets) == 1:
+        return guess - offsets[0]
+    # In the gap; find the change between the two readings of wall
+    low, high = guess - offsets[-1], guess - offsets[0]
+    while high - low > 1:
+        middle = (low + high) // 2
+        if zone.utcoffset(middle) == offsets[0]:
+            low = middle
+        else:
+            high = middle
+    return high
+
+#
+# timestamp_of() - Return the timestamp of a datetime; naive datetimes
+#     are local time
+#
+def timestamp_of(date):
+    if date.tzinfo is not None:
+        return date.timestamp()
+    return wall_to_timestamp(LOCAL_ZONE, date) + date.microsecond / 1000000.0
+
+class Schedule(object):
+    '''
+    A weekly schedule, compiled into sorted lists of the start and end
+    timestamps of the windows from now until a couple of weeks ahead,
+    so that lookups are a binary search.  Windows are laid out on the
+    wall clock of their time zone, so they follow daylight saving
+    changes.  No entries means no windows are defined (always on).
+    '''
+    def __init__(self, schedule_list=None):
+        self.rules = []
+        for d in schedule_list or []:
+            days, start, end, tz = parse_schedule_entry(d)
+            self.rules.append((get_zone(tz), set(days), start, end))
+        self.table = (0, 0, [], [])
+
+    def windows(self, low, high):
+        '''
+        Return the merged (start, end) timestamps of all windows from
+        the local day before low to the day after high
+        '''
+        windows = []
+        for zone, days, start, end in self.rules:
+            first = (EPOCH + datetime.timedelta(seconds=low + zone.utcoffset(low))).date()
+            last = (EPOCH + datetime.timedelta(seconds=high + zone.utcoffset(high))).date()
+            day = first - datetime.timedelta(days=1)
+            while day <= last + datetime.timedelta(days=1):
+                if day.weekday() in days:
+                    midnight = datetime.datetime.combine(day, datetime.time())
+                    ts_start = wall_to_timestamp(zone, midnight + datetime.timedelta(minutes=start))
+                    ts_end = wall_to_timestamp(zone, midnight + datetime.timedelta(minutes=end))
+                    if ts_end <= ts_start:
+                        # The whole window was skipped by the clocks going
+                        # forward; keep it at the change for its length
+                        ts_end = ts_start + (end - start) * SECONDS_PER_MINUTE
+                    windows.append((ts_start, ts_end))
+                day += datetime.timedelta(days=1)
+        merged = []
+        for ts_start, ts_end in sorted(windows):
+            if merged and ts_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], ts_end))
+            else:
+                merged.append((ts_start, ts_end))
+        return merged
+
+    def lookup_table(self, ts):
+        table = self.table
+        if not table[0] <= ts <= table[1] - SCHEDULE_LOOKAHEAD:
+            high = ts + SCHEDULE_LOOKAHEAD + SCHEDULE_REFRESH
+            windows = self.windows(ts, high)
+            table = (ts, high, [w[0] for w in windows], [w[1] for w in windows])
+            self.table = table
+        return table
+
+    def window_bounds(self, ts):
+        '''
+        Return the start and end timestamps of the window containing ts,
+        or of the next window, or None if there are no windows (always
+        on)
+        '''
+        if not self.rules:
+            return None
+        low, high, starts, ends = self.lookup_table(ts)
+        i = bisect.bisect_right(starts, ts) - 1
+        if i < 0 or ts >= ends[i]:
+            i += 1
+        if i >= len(starts) or ends[i] >= high:
+            # No windows, or no gap in the windows at all
+            return None
+        return starts[i], ends[i]
+
+    def window_at(self, ts):
+        '''
+        Return a tuple of the time delta from timestamp ts (seconds) to
+        the start and end of the next window.  A start delta of 0 means
+        ts is in a window; an end delta of 0 (along with start of 0)
+        means no window exists (always on).
+        '''
+        bounds = self.window_bounds(ts)
+        if bounds is None:
+            return (0, 0)
+        return (max(bounds[0] - ts, 0), bounds[1] - ts)
+
+    def spread_window_at(self, ts, fraction, max_spread):
+        '''
+        As window_at, with the start of the window delayed by fraction
+        (0 to 1) of max_spread seconds, so that devices sharing a
+        schedule do not all start at once.  The delay is limited to
+        part of the window, and a device already past its start time
+        in a window starts straight away.
+        '''
+        bounds = self.window_bounds(ts)
+        if bounds is None:
+            return (0, 0)
+        start, end = bounds
+        spread = min(max_spread, (end - start) * SPREAD_WINDOW_FRACTION)
+        if spread > 0:
+            start += fraction * spread
+        return (max(start - ts, 0), end - ts)
+
+    def next_window(self, date_from):
+        '''
+        As window_at, from a datetime (local time if naive)
+        '''
+        return self.window_at(timestamp_of(date_from))
+
+    def in_window(self, date):
+        '''
+        Return True if the given time is within a window (or there are
+        no windows at all)
+        '''
+        return self.next_window(date)[0] == 0
 
 #
 # check_schedule() - Check that the given schedule is valid
 #
 def check_schedule(schedule_list):
-    day_count = 0
     try:
         for d in schedule_list:
-            day = list(d.keys())[0]
-            if day != '*':
-                if int(day) not in range(0, DAYS_PER_WEEK):
-                    return False
-            hours = list(d.values())[0]
-            hours_list = hours.split('-')
-            hour_low = int(hours_list[0])
-            if len(hours_list) > 1:
-                hour_high = int(hours_list[1])
-            else:
-                hour_high = hour_low
-            if hour_low not in range(0, HOURS_PER_DAY):
-                return False
-            if hour_high not in range(0, HOURS_PER_DAY):
-                return False
-            if hour_low > hour_high:
-                return False
-            day_count = day_count + 1
-        return day_count > 0
-    except Exception:
+            parse_schedule_entry(d)
+        return len(schedule_list) > 0
+    except (TypeError, ValueError):
         # Any failure to parse is an invalid configuration
         return False
 
@@ -67,6 +343,37 @@ def save_schedule(cfg_path, schedule_name, schedule_list):
     with open(filepath, 'w+') as f:
         json.dump(cfg, f, sort_keys=True, indent=2, separators=(',', ': '))
 
+_schedule_cache = {}
+
+#
+# compile_schedule() - Return the compiled Schedule for a schedule list,
+#     reusing a previously compiled one with the same content.  An
+#     invalid schedule compiles to 'always on'.
+#
+def compile_schedule(schedule_list):
+    try:
+        key = json.dumps(schedule_list, sort_keys=True)
+    except (TypeError, ValueError):
+        return Schedule()
+    schedule = _schedule_cache.get(key)
+    if schedule is None:
+        try:
+            schedule = Schedule(schedule_list)
+        except (TypeError, ValueError):
+            schedule = Schedule()
+        if len(_schedule_cache) >= SCHEDULE_CACHE_SIZE:
+            _schedule_cache.clear()
+        _schedule_cache[key] = schedule
+    return schedule
+
+#
+# spread_fraction() - Map a device identifier to a stable value in
+#     [0, 1), uniformly distributed across devices
+#
+def spread_fraction(device_id):
+    digest = hashlib.sha256(device_id.encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0] / float(1 << 64)
+
 #
 # next_schedule_window() - Find the start and end of the next
 #     available window from the given schedule.  Returns a tuple of the
@@ -76,56 +383,4 @@ def save_schedule(cfg_path, schedule_name, schedule_list):
 #     exists (always on).
 #
 def next_schedule_window(date_from, schedule_list):
-    try:
-        # Create a list of all available hours for the week
-        schedule_hours = [0 for i in range(0, HOURS_PER_DAY * DAYS_PER_WEEK)]
-        for d in schedule_list:
-            day = list(d.keys())[0]
-            hours = list(d.values())[0]
-            hours_list = hours.split('-')
-            hour_low = int(hours_list[0])
-            if len(hours_list) > 1:
-                hour_high = int(hours_list[1])
-            else:
-                hour_high = hour_low
-            if day == '*':
-                # Default hours for all days
-                for i in range(0, DAYS_PER_WEEK):
-                    day_offset = i * HOURS_PER_DAY
-                    schedule_hours[day_offset+hour_low:day_offset+hour_high+1] = [1] * (hour_high - hour_low + 1)
-            else:
-                day_offset = int(day) * HOURS_PER_DAY
-                schedule_hours[day_offset+hour_low:day_offset+hour_high+1] = [1] * (hour_high - hour_low + 1)
-
-        delta_start = None
-        delta_end = None
-        # Compute the starting point and check if it's in a window
-        start_hour = (date_from.weekday() * HOURS_PER_DAY) + date_from.hour
-        if schedule_hours[start_hour] > 0:
-            delta_start = 0
-
-        # Walk the hours starting from the 'from' hour
-        for w in range(0, HOURS_PER_DAY * DAYS_PER_WEEK):
-            is_window = schedule_hours[(w + start_hour) % (HOURS_PER_DAY * DAYS_PER_WEEK)] > 0
-            if delta_start is None:
-                # Look for start
-                if is_window:
-                    date_start = (date_from + datetime.timedelta(hours=w)).replace(minute=0)
-                    delta_start = (date_start - date_from).total_seconds()
-            elif delta_end is None:
-                # Look for end
-                if not is_window:
-                    date_end = (date_from + datetime.timedelta(hours=w)).replace(minute=0)
-                    delta_end = (date_end - date_from).total_seconds()
-        if delta_end is None:
-            if delta_start is None or delta_start == 0:
-                # No windows defined, or entire schedule is available
-                delta_start = 0
-                delta_end = 0
-            else:
-                # The window ends at the last interval
-                delta_end = (HOURS_PER_DAY * DAYS_PER_WEEK)
-        return (delta_start, delta_end)
-    except Exception:
-        # Invalid input config, return 'always on'
-        return (0, 0)
+    return compile_schedule(schedule_list).next_window(date_from)
@@ -4,5 +4,5 @@ from setuptools import setup
 
 setup(name='igupd',
       version='1.0',
-      py_modules=['__main__','swupd','upsvc','somutil', 'resumetimer', 'swuclient', 'usbupd', 'schedule']
+      py_modules=['__main__','swupd','upsvc','somutil', 'swuclient', 'usbupd', 'schedule', 'swuprogress', 'pathwait', 'supervisor', 'mainloop', 'swuctrl', 'multihash', 'procrun', 'migrate', 'timersched', 'journal', 'startup', 'delta', 'artifactcache', 'streaminstall', 'shaper', 'peercache', 'swuimage', 'metrics', 'propcache']
       )
@@ -0,0 +1,350 @@
+#
+# shaper.py - Bandwidth shaping for update downloads
+#
+# swupdate (and igupd's own downloads) are pointed at a relay proxy on
+# the loopback interface.  Data from the server passes through a token
+# bucket, so a download cannot take the whole of the gateway's cellular
+# link.  The rate can be changed while downloads are running, and can
+# differ between schedule windows.
+#
+import os
+import json
+import time
+import socket
+import threading
+from syslog import syslog
+
+from urllib.parse import urlsplit
+
+from schedule import compile_schedule, parse_schedule_entry
+
+RATE = 'rate'
+DOWNLOAD_RATE = 'download_rate'
+DOWNLOAD_RATES = 'download_rates'
+# Data allowed through at once, as a time at the configured rate
+BURST_SECONDS = 0.25
+MIN_BURST = 16 * 1024
+RELAY_READ_SIZE = 16 * 1024
+RELAY_CONNECT_TIMEOUT = 30
+RELAY_IDLE_TIMEOUT = 300
+MAX_HEADER_LINE = 8192
+# Hop-by-hop headers not passed on to the server
+HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authorization', 'te', 'upgrade')
+
+
+class TokenBucket(object):
+    '''
+    Limit data to rate bytes per second, with bursts of up to burst
+    bytes.  A rate of 0 is unlimited.  Safe to use from several threads.
+    '''
+    def __init__(self, rate=0, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.sleep = sleep
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.last = clock()
+        self.stats = {'bytes' : 0, 'delays' : 0, 'delay_seconds' : 0.0, 'max_delay' : 0.0}
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.burst = burst or max(int(rate * BURST_SECONDS), MIN_BURST)
+            self.tokens = min(self.tokens, self.burst) if self.rate else self.burst
+
+    def refill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+        self.last = now
+
+    def reserve(self, nbytes):
+        '''
+        Take nbytes from the bucket, going into debt if need be, and
+        return how long to wait before sending them
+        '''
+        with self.lock:
+            self.stats['bytes'] += nbytes
+            if not self.rate:
+                return 0.0
+            self.refill()
+            self.tokens -= nbytes
+            if self.tokens >= 0:
+                return 0.0
+            delay = -self.tokens / float(self.rate)
+            self.stats['delays'] += 1
+            self.stats['delay_seconds'] += delay
+            self.stats['max_delay'] = max(self.stats['max_delay'], delay)
+            return delay
+
+    def consume(self, nbytes):
+        '''
+        Wait until nbytes may be sent.  Returns the time waited.
+        '''
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+
+def scheduled_rate(rates, default, ts):
+    '''
+    Return the download rate at timestamp ts and the seconds until it
+    next changes (None if it never does).  rates is a list of schedule
+    entries in the extended form, each with a 'rate'; the first whose
+    window contains ts applies, otherwise default.
+    '''
+    rate = None
+    change = None
+    for entry in rates or []:
+        window = dict((k, v) for k, v in entry.items() if k != RATE)
+        bounds = compile_schedule([window]).window_bounds(ts)
+        if bounds is None:
+            # Always in the window
+            if rate is None:
+                rate = entry[RATE]
+            continue
+        start, end = bounds
+        if start <= ts < end:
+            if rate is None:
+                rate = entry[RATE]
+            edge = end
+        else:
+            edge = start
+        if change is None or edge - ts < change:
+            change = edge - ts
+    return (default if rate is None else rate), change
+
+
+def check_rates(rates):
+    '''
+    Check a list of rate schedule entries; raises ValueError if invalid
+    '''
+    if not isinstance(rates, list):
+        raise ValueError('download rates must be a list')
+    for entry in rates:
+        if not isinstance(entry, dict) or 'hours' not in entry:
+            raise ValueError('download rate entries need days and hours')
+        if int(entry.get(RATE, -1)) < 0:
+            raise ValueError('download rate entries need a rate of 0 or more')
+        parse_schedule_entry(entry)
+
+
+def load_rates(cfg_path):
+    '''
+    Return the default download rate and the rate schedule saved by
+    save_rates(), or None
+    '''
+    filepath = '{}/{}.conf'.format(cfg_path, DOWNLOAD_RATE)
+    try:
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as f:
+                cfg = json.load(f)
+            check_rates(cfg[DOWNLOAD_RATES])
+            if int(cfg[DOWNLOAD_RATE]) >= 0:
+                return int(cfg[DOWNLOAD_RATE]), cfg[DOWNLOAD_RATES]
+    except Exception as e:
+        syslog('Failed to load download rates from {}: {}'.format(filepath, e))
+    return None
+
+
+def save_rates(cfg_path, rate, rates):
+    if not os.path.exists(cfg_path):
+        os.makedirs(cfg_path)
+    filepath = '{}/{}.conf'.format(cfg_path, DOWNLOAD_RATE)
+    cfg = { DOWNLOAD_RATE : rate, DOWNLOAD_RATES : rates }
+    with open(filepath, 'w+') as f:
+        json.dump(cfg, f, sort_keys=True, indent=2, separators=(',', ': '))
+
+
+def open_url(request, timeout, proxy=None):
+    '''
+    urlopen(), through the relay proxy if one is given
+    '''
+    from urllib.request import ProxyHandler, build_opener, urlopen
+    if proxy is None:
+        return urlopen(request, timeout=timeout)
+    opener = build_opener(ProxyHandler({'http' : proxy, 'https' : proxy}))
+    return opener.open(request, timeout=timeout)
+
+
+def split_host(hostport, default_port):
+    host, sep, port = hostport.rpartition(':')
+    if not sep or ']' in port:
+        return hostport.strip('[]'), default_port
+    return host.strip('[]'), int(port)
+
+
+class RelayProxy(object):
+    '''
+    An HTTP proxy on the loopback interface that shapes data from the
+    server with a token bucket.  HTTPS is tunnelled with CONNECT, so the
+    end to end TLS (and its certificate checks) are unchanged.
+    '''
+    def __init__(self, bucket, address=('127.0.0.1', 0),
+                 connect_timeout=RELAY_CONNECT_TIMEOUT, idle_timeout=RELAY_IDLE_TIMEOUT):
+        self.bucket = bucket
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.busy_since = None
+        self.stats = {'connections' : 0, 'failed' : 0, 'bytes_down' : 0, 'bytes_up' : 0,
+                      'busy_seconds' : 0.0}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(8)
+        self.thread = None
+
+    def url(self):
+        host, port = self.sock.getsockname()[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        syslog('Download relay listening on {}'.format(self.url()))
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            if self.busy_since is not None:
+                stats['busy_seconds'] += time.monotonic() - self.busy_since
+        stats['active'] = self.active
+        busy = stats['busy_seconds']
+        stats['throughput'] = stats['bytes_down'] / busy if busy > 0 else 0.0
+        for key, value in self.bucket.stats.items():
+            stats['bucket_' + key] = value
+        delays = self.bucket.stats['delays']
+        stats['mean_delay'] = self.bucket.stats['delay_seconds'] / delays if delays else 0.0
+        stats['rate'] = self.bucket.rate
+        return stats
+
+    def busy(self, start):
+        '''
+        Track the time any connection is open, for the throughput
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if start:
+                self.stats['connections'] += 1
+                self.active += 1
+                if self.active == 1:
+                    self.busy_since = now
+            else:
+                self.active -= 1
+                if self.active == 0:
+                    self.stats['busy_seconds'] += now - self.busy_since
+                    self.busy_since = None
+
+    def read_request(self, rfile):
+        line = rfile.readline(MAX_HEADER_LINE).decode('latin-1')
+        method, target, version = line.split()
+        headers = []
+        while True:
+            header = rfile.readline(MAX_HEADER_LINE).decode('latin-1')
+            if header in ('\r\n', '\n', ''):
+                break
+            headers.append(header.rstrip('\r\n'))
+        return method, target, version, headers
+
+    def open_upstream(self, conn, rfile):
+        '''
+        Read the client's request and connect to the server.  Returns the
+        server socket, with a plain HTTP request already passed on.
+        '''
+        method, target, version, headers = self.read_request(rfile)
+        if method == 'CONNECT':
+            host, port = split_host(target, 443)
+            upstream = socket.create_connection((host, port), self.connect_timeout)
+            conn.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            return upstream
+        url = urlsplit(target)
+        if url.scheme != 'http':
+            raise ValueError('Unsupported proxy request for {}'.format(target))
+        host, port = split_host(url.netloc, 80)
+        upstream = socket.create_connection((host, port), self.connect_timeout)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        request = ['{} {} {}'.format(method, path, version)]
+        request.extend(h for h in headers if h.split(':', 1)[0].strip().lower() not in HOP_HEADERS)
+        # One request per connection keeps requests to different servers apart
+        request.append('Connection: close')
+        upstream.sendall(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+        return upstream
+
+    def copy_up(self, rfile, upstream):
+        try:
+            while True:
+                data = rfile.read1(RELAY_READ_SIZE)
+                if not data:
+                    break
+                upstream.sendall(data)
+                self.stats['bytes_up'] += len(data)
+            upstream.shutdown(socket.SHUT_WR)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            rfile.close()
+
+    def handle(self, conn):
+        self.busy(True)
+        rfile = conn.makefile('rb')
+        upstream = None
+        try:
+            try:
+                upstream = self.open_upstream(conn, rfile)
+            except (socket.error, ValueError) as e:
+                self.stats['failed'] += 1
+                syslog('Download relay: {}'.format(e))
+                conn.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                rfile.close()
+                return
+            upstream.settimeout(self.idle_timeout)
+            # copy_up() owns rfile from here
+            t = threading.Thread(target=self.copy_up, args=(rfile, upstream))
+            t.daemon = True
+            t.start()
+            while True:
+                data = upstream.recv(RELAY_READ_SIZE)
+                if not data:
+                    break
+                self.bucket.consume(len(data))
+                conn.sendall(data)
+                self.stats['bytes_down'] += len(data)
+        except socket.error:
+            pass
+        finally:
+            if upstream is not None:
+                upstream.close()
+            try:
+                # Also wakes copy_up() if it is waiting for the client
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+            self.busy(False)
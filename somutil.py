@@ -1,10 +1,14 @@
 import os
 import sys
 import subprocess
-import hashlib
-import re
+import time
+import struct
+import zlib
+import tempfile
+import collections
 from syslog import syslog, openlog
-from threading import Timer
+import multihash
+import procrun
 
 CMD_FW_PRINTENV = "fw_printenv"
 CMD_FW_SETENV = "fw_setenv"
@@ -15,30 +19,18 @@ CMD_MIGRATE_DATA = "migrate_data.sh"
 CMD_STTY = 'stty'
 CMD_OPENSSL = 'openssl'
 SERIAL_DEVICE = '/dev/ttyS0'
+FW_ENV_CONFIG = '/etc/fw_env.config'
+
+ENV_CRC = struct.Struct('<I')
 
 def run_proc(cmd, timeout=5):
     '''
-    Run the given process or cmd.  Use a timer in case
-    the process does not return.  Kill after timeout.
+    Run the given process or cmd.  Kill after timeout.  Returns the
+    decoded stdout (or None) and stderr.
     '''
-    kill = lambda process: process.kill()
-    proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    my_timer = Timer(timeout, kill, [proc])
-    try:
-        my_timer.start()
-        stdout, stderr = proc.communicate()
-        if stdout:
-            decoded = stdout.decode('utf-8')
-            syslog(decoded)
-        else:
-            decoded = None
-    except Exception as e:
-        syslog("Failed to run proc: '%s'" % str(e))
-    finally:
-        my_timer.cancel()
-
-    return decoded, stderr
+    result = procrun.run(cmd, timeout)
+    decoded = result.stdout.decode('utf-8') if result.stdout else None
+    return decoded, result.stderr
 
 
 def run_proc_async(cmd):
@@ -52,25 +44,201 @@ def run_proc_async(cmd):
         proc.kill()
 
 
+def parse_env_text(text):
+    '''
+    Parse 'fw_printenv' output into a dict
+    '''
+    env = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition('=')
+        if sep:
+            env[name] = value
+    return env
+
+
+def parse_env_data(data):
+    '''
+    Parse the NUL separated variables of a raw environment into a dict
+    '''
+    env = {}
+    for entry in data.split(b'\x00\x00', 1)[0].split(b'\x00'):
+        name, sep, value = entry.partition(b'=')
+        if sep:
+            env[name.decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+    return env
+
+
+def read_fw_env_config(config=FW_ENV_CONFIG):
+    '''
+    Return a list of (device, offset, size) for each environment copy
+    listed in the fw_env.config file
+    '''
+    copies = []
+    with open(config, 'r') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) >= 3:
+                copies.append((fields[0], int(fields[1], 0), int(fields[2], 0)))
+    if not copies:
+        raise ValueError('No environment devices in {}'.format(config))
+    return copies
+
+
+def read_native_env(config=FW_ENV_CONFIG):
+    '''
+    Read the U-Boot environment directly from its partition(s) and
+    return it as a dict.  Each copy is validated with its CRC32; with a
+    redundant environment the valid copy with the newest flags wins.
+    '''
+    copies = read_fw_env_config(config)
+    redundant = len(copies) > 1
+    header = ENV_CRC.size + (1 if redundant else 0)
+    best = None
+    for device, offset, size in copies:
+        with open(device, 'rb') as f:
+            f.seek(offset)
+            raw = f.read(size)
+        if len(raw) != size:
+            continue
+        data = raw[header:]
+        if ENV_CRC.unpack_from(raw)[0] != zlib.crc32(data) & 0xffffffff:
+            syslog('somutil: bad environment CRC on {}'.format(device))
+            continue
+        flags = ord(raw[ENV_CRC.size:header]) if redundant else 0
+        # Flags are a wrapping counter (or 1/0 active/obsolete) for
+        # redundant copies; prefer the newer one.
+        if best is None or 0 < (flags - best[0]) % 256 < 128:
+            best = (flags, data)
+    if best is None:
+        raise ValueError('No valid environment copy')
+    return parse_env_data(best[1])
+
+
+class UBootEnv(object):
+    '''
+    In-process cache of the U-Boot environment.  The environment is
+    read once, directly from the env partition when possible and with
+    'fw_printenv' otherwise, and is kept up to date by set().
+    '''
+    def __init__(self, config=FW_ENV_CONFIG, native=True):
+        self.config = config
+        self.native = native
+        self.values = None
+        self.native_reads = 0
+        self.fork_reads = 0
+        self.writes = 0
+        self.saved_writes = 0
+        self.last_write_latency = 0.0
+
+    def load(self):
+        if self.native and os.path.exists(self.config):
+            try:
+                self.values = read_native_env(self.config)
+                self.native_reads += 1
+                return self.values
+            except (IOError, OSError, ValueError) as e:
+                syslog('somutil: native environment read failed: {}'.format(e))
+        result = procrun.run([CMD_FW_PRINTENV])
+        self.fork_reads += 1
+        if result.returncode == 0 and not result.truncated:
+            self.values = parse_env_text(result.stdout.decode('utf-8', 'replace'))
+        else:
+            self.values = None
+        return self.values
+
+    def get(self, var):
+        if self.values is None and self.load() is None:
+            return None
+        return self.values.get(var)
+
+    def set(self, var, value):
+        return self.set_many({var : value})
+
+    def set_many(self, changes):
+        '''
+        Apply all of the given variable changes with a single write of
+        the environment, using a 'fw_setenv -s' script for more than one.
+        '''
+        if not changes:
+            return True
+        changes = collections.OrderedDict(changes)
+        start = time.time()
+        if len(changes) == 1:
+            var, value = list(changes.items())[0]
+            result = procrun.run([CMD_FW_SETENV, var, value])
+        else:
+            with tempfile.NamedTemporaryFile('w', prefix='fw_setenv') as script:
+                for var, value in changes.items():
+                    script.write('{} {}\n'.format(var, value))
+                script.flush()
+                result = procrun.run([CMD_FW_SETENV, '-s', script.name])
+        self.last_write_latency = time.time() - start
+        self.writes += 1
+        self.saved_writes += len(changes) - 1
+        if result.returncode != 0:
+            # The state of the environment is unknown; reread on next use
+            self.invalidate()
+            return False
+        if self.values is not None:
+            self.values.update(changes)
+        return True
+
+    def transaction(self):
+        return EnvTransaction(self)
+
+    def invalidate(self):
+        self.values = None
+
+    def write_stats(self):
+        return {
+            'env_writes' : self.writes,
+            'env_saved_writes' : self.saved_writes,
+            'env_last_write_latency' : self.last_write_latency,
+        }
+
+
+class EnvTransaction(object):
+    '''
+    Collect environment changes and write them together on commit, or
+    on leaving a 'with' block without an exception.
+    '''
+    def __init__(self, env):
+        self.env = env
+        self.changes = collections.OrderedDict()
+        self.result = None
+
+    def set(self, var, value):
+        self.changes[var] = value
+
+    def commit(self):
+        self.result = self.env.set_many(self.changes)
+        self.changes.clear()
+        return self.result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        return False
+
+
+uboot_env = UBootEnv()
+
+
 def get_uboot_env_value(var):
     '''
-    Run the 'fw_printenv' command and return the value
-    of the given u-boot environment variable
+    Return the value of the given u-boot environment variable
     '''
-    cmd = [CMD_FW_PRINTENV]
-    out, err = run_proc(cmd)
-    if out:
-        m = re.search(var+'=([a-zA-Z0-9]*)\n', out)
-        if m:
-            return m.group(1)
-    return None
+    return uboot_env.get(var)
 
 
 def get_current_side():
     '''
     Return the current bootside
     '''
-    val = get_uboot_env_val(CMD_BOOTSIDE)
+    val = get_uboot_env_value(CMD_BOOTSIDE)
     return val
 
 
@@ -78,11 +246,14 @@ def set_env(var, value):
     '''
     Set a u-boot environment variable
     '''
-    out, err = run_proc([CMD_FW_SETENV, var, value])
-    if err == 0:
-        return True
-    else:
-        return False
+    return uboot_env.set(var, value)
+
+
+def set_env_batch(changes):
+    '''
+    Set several u-boot environment variables with a single write
+    '''
+    return uboot_env.set_many(changes)
 
 
 def data_migration():
@@ -90,12 +261,12 @@ def data_migration():
     Handler to migrate data between two sides
     '''
     syslog("igupd: data_migration: Starting")
-    out, err = run_proc([CMD_MIGRATE_DATA], timeout=40)
-    if err:
+    result = procrun.run([CMD_MIGRATE_DATA], timeout=40, line_callback=syslog)
+    if result.returncode != 0:
         syslog("igupd: data_migration: Data migration failed")
         return False
     else:
-        syslog("igupd: data_migration: Data migration Completed")
+        syslog("igupd: data_migration: Data migration Completed in {:.1f}s".format(result.duration))
         return True
 
 
@@ -103,18 +274,13 @@ def generate_md5sum(partition):
     '''
     Handler to generate md5sum for each components
     '''
-    hash_md5 = hashlib.md5()
-    with open(partition, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return multihash.file_digests(partition, ('md5',))['md5']
 
 
 def reboot():
     '''
     Call the 'reboot' command
     '''
-    cmd = [CMD_REBOOT]
-    out, err = run_proc([CMD_REBOOT],300)
+    result = procrun.run([CMD_REBOOT], 300)
 
-    return err
+    return result.returncode
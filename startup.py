@@ -0,0 +1,103 @@
+#
+# startup.py - Startup phase timing and the cached device ID
+#
+import os
+import time
+from syslog import syslog
+
+# Close to when the process started, as this is imported early
+PROCESS_START = time.monotonic()
+
+DEVICE_ID_NAME = 'device_id'
+
+
+class PhaseTimer(object):
+    '''
+    Record how long each startup phase takes, and the time from the
+    start of the process until the service is ready.  Phases may
+    overlap, e.g. an asynchronous D-Bus query running alongside others.
+    '''
+    def __init__(self, start=PROCESS_START, clock=time.monotonic):
+        self.start = start
+        self.clock = clock
+        self.phases = []
+        self.durations = {}
+        self.running = {}
+        self.ready_time = None
+
+    def begin(self, name):
+        if name not in self.running:
+            self.running[name] = self.clock()
+
+    def end(self, name):
+        started = self.running.pop(name, None)
+        if started is None:
+            return None
+        if name not in self.durations:
+            self.phases.append(name)
+        self.durations[name] = self.clock() - started
+        return self.durations[name]
+
+    def phase(self, name):
+        '''
+        Time a block of code: with timer.phase('config'): ...
+        '''
+        return TimedPhase(self, name)
+
+    def ready(self):
+        if self.ready_time is None:
+            self.ready_time = self.clock() - self.start
+            syslog('Startup ready in {:.3f}s ({})'.format(self.ready_time, self.summary()))
+
+    def summary(self):
+        return ', '.join('{} {:.3f}s'.format(name, self.durations[name]) for name in self.phases)
+
+    def stats(self):
+        stats = dict(('startup.' + name, self.durations[name]) for name in self.phases)
+        if self.ready_time is not None:
+            stats['startup.time_to_ready'] = self.ready_time
+        return stats
+
+
+class TimedPhase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.begin(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer.end(self.name)
+        return False
+
+
+def load_device_id(path, prefix):
+    '''
+    Return the device ID saved by a previous run, if it has the
+    configured prefix
+    '''
+    try:
+        with open(path, 'r') as f:
+            device_id = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if not device_id.startswith(prefix) or len(device_id) == len(prefix):
+        return None
+    return device_id
+
+
+def save_device_id(path, device_id):
+    try:
+        d = os.path.dirname(path)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(device_id + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        syslog('Failed to save device ID to {}: {}'.format(path, e))
@@ -0,0 +1,201 @@
+#
+# streaminstall.py - Stream an update image from a URL into swupdate
+#
+# Nothing is written to disk: the image is read from the server by one
+# thread and written to swupdate by another, through a bounded queue.
+# The queue lets network reads run ahead of swupdate; when swupdate
+# falls behind the queue fills, the reader stops reading and TCP flow
+# control slows the server down.
+#
+import time
+import queue
+import threading
+from syslog import syslog
+
+import shaper
+
+STREAM_READ_SIZE = 64 * 1024
+# Reads buffered between the network and swupdate
+STREAM_QUEUE_DEPTH = 16
+STREAM_TIMEOUT = 30
+# Dropped connections carried on with a range request
+STREAM_MAX_RESUMES = 5
+STREAM_RESUME_DELAY = 1
+QUEUE_POLL = 0.2
+
+
+class StreamError(Exception):
+    pass
+
+
+class StreamInstall(object):
+    '''
+    Copy an image from a URL to a writable stream, e.g. a
+    swuctrl.InstallStream.  run() blocks, so it is used off the main
+    loop; stop() ends it.
+    '''
+    def __init__(self, url, timeout=STREAM_TIMEOUT, read_size=STREAM_READ_SIZE,
+                 queue_depth=STREAM_QUEUE_DEPTH, max_resumes=STREAM_MAX_RESUMES,
+                 resume_delay=STREAM_RESUME_DELAY, proxy=None):
+        self.url = url
+        self.proxy = proxy
+        self.timeout = timeout
+        self.read_size = read_size
+        self.queue_depth = queue_depth
+        self.max_resumes = max_resumes
+        self.resume_delay = resume_delay
+        self.queue = queue.Queue(queue_depth)
+        self.stop_event = threading.Event()
+        self.size = None
+        self.stats = {'bytes' : 0, 'size' : 0, 'requests' : 0, 'resumes' : 0,
+                      'queue_depth' : queue_depth, 'queue_high_water' : 0,
+                      'backpressure_waits' : 0, 'backpressure_seconds' : 0.0,
+                      'starved_waits' : 0, 'starved_seconds' : 0.0,
+                      'duration' : 0.0, 'throughput' : 0.0}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def put(self, item):
+        '''
+        Queue an item for the writer, waiting while the queue is full.
+        Returns False if stopped.
+        '''
+        try:
+            self.queue.put(item, block=False)
+            return True
+        except queue.Full:
+            pass
+        # swupdate is behind
+        self.stats['backpressure_waits'] += 1
+        start = time.time()
+        try:
+            while not self.stopped():
+                try:
+                    self.queue.put(item, timeout=QUEUE_POLL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.stats['backpressure_seconds'] += time.time() - start
+
+    def get(self):
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            pass
+        # The network is behind
+        self.stats['starved_waits'] += 1
+        start = time.time()
+        try:
+            while not self.stopped():
+                try:
+                    return self.queue.get(timeout=QUEUE_POLL)
+                except queue.Empty:
+                    pass
+            raise StreamError('Stream install of {} stopped'.format(self.url))
+        finally:
+            self.stats['starved_seconds'] += time.time() - start
+
+    def open(self, offset, validator):
+        from urllib.request import Request
+        from urllib.error import HTTPError
+
+        request = Request(self.url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            if validator:
+                request.add_header('If-Range', validator)
+        self.stats['requests'] += 1
+        try:
+            response = shaper.open_url(request, self.timeout, self.proxy)
+        except HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise StreamError('HTTP error {} for {}'.format(e.code, self.url))
+            raise
+        if offset and (response.getcode() != 206 or not response.headers.get(
+                'Content-Range', '').startswith('bytes {}-'.format(offset))):
+            # What has been sent to swupdate cannot be taken back
+            response.close()
+            raise StreamError('{} cannot be resumed at {} bytes'.format(self.url, offset))
+        return response
+
+    def read_url(self):
+        '''
+        Read the image into the queue, carrying on after a dropped
+        connection with a range request.  Ends with None, or the error
+        that stopped it.
+        '''
+        from http.client import HTTPException
+
+        offset = 0
+        validator = None
+        resumes = 0
+        try:
+            while not self.stopped():
+                try:
+                    response = self.open(offset, validator)
+                    try:
+                        if not offset:
+                            length = response.headers.get('Content-Length')
+                            self.size = int(length) if length is not None else None
+                            self.stats['size'] = self.size or 0
+                            validator = response.headers.get('ETag') or \
+                                response.headers.get('Last-Modified')
+                        while not self.stopped():
+                            data = response.read(self.read_size)
+                            if not data:
+                                break
+                            offset += len(data)
+                            if not self.put(data):
+                                return
+                    finally:
+                        response.close()
+                    if self.size is None or offset >= self.size:
+                        break
+                    raise IOError('Connection closed after {} of {} bytes'.format(offset, self.size))
+                except (IOError, OSError, ValueError, HTTPException) as e:
+                    if self.size is None or resumes >= self.max_resumes:
+                        raise
+                    resumes += 1
+                    self.stats['resumes'] = resumes
+                    syslog('Stream install: {} interrupted at {} bytes, resuming: {}'.format(
+                        self.url, offset, e))
+                    self.stop_event.wait(self.resume_delay)
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def run(self, out):
+        '''
+        Stream the image to out.  Raises StreamError, or the error from
+        the network or out, if the image was not sent in full.  Returns
+        the statistics for the transfer.
+        '''
+        start = time.time()
+        reader = threading.Thread(target=self.read_url)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item = self.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.stats['queue_high_water'] = max(self.stats['queue_high_water'],
+                    self.queue.qsize() + 1)
+                out.write(item)
+                self.stats['bytes'] += len(item)
+        finally:
+            self.stop()
+            duration = time.time() - start
+            self.stats['duration'] = duration
+            self.stats['throughput'] = self.stats['bytes'] / duration if duration > 0 else 0.0
+        syslog('Stream install: {bytes} bytes in {duration:.1f}s ({throughput:.0f} B/s), '
+               '{backpressure_waits} waits on swupdate, {starved_waits} on the network'.format(**self.stats))
+        return self.stats
@@ -0,0 +1,154 @@
+#
+# supervisor.py - Restart policy for the swupdate child process
+#
+import time
+import random
+from syslog import syslog
+
+SIGNAL_KILL = -9
+SIGNAL_TERM = -15
+
+EXIT_SUCCESS = 'success'
+EXIT_TERMINATED = 'terminated'
+EXIT_FAILURE = 'failure'
+EXIT_BAD_CMD = 'bad_cmd'
+
+TERMINATED_RESTART_DELAY = 1
+RESTART_DELAY = 3
+MAX_RESTART_DELAY = 300
+RESTART_JITTER = 0.2
+RAPID_FAILURE_SECONDS = 30
+CIRCUIT_TRIP_FAILURES = 5
+CIRCUIT_RESET_DELAY = 600
+
+
+def classify_exit(returncode):
+    '''
+    Classify a swupdate exit code.  A returncode of None means the
+    process could not be spawned at all.
+    '''
+    if returncode == 0:
+        return EXIT_SUCCESS
+    if returncode == SIGNAL_TERM:
+        return EXIT_TERMINATED
+    if returncode is None or returncode > 0:
+        return EXIT_BAD_CMD
+    return EXIT_FAILURE
+
+
+class RestartSupervisor(object):
+    '''
+    Decide when swupdate is restarted after it exits.  Failures are
+    retried with exponential backoff and jitter; after a number of
+    consecutive rapid failures the circuit breaker opens and restarts
+    are held off for CIRCUIT_RESET_DELAY before trying again.
+    '''
+    def __init__(self, clock=time.time, rand=random.random,
+                 trip_failures=CIRCUIT_TRIP_FAILURES):
+        self.clock = clock
+        self.rand = rand
+        self.trip_failures = trip_failures
+        self.spawn_time = None
+        self.outage_start = None
+        self.is_healthy = False
+        self.consecutive_failures = 0
+        self.circuit_open = False
+        self.restarts = 0
+        self.failures = 0
+        self.bad_cmds = 0
+        self.circuit_trips = 0
+        self.last_exit_code = None
+        self.last_time_to_healthy = None
+
+    def started(self):
+        '''
+        Record that swupdate has been spawned
+        '''
+        self.spawn_time = self.clock()
+        self.is_healthy = False
+        if self.outage_start is None:
+            self.outage_start = self.spawn_time
+
+    def healthy(self):
+        '''
+        Record that swupdate is up and reporting progress.  Closes the
+        circuit breaker if it was open.  Returns True if this changed
+        the breaker state.  The failure count is kept: a swupdate that
+        connects and then exits at once is still crash looping.
+        '''
+        now = self.clock()
+        self.is_healthy = True
+        if self.outage_start is not None:
+            self.last_time_to_healthy = now - self.outage_start
+            self.outage_start = None
+        if self.circuit_open:
+            syslog('supervisor: swupdate healthy, closing circuit breaker')
+            self.circuit_open = False
+            return True
+        return False
+
+    def reset(self):
+        '''
+        Forget previous failures, e.g. after the command line changed.
+        Returns True if this closed the circuit breaker.
+        '''
+        self.consecutive_failures = 0
+        if self.circuit_open:
+            self.circuit_open = False
+            return True
+        return False
+
+    def exited(self, returncode):
+        '''
+        Record the exit of swupdate and return a tuple of the exit
+        classification and the delay in seconds before the next start.
+        '''
+        now = self.clock()
+        kind = classify_exit(returncode)
+        self.last_exit_code = returncode
+        self.restarts += 1
+        ran = now - self.spawn_time if self.spawn_time is not None else 0
+        if ran >= RAPID_FAILURE_SECONDS:
+            # Only a run of some length clears earlier failures
+            self.consecutive_failures = 0
+        if self.is_healthy:
+            # Time to healthy is measured from the first exit
+            self.outage_start = now
+        self.is_healthy = False
+
+        if kind == EXIT_TERMINATED:
+            return kind, TERMINATED_RESTART_DELAY
+        if kind == EXIT_SUCCESS:
+            return kind, RESTART_DELAY
+
+        self.failures += 1
+        if kind == EXIT_BAD_CMD:
+            self.bad_cmds += 1
+        self.consecutive_failures += 1
+
+        if self.consecutive_failures >= self.trip_failures:
+            if not self.circuit_open:
+                syslog('supervisor: {} rapid swupdate failures, opening circuit breaker'.format(
+                    self.consecutive_failures))
+                self.circuit_open = True
+                self.circuit_trips += 1
+            return kind, CIRCUIT_RESET_DELAY
+
+        delay = min(RESTART_DELAY * (2 ** (self.consecutive_failures - 1)), MAX_RESTART_DELAY)
+        delay = delay * (1 + RESTART_JITTER * (2 * self.rand() - 1))
+        return kind, delay
+
+    def stats(self):
+        '''
+        Return the restart counters as a dict
+        '''
+        return {
+            'restarts' : self.restarts,
+            'failures' : self.failures,
+            'bad_cmds' : self.bad_cmds,
+            'consecutive_failures' : self.consecutive_failures,
+            'circuit_open' : self.circuit_open,
+            'circuit_trips' : self.circuit_trips,
+            'last_exit_code' : self.last_exit_code if self.last_exit_code is not None else 0,
+            'last_time_to_healthy' : self.last_time_to_healthy if self.last_time_to_healthy is not None else -1.0,
+        }
@@ -1,91 +1,196 @@
 import socket
-import select
-import struct
-import json
-import threading
 import random
+import signal
 import subprocess
 import time
 import os
 from syslog import syslog, openlog
+import swuprogress
+import pathwait
+import supervisor
+import swuctrl
 
-import sys
-PYTHON3 = sys.version_info >= (3, 0)
-
-SWU_STATUS_IDLE=0
-SWU_STATUS_START=1
-SWU_STATUS_RUN=2
-SWU_STATUS_SUCCESS=3
-SWU_STATUS_FAILURE=4
-SWU_STATUS_DOWNLOAD=5
-SWU_STATUS_DONE=6
-SWU_STATUS_SUBPROCESS=7
-SWU_STATUS_BAD_CMD=8
+from swuprogress import SWU_STATUS_IDLE, SWU_STATUS_START, SWU_STATUS_RUN, \
+    SWU_STATUS_SUCCESS, SWU_STATUS_FAILURE, SWU_STATUS_DOWNLOAD, SWU_STATUS_DONE, \
+    SWU_STATUS_SUBPROCESS, SWU_STATUS_BAD_CMD
 
 SIGNAL_KILL = -9
 SIGNAL_TERM = -15
 
-SWUPDATE_MAGIC = 0x14052001
-SWUPDATE_MSG_SUBPROCESS = 5
-SWUPDATE_CMD_ENABLE = 2
-SWUPDATE_SRC_SURICATTA = 2
-SURICATTA_CONNECT_DELAY = 60
-SURICATTA_RESPONSE_TIMEOUT = 2
-
-SWUPDATE_MSG_STRUCT = 'IiiiiI2048s'
-
 SWU_PROG_ADDRESS = '/tmp/swupdateprog'
-SWU_CTRL_ADDRESS = '/tmp/sockinstctrl'
+SWU_PROG_CONNECT_TIMEOUT = 10
+SWU_PROG_DRAIN_TIMEOUT = 1
 
-class SWUpdateClient(threading.Thread):
-    def __init__(self,handler,cmd):
+class SWUpdateClient(object):
+    '''
+    Run swupdate as a child process and receive its progress messages.
+    All work is done from main loop callbacks, set up through loop (the
+    mainloop module): an IO watch on the progress socket, and a child
+    watch to restart swupdate when it exits.
+    Restarts are paced by a RestartSupervisor; circuit_handler is called
+    with the breaker state whenever it opens or closes.  If given,
+    telemetry_handler is called with every decoded Progress message.
+    '''
+    def __init__(self,loop,handler,cmd,circuit_handler=None,telemetry_handler=None,
+                 progress_layout=swuprogress.PROGRESS_LAYOUT_LEGACY, connected_handler=None,
+                 prog_address=SWU_PROG_ADDRESS):
+        self.loop = loop
+        self.prog_address = prog_address
         self.recv_handler = handler
+        self.connected_handler = connected_handler
+        self.circuit_handler = circuit_handler
+        self.telemetry_handler = telemetry_handler
+        self.progress_msg, self.progress_fields = swuprogress.PROGRESS_LAYOUTS[progress_layout]
+        self.supervisor = supervisor.RestartSupervisor()
+        self.restart_id = None
         self.proc = None
         self.cmd = cmd
-        self.suricatta_pending_enable = None
-        threading.Thread.__init__(self)
+        self.ctrl_channel = swuctrl.ControlChannel(loop)
+        self.spawn_time = None
+        self.connect_latency = None
+        self.sock = None
+        self.reader = None
+        self.watcher = None
+        self.watcher_id = None
+        self.sock_id = None
+        self.connect_retry_id = None
+        self.connect_timeout_id = None
+
+    def start(self):
+        self.start_swupdate()
 
     def connect_to_prog_sock(self):
-        timeout = time.time() + 10
-        while True:
+        # swupdate creates the progress socket some time after it is
+        # spawned; wait for it to appear rather than polling for it.
+        self.watcher = pathwait.PathWatcher(self.prog_address)
+        if self.watcher.fileno() is not None:
+            self.watcher_id = self.loop.watch_readable(self.watcher.fileno(),
+                self.prog_sock_created)
+        self.connect_timeout_id = self.loop.call_later(
+            SWU_PROG_CONNECT_TIMEOUT, self.connect_timeout)
+        self.try_connect()
+
+    def try_connect(self):
+        self.connect_retry_id = None
+        if self.watcher.exists():
             try:
-                if os.path.exists(SWU_PROG_ADDRESS):
-                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                    self.sock.connect(SWU_PROG_ADDRESS)
-                    syslog("Socket connection established")
-                    return True
-                if time.time() > timeout:
-                    return False
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.prog_address)
+                self.connect_latency = time.time() - self.spawn_time
+                syslog("Socket connection established after %.3f seconds" % self.connect_latency)
+                self.stop_connect()
+                if self.supervisor.healthy():
+                    self.notify_circuit()
+                self.reader = swuprogress.ProgressReader(self.sock, msg=self.progress_msg)
+                self.sock_id = self.loop.watch_readable(self.sock.fileno(),
+                    self.prog_sock_ready)
+                if self.connected_handler:
+                    self.connected_handler()
+                return False
             except socket.error as exc:
+                self.sock.close()
+                self.sock = None
                 syslog("Caught exception socket.error.. Retrying: %s" % exc)
-                time.sleep(2)
+        elif self.watcher.fileno() is not None:
+            # Wait for the inotify watch to report the socket
+            return False
+        self.connect_retry_id = self.loop.call_later(
+            self.watcher.next_backoff(), self.try_connect)
+        return False
+
+    def prog_sock_created(self, fd, condition):
+        if self.watcher.check_events() and self.connect_retry_id is None:
+            self.try_connect()
+        return self.watcher_id is not None
+
+    def connect_timeout(self):
+        syslog("Timed out waiting for the swupdate progress socket")
+        self.connect_timeout_id = None
+        self.stop_connect()
+        return False
+
+    def stop_connect(self):
+        for source_id in (self.watcher_id, self.connect_retry_id, self.connect_timeout_id):
+            if source_id is not None:
+                self.loop.cancel(source_id)
+        self.watcher_id = None
+        self.connect_retry_id = None
+        self.connect_timeout_id = None
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
 
     def receive_progress_updates(self):
-        while True:
+        '''
+        Dispatch all messages from a single read of the progress socket.
+        Returns False once the socket has been closed.
+        '''
+        try:
+            frames = self.reader.read_frames()
+        except socket.error as exc:
+            syslog("Caught exception socket.error: %s" % exc)
+            frames = None
+        if frames is None:
+            return False
+        for fields in frames:
             try:
-                data = self.sock.recv(2400)
-                if not data:
-                    break
-                fields = struct.unpack('=IiIIII256s64siI2048s', data)
-                if PYTHON3:
-                    self.progress_handler(fields[1], str(fields[6],"utf-8"), str(fields[10],"utf-8"))
-                else:
-                    self.progress_handler(fields[1], fields[6], fields[10])
-            except socket.error as exc:
-                syslog("Caught exception socket.error: %s" % exc)
+                progress = swuprogress.Progress.from_fields(fields, self.progress_fields)
+                self.progress_handler(progress.status, progress.cur_image, progress.info)
+                if self.telemetry_handler:
+                    self.telemetry_handler(progress)
             except Exception as e:
                 syslog("Failed to do progress updates: '%s'" % str(e))
+        return True
 
-        self.sock.close()
+    def prog_sock_ready(self, fd, condition):
+        if self.receive_progress_updates():
+            return True
+        self.sock_id = None
+        self.close_prog_sock()
+        return False
 
+    def close_prog_sock(self):
+        if self.sock_id is not None:
+            self.loop.cancel(self.sock_id)
+            self.sock_id = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            self.reader = None
 
     def start_swupdate(self):
-        self.proc = subprocess.Popen(self.cmd, shell=False)
+        self.restart_id = None
+        self.spawn_time = time.time()
+        self.connect_latency = None
+        self.supervisor.started()
+        self.ctrl_channel.reset()
+        try:
+            self.proc = subprocess.Popen(self.cmd, shell=False)
+        except OSError as e:
+            syslog("Failed to start swupdate: %s" % e)
+            self.proc = None
+            self.progress_handler(SWU_STATUS_BAD_CMD, None, e.errno)
+            self.schedule_restart(None)
+            return False
+        self.loop.watch_child(self.proc.pid, self.swupdate_exited)
+        self.connect_to_prog_sock()
+        return False
 
-        if self.connect_to_prog_sock():
-            self.receive_progress_updates()
+    def swupdate_exited(self, pid, status):
+        # The child watch has reaped the process, so record its exit
+        # code for Popen rather than letting it wait again.
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
 
-        (out, err) = self.proc.communicate()
+        # Deliver any progress messages still queued on the socket
+        self.stop_connect()
+        if self.sock:
+            self.sock.settimeout(SWU_PROG_DRAIN_TIMEOUT)
+            while self.receive_progress_updates():
+                pass
+            self.close_prog_sock()
 
         if self.proc.returncode != 0:
             if self.proc.returncode == SIGNAL_TERM:
@@ -96,17 +201,33 @@ class SWUpdateClient(threading.Thread):
                 syslog("command failed stopping, exit-code=%d" % (self.proc.returncode))
                 self.progress_handler(SWU_STATUS_BAD_CMD, None, self.proc.returncode)
 
-        if self.proc.poll() is None:
-            self.proc.kill()
+        self.schedule_restart(self.proc.returncode)
 
-    def restart_swupdate(self):
-        if self.proc.poll() is None:
-            self.proc.terminate()
+    def schedule_restart(self, returncode):
+        was_open = self.supervisor.circuit_open
+        kind, delay = self.supervisor.exited(returncode)
+        if self.supervisor.circuit_open != was_open:
+            self.notify_circuit()
+        syslog("Restarting swupdate in %.1f seconds (%s)" % (delay, kind))
+        self.restart_id = self.loop.call_later(delay, self.start_swupdate)
+
+    def notify_circuit(self):
+        if self.circuit_handler:
+            self.circuit_handler(self.supervisor.circuit_open)
 
-    def run(self):
-        while True:
+    def restart_swupdate(self):
+        # A new command gets a fresh start, even if the old one had
+        # tripped the circuit breaker.
+        if self.supervisor.reset():
+            self.notify_circuit()
+        # returncode is only set by the child watch; polling here
+        # would reap the process behind GLib's back.  Popen.terminate()
+        # polls first (Python 3.9+), so the signal is sent directly.
+        if self.proc is not None and self.proc.returncode is None:
+            os.kill(self.proc.pid, signal.SIGTERM)
+        elif self.restart_id is not None:
+            self.loop.cancel(self.restart_id)
             self.start_swupdate()
-            time.sleep(3)
 
     def progress_handler(self, status, curr_image, msg):
         self.state = status
@@ -119,50 +240,21 @@ class SWUpdateClient(threading.Thread):
     def get_state(self):
         return self.state
 
+    def get_connect_latency(self):
+        '''
+        Seconds from spawning swupdate to connecting to its progress
+        socket, or None if the last attempt did not connect
+        '''
+        return self.connect_latency
+
+    def get_supervisor_stats(self):
+        stats = self.supervisor.stats()
+        stats['connect_latency'] = self.connect_latency if self.connect_latency is not None else -1.0
+        stats.update(self.ctrl_channel.stats())
+        return stats
+
     def set_command(self,cmd):
         self.cmd = cmd
 
-    def send_suricatta_enable(self):
-        # Suricatta is not always started when swupdate begins;
-        # for example, if swupdate is attempting to report status
-        # to HawkBit after an update, it must establish the initial
-        # response before the suricatta socket is available to
-        # enable downloads.  There is no notification via the status
-        # socket (sigh), so we must continually attempt to connect
-        # until it responds.
-        json_msg = json.dumps({'enable' : self.suricatta_pending_enable})
-        msg = struct.pack(SWUPDATE_MSG_STRUCT,
-            SWUPDATE_MAGIC,
-            SWUPDATE_MSG_SUBPROCESS,
-            SWUPDATE_SRC_SURICATTA,
-            SWUPDATE_CMD_ENABLE,
-            0,
-            len(json_msg),
-            json_msg.encode('utf8'))
-        syslog('Attempting to send suricatta {}able message.'.format('en' if self.suricatta_pending_enable else 'dis'))
-        try:
-            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            s.connect(SWU_CTRL_ADDRESS)
-            s.send(msg)
-            rd, wr, ex = select.select([s], [], [], SURICATTA_RESPONSE_TIMEOUT)
-            if s in rd:
-                syslog('Suricatta {}able message successful.'.format('en' if self.suricatta_pending_enable else 'dis'))
-                self.suricatta_pending_enable = None
-                return
-            else:
-                syslog('Suricatta socket response timed out.')
-        except socket.error as e:
-            syslog('Suricatta socket error occurred: {}'.format(e))
-        finally:
-            s.close()
-        # Request to suricatta was not successful, try again later.
-        threading.Timer(SURICATTA_CONNECT_DELAY, self.send_suricatta_enable).start()
-
     def suricatta_enable(self, enable):
-        if self.suricatta_pending_enable is not None:
-            # There is already a pending value to send, just change it
-            self.suricatta_pending_enable = enable
-        else:
-            # Attempt to send enable message to suricatta socket
-            self.suricatta_pending_enable = enable
-            self.send_suricatta_enable()
+        self.ctrl_channel.set_enable(enable)
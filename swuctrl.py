@@ -0,0 +1,278 @@
+#
+# swuctrl.py - Client for the swupdate control (IPC) socket
+#
+import json
+import time
+import select
+import socket
+import struct
+from syslog import syslog
+
+SWUPDATE_MAGIC = 0x14052001
+SWUPDATE_MSG_REQ_INSTALL = 0
+SWUPDATE_MSG_ACK = 1
+SWUPDATE_MSG_NACK = 2
+SWUPDATE_MSG_SUBPROCESS = 5
+SWUPDATE_CMD_ENABLE = 2
+SWUPDATE_SRC_SURICATTA = 2
+SWUPDATE_SRC_LOCAL = 4
+
+# ipc_message: magic, type, then procmsg (source, cmd, timeout, len, buf)
+SWUPDATE_MSG = struct.Struct('IiiiiI2048s')
+SWUPDATE_MSG_HEADER = struct.Struct('Ii')
+
+SWU_CTRL_ADDRESS = '/tmp/sockinstctrl'
+
+SURICATTA_RESPONSE_TIMEOUT = 2
+SURICATTA_RETRY_MIN = 2
+SURICATTA_RETRY_MAX = 60
+
+# swupdate may still be starting when an install is streamed to it
+INSTALL_CONNECT_TIMEOUT = 30
+INSTALL_RESPONSE_TIMEOUT = 10
+
+
+def pack_suricatta_enable(enable):
+    '''
+    Build the subprocess message enabling or disabling suricatta
+    '''
+    json_msg = json.dumps({'enable' : enable})
+    return SWUPDATE_MSG.pack(SWUPDATE_MAGIC,
+        SWUPDATE_MSG_SUBPROCESS,
+        SWUPDATE_SRC_SURICATTA,
+        SWUPDATE_CMD_ENABLE,
+        0,
+        len(json_msg),
+        json_msg.encode('utf8'))
+
+
+def pack_install_request(source=SWUPDATE_SRC_LOCAL):
+    '''
+    Build the request to install an image sent on the same connection
+    '''
+    return SWUPDATE_MSG.pack(SWUPDATE_MAGIC, SWUPDATE_MSG_REQ_INSTALL,
+        source, 0, 0, 0, b'')
+
+
+def enable_str(enable):
+    return 'en' if enable else 'dis'
+
+
+class ControlChannel(object):
+    '''
+    Deliver the desired suricatta enable state to swupdate.
+
+    Requests are coalesced: only the latest desired state is kept, and
+    at most one request is outstanding on the single control connection.
+    The response is awaited with a main loop IO watch, and failures
+    are retried with exponential backoff from the main loop.
+
+    Suricatta is not always started when swupdate begins; for example,
+    if swupdate is attempting to report status to HawkBit after an
+    update, it must establish the initial response before the
+    suricatta socket is available to enable downloads.  There is no
+    notification via the status socket, so the request is retried
+    until it is acknowledged.
+    '''
+    def __init__(self, loop, address=SWU_CTRL_ADDRESS, clock=time.time):
+        self.loop = loop
+        self.address = address
+        self.clock = clock
+        self.sock = None
+        self.desired = None
+        self.acked = None
+        self.in_flight = None
+        self.watch_id = None
+        self.timeout_id = None
+        self.retry_id = None
+        self.retry_delay = SURICATTA_RETRY_MIN
+        self.enable_requested = None
+        self.enable_latency = None
+        self.attempts = 0
+        self.failures = 0
+        self.coalesced = 0
+
+    def set_enable(self, enable):
+        '''
+        Request that suricatta downloads are enabled or disabled
+        '''
+        if enable and self.desired is not True:
+            self.enable_requested = self.clock()
+            self.enable_latency = None
+        self.desired = enable
+        if self.in_flight is not None or self.retry_id is not None:
+            # The latest value is sent once the current attempt completes
+            self.coalesced += 1
+        elif self.desired == self.acked:
+            self.coalesced += 1
+        else:
+            self.send()
+
+    def reset(self):
+        '''
+        swupdate was restarted; its suricatta state is no longer known,
+        so resend the desired state.
+        '''
+        self.acked = None
+        self.finish_request()
+        self.close()
+        if self.retry_id is not None:
+            self.loop.cancel(self.retry_id)
+            self.retry_id = None
+        self.retry_delay = SURICATTA_RETRY_MIN
+        if self.desired is not None:
+            self.send()
+
+    def connected(self):
+        '''
+        Return True if the existing connection is still usable, discarding
+        any remainder of the previous response.
+        '''
+        if self.sock is None:
+            return False
+        try:
+            while True:
+                rd, wr, ex = select.select([self.sock], [], [], 0)
+                if not rd:
+                    return True
+                if not self.sock.recv(SWUPDATE_MSG.size):
+                    return False
+        except socket.error:
+            return False
+
+    def send(self):
+        self.retry_id = None
+        if self.desired is None or self.desired == self.acked:
+            return
+        self.in_flight = self.desired
+        self.attempts += 1
+        syslog('Attempting to send suricatta {}able message.'.format(enable_str(self.in_flight)))
+        try:
+            if not self.connected():
+                self.close()
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.address)
+            self.sock.sendall(pack_suricatta_enable(self.in_flight))
+        except socket.error as e:
+            syslog('Suricatta socket error occurred: {}'.format(e))
+            self.request_failed()
+            return
+        self.watch_id = self.loop.watch_readable(self.sock.fileno(), self.response_ready)
+        self.timeout_id = self.loop.call_later(SURICATTA_RESPONSE_TIMEOUT, self.response_timeout)
+
+    def response_ready(self, fd, condition):
+        self.watch_id = None
+        try:
+            data = self.sock.recv(SWUPDATE_MSG.size)
+        except socket.error as e:
+            syslog('Suricatta socket error occurred: {}'.format(e))
+            data = None
+        if data and len(data) >= SWUPDATE_MSG_HEADER.size and \
+                SWUPDATE_MSG_HEADER.unpack_from(data)[1] == SWUPDATE_MSG_NACK:
+            syslog('Suricatta {}able message rejected.'.format(enable_str(self.in_flight)))
+            data = None
+        if data:
+            self.request_succeeded()
+        else:
+            self.request_failed()
+        return False
+
+    def response_timeout(self):
+        self.timeout_id = None
+        syslog('Suricatta socket response timed out.')
+        self.request_failed()
+
+    def request_succeeded(self):
+        syslog('Suricatta {}able message successful.'.format(enable_str(self.in_flight)))
+        self.acked = self.in_flight
+        if self.acked and self.enable_requested is not None:
+            self.enable_latency = self.clock() - self.enable_requested
+            self.enable_requested = None
+            syslog('Suricatta downloads enabled {:.1f} seconds after request.'.format(self.enable_latency))
+        self.finish_request()
+        self.retry_delay = SURICATTA_RETRY_MIN
+        # Send any state requested while this one was in flight
+        self.send()
+
+    def request_failed(self):
+        self.failures += 1
+        self.finish_request()
+        self.close()
+        # Request to suricatta was not successful, try again later.
+        self.retry_id = self.loop.call_later(self.retry_delay, self.send)
+        self.retry_delay = min(self.retry_delay * 2, SURICATTA_RETRY_MAX)
+
+    def finish_request(self):
+        self.in_flight = None
+        if self.watch_id is not None:
+            self.loop.cancel(self.watch_id)
+            self.watch_id = None
+        if self.timeout_id is not None:
+            self.loop.cancel(self.timeout_id)
+            self.timeout_id = None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def stats(self):
+        return {
+            'suricatta_attempts' : self.attempts,
+            'suricatta_failures' : self.failures,
+            'suricatta_coalesced' : self.coalesced,
+            'suricatta_enable_latency' : self.enable_latency if self.enable_latency is not None else -1.0,
+        }
+
+
+class InstallStream(object):
+    '''
+    Stream an image to swupdate over the control socket, as
+    swupdate-client does: an install request, which swupdate must
+    acknowledge, followed by the image data.  Closing the stream ends
+    the image.  This blocks, so it is used off the main loop.
+    '''
+    def __init__(self, address=SWU_CTRL_ADDRESS, source=SWUPDATE_SRC_LOCAL,
+                 connect_timeout=INSTALL_CONNECT_TIMEOUT):
+        self.address = address
+        self.source = source
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.bytes_written = 0
+
+    def open(self):
+        deadline = time.time() + self.connect_timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(self.address)
+                break
+            except socket.error as e:
+                self.sock.close()
+                self.sock = None
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.5)
+        self.sock.settimeout(INSTALL_RESPONSE_TIMEOUT)
+        self.sock.sendall(pack_install_request(self.source))
+        reply = b''
+        while len(reply) < SWUPDATE_MSG_HEADER.size:
+            data = self.sock.recv(SWUPDATE_MSG.size)
+            if not data:
+                break
+            reply += data
+        if len(reply) < SWUPDATE_MSG_HEADER.size or \
+                SWUPDATE_MSG_HEADER.unpack_from(reply)[1] != SWUPDATE_MSG_ACK:
+            self.close()
+            raise IOError('swupdate refused the install request')
+        self.sock.settimeout(None)
+        return self
+
+    def write(self, data):
+        self.sock.sendall(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
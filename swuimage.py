@@ -0,0 +1,90 @@
+#
+# swuimage.py - Read the contents and sw-description of .swu images
+#
+# An .swu image is a newc/crc cpio archive with sw-description first,
+# then its signature, then the files it lists.  Nothing here checks the
+# signature; see peercache.verify_swu.
+#
+import re
+import hashlib
+
+SW_DESCRIPTION = 'sw-description'
+SW_DESCRIPTION_SIG = 'sw-description.sig'
+CPIO_MAGICS = (b'070701', b'070702')
+CPIO_HEADER = 110
+CPIO_TRAILER = 'TRAILER!!!'
+SWU_READ_SIZE = 64 * 1024
+SHA256_PATTERN = re.compile(r'sha256\s*=\s*"([0-9a-fA-F]{64})"')
+# Images not written to the volume as they are in the archive
+TRANSFORMED_PATTERN = re.compile(r'\b(compressed|encrypted)\s*=\s*(?!false\b)[^\s;]')
+
+
+class VerifyError(Exception):
+    pass
+
+
+def cpio_entries(f):
+    '''
+    Yield (name, offset, size) for each file in a newc/crc cpio archive,
+    the format of .swu images
+    '''
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(CPIO_HEADER)
+        if len(header) < CPIO_HEADER or header[:6] not in CPIO_MAGICS:
+            raise VerifyError('Not a cpio archive at offset {}'.format(offset))
+        try:
+            size = int(header[54:62], 16)
+            namesize = int(header[94:102], 16)
+        except ValueError:
+            raise VerifyError('Damaged cpio header at offset {}'.format(offset))
+        name = f.read(namesize).rstrip(b'\0').decode('utf-8', 'replace')
+        data = (offset + CPIO_HEADER + namesize + 3) & ~3
+        if name == CPIO_TRAILER:
+            return
+        yield name, data, size
+        offset = (data + size + 3) & ~3
+
+
+def read_entry(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise VerifyError('Truncated image')
+    return data
+
+
+def hash_entry(f, offset, size):
+    f.seek(offset)
+    sha = hashlib.sha256()
+    while size > 0:
+        data = f.read(min(SWU_READ_SIZE, size))
+        if not data:
+            raise VerifyError('Truncated image')
+        sha.update(data)
+        size -= len(data)
+    return sha.hexdigest()
+
+
+def swu_images(path):
+    '''
+    Return a dict of filename to (size, sha256) from the sw-description
+    of an .swu image, for the images written to their volume unchanged,
+    whose digest can be checked on the volume after they are installed.
+    Raises VerifyError if the image cannot be read.
+    '''
+    with open(path, 'rb') as f:
+        entries = list(cpio_entries(f))
+        if not entries or entries[0][0] != SW_DESCRIPTION:
+            raise VerifyError('Image has no sw-description')
+        description = read_entry(f, entries[0][1], entries[0][2]).decode('utf-8', 'replace')
+    images = {}
+    for name, offset, size in entries[1:]:
+        m = re.search(r'\{[^{}]*filename\s*=\s*"' + re.escape(name) + r'"[^{}]*\}', description)
+        if m is None or TRANSFORMED_PATTERN.search(m.group(0)):
+            continue
+        sha256 = SHA256_PATTERN.search(m.group(0))
+        if sha256:
+            images[name] = (size, sha256.group(1).lower())
+    return images
@@ -1,24 +1,49 @@
 import os
-import json
-import random
-import datetime
+import time
+import shutil
 import dbus.service
 import dbus.exceptions
 from syslog import syslog
-from upsvc import UpdateService
+from upsvc import UpdateService, PROP_STATUS, PROP_PROGRESS, PROP_WINDOW_START, \
+    PROP_WINDOW_END, PROP_REBOOT_DEADLINE, PROP_SNOOZE_REMAINING, PROP_LAST_RESULT
 from somutil import *
-import resumetimer
 import swuclient
+import swuprogress
+import mainloop
+import multihash
+import procrun
+import migrate
+import journal
+import startup
+import delta
+import artifactcache
+import streaminstall
+import shaper
+import peercache
+import swuimage
+import metrics
+import swuctrl
+import threading
 from usbupd import LocalUpdate
-import pylibconfig
-import traceback
 from schedule import *
 
+import sys
+PYTHON3 = sys.version_info >= (3, 0)
+if PYTHON3:
+    from gi.repository import GLib as glib
+else:
+    import gobject as glib
+
 NM_IFACE = 'org.freedesktop.NetworkManager'
 NM_OBJ = '/org/freedesktop/NetworkManager'
 NM_DEVICE_IFACE = 'org.freedesktop.NetworkManager.Device'
 NM_WIFI_DEVICE_IFACE = 'org.freedesktop.NetworkManager.Device.Wireless'
 DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+# NetworkManager may not be up yet at boot; its queries are retried
+NM_QUERY_TIMEOUT = 10
+NM_RETRY_DELAY = 5
+# USB monitoring is not needed to get the service running
+USB_MONITOR_DELAY = 5
 
 DEVICE_SERVICE_INTERFACE = "com.lairdtech.device.DeviceService"
 DEVICE_SERVICE_OBJ_PATH = "/com/lairdtech/device/DeviceService"
@@ -30,15 +55,31 @@ BOOTSIDE = 'bootside'
 ALTBOOTCMD = 'altbootcmd'
 BOOTCOUNT = 'bootcount'
 BOOTLIMIT = 'bootlimit'
+# Wall clock time of the reboot into an update, to time the reboot
+REBOOT_TIME = 'igupd_reboot_time'
 
 UPDATE_SCHEDULE = 'update_schedule'
 DOWNLOAD_SCHEDULE = 'download_schedule'
+PROGRESS_RATE = 'progress_rate'
+SCHEDULE_SPREAD = 'schedule_spread'
+DOWNLOAD = 'download'
 
 ID_CFG_KEY = 'secupdate.id'
 WRITE_CFG_KEY = 'secupdate.write_cfg_path'
 UPDATE_SCHEDULE_CFG_KEY = 'secupdate.update_schedule'
+PROGRESS_LAYOUT_CFG_KEY = 'secupdate.progress_layout'
+PROGRESS_RATE_CFG_KEY = 'secupdate.progress_rate'
+MIGRATE_DEST_CFG_KEY = 'secupdate.migrate_dest'
+SCHEDULE_SPREAD_CFG_KEY = 'secupdate.schedule_spread'
+CACHE_DIR_CFG_KEY = 'secupdate.cache_dir'
+CACHE_BUDGET_CFG_KEY = 'secupdate.cache_budget'
+DOWNLOAD_RATE_CFG_KEY = 'secupdate.download_rate'
+PEER_CACHE_CFG_KEY = 'secupdate.peer_cache'
+PEER_INTERFACE_CFG_KEY = 'secupdate.peer_interface'
+METRICS_FILE_CFG_KEY = 'secupdate.metrics_file'
 DAY_CFG_KEY = '.day'
 HOURS_CFG_KEY = '.hours'
+TZ_CFG_KEY = '.tz'
 
 SWUPDATE = 'swupdate'
 IMAGE = 'image'
@@ -46,6 +87,9 @@ DEVICE_LED_FAILED = "failed"
 DEVICE_LED_RESET = "reset"
 
 SW_CONF_FILE_PATH = '/etc/secupdate.cfg'
+DATA_PATH = '/data'
+# Outside /data, which it describes the copy of; only valid until reboot
+MIGRATE_MANIFEST_PATH = '/run/igupd/migrate.manifest'
 SW_VERSION_FILE_PATH = '/var/sw-versions'
 LAIRD_RELEASE_FILE_PATH = '/etc/os-release'
 
@@ -54,6 +98,9 @@ rootfs_side = {'a': '/dev/ubi0_1', 'b': '/dev/ubi0_4'}
 
 components_dict = {'kernel': kernel_side,
                    'rootfs': rootfs_side}
+# The images in an update written to each component
+image_components = {'kernel.itb': 'kernel',
+                    'rootfs.bin': 'rootfs'}
 
 NO_UPDATE_AVAILABLE = 0
 UPDATES_AVAILABLE = 1
@@ -67,32 +114,96 @@ UPDATE_SCHEDULED = 2
 UPDATE_REBOOT = 3
 UPDATE_READY = 4
 
+# The LastResult property
+RESULT_NONE = ''
+RESULT_INSTALLED = 'installed'
+RESULT_SKIPPED = 'skipped'
+RESULT_FAILED = 'failed'
+RESULT_MIGRATION_FAILED = 'migration_failed'
+RESULT_VERIFY_FAILED = 'verify_failed'
+RESULT_ENV_FAILED = 'env_write_failed'
+RESULT_VERIFIED = 'verified'
+RESULT_FALLBACK = 'fallback'
+
 MAX_SNOOZE_SECONDS = 7200
+METRICS_WRITE_INTERVAL = 60
 SWUPDATE_SUCCESS = '2'
 SWUPDATE_FAILED = '3'
 
+# Progress statuses timed as phases of an update
+PROGRESS_PHASES = {swuprogress.SWU_STATUS_DOWNLOAD : 'download',
+                   swuprogress.SWU_STATUS_RUN : 'install'}
+
+
+def download_url(download):
+    url = download['url']
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError('Unsupported download URL {}'.format(url))
+    return url
+
 
 class SoftwareUpdate(UpdateService):
     def __init__(self, bus_name):
         super(SoftwareUpdate, self).__init__(bus_name)
         syslog("Starting secure software update")
-        self.current_boot_side = get_uboot_env_value(BOOTSIDE)
+        self.startup = startup.PhaseTimer()
+        self.metrics = metrics.Registry()
+        self.metrics_file = None
+        self.init_metrics()
+        with self.startup.phase('uboot_env'):
+            self.current_boot_side = get_uboot_env_value(BOOTSIDE)
         self.config = {}
         self.swupdate_client = None
         self.reboot_start_time = 0
         self.reboot_timer = None
+        # Wall clock time of the reboot, and the snooze, as last signalled
+        self.reboot_at = None
+        self.snooze_remaining = 0
+        self.snooze_timer = None
         self.snooze_duration = 0
+        self.last_result = RESULT_NONE
+        self.window_start = 0
+        self.window_end = 0
         self.device_name = None
+        self.mac_addr = None
         self.total_snooze_seconds = 0
         self.usb_local_update = False
         self.switch_side = False
         self.data_migrate_success = True
         self.device_svc = None
         self.updated_component = set()
-        self.gen_sw_version()
-        self.get_wlan_hw_address()
-        self.conn_device_service()
-        self.local_update = LocalUpdate(self.process_config, self.start_swupdate, self.device_svc)
+        self.update_generation = 0
+        self.digest_cache = multihash.DigestCache()
+        # The local .swu being installed, to verify the volumes against
+        self.installed_image = None
+        # Generation of the update whose volumes are being read back
+        self.verifying = None
+        self.reboot_waiting = False
+        self.migrate_dest = None
+        self.data_migration = None
+        self.prestaged_generation = None
+        self.prestage_thread = None
+        self.pending_delta = None
+        self.delta_stats = {}
+        self.pending_stream = None
+        self.stream_install = None
+        # A streamed install is under way; not a USB update
+        self.stream_installing = False
+        # A downloaded image to stream to swupdate, and the key of the
+        # artifact kept in the cache until swupdate has installed it
+        self.pending_artifact = None
+        self.pending_fallback = None
+        self.installing_artifact = None
+        self.progress_layout = swuprogress.PROGRESS_LAYOUT_LEGACY
+        self.progress = {}
+        self.progress_status = None
+        self.progress_estimator = swuprogress.ProgressEstimator()
+        self.progress_throttle = swuprogress.ProgressThrottle(mainloop, self.progress_changed)
+        with self.startup.phase('sw_version'):
+            self.gen_sw_version()
+        with self.startup.phase('device_service'):
+            self.conn_device_service()
+        self.local_update = None
         self.update_state = UPDATE_READY
         self.device_name_prefix = 'Laird_'
         self.write_cfg_path = '/data/public/igupd/update_schedule.conf'
@@ -100,20 +211,190 @@ class SoftwareUpdate(UpdateService):
         self.sslkey = None
         self.download_start_timer = None
         self.download_end_timer = None
-        self.process_config()
+        # Maximum delay (seconds) of this device into each window; 0 disables
+        self.schedule_spread = 0
+        self.cache_dir = artifactcache.CACHE_DIR
+        self.cache_budget = artifactcache.CACHE_BUDGET
+        self.cached_download = None
+        self.cached_download_thread = None
+        # Download bandwidth (bytes/second, 0 unlimited), overridden by
+        # the first window of download_rates containing the time
+        self.download_rate = 0
+        self.download_rates = []
+        self.rate_bucket = shaper.TokenBucket()
+        self.rate_timer = None
+        self.relay = None
+        # Share downloaded artifacts with other gateways on the LAN
+        self.peer_cache_enabled = False
+        self.peer_interface = None
+        self.peer_cache = None
+        with self.startup.phase('config'):
+            self.process_config()
+        if self.metrics_file:
+            mainloop.call_later(METRICS_WRITE_INTERVAL, self.write_metrics)
+        self.artifact_cache = artifactcache.ArtifactCache(self.cache_dir, self.cache_budget)
+        self.apply_download_rate()
+        if self.peer_cache_enabled:
+            self.start_peer_cache()
+        self.journal = journal.StateJournal(
+            os.path.join(self.write_cfg_path, journal.JOURNAL_NAME), mainloop)
 
-        if get_uboot_env_value(UPGRADE_AVAILABLE) == '1':
-            self.verify_startup()
-        else:
-            self.start_swupdate(False)
+        # The device ID is the WLAN MAC address, which can take a while
+        # to get from NetworkManager at boot.  Start with the ID saved by
+        # the last run, if there is one, and check it once the address
+        # arrives.
+        self.device_name = startup.load_device_id(self.device_id_path(), self.device_name_prefix)
+        self.get_wlan_hw_address()
+        if self.device_name:
+            syslog('Secure update device ID (cached): ' + self.device_name)
+            self.start_update_service()
+        self.update_properties()
+        mainloop.call_later(USB_MONITOR_DELAY, self.start_local_update)
+
+    def init_metrics(self):
+        '''
+        Create the update pipeline metrics, so that all of them are
+        exported from the start
+        '''
+        m = self.metrics
+        self.progress_messages = m.counter('progress_messages_total', 'swupdate progress messages')
+        m.counter('updates_started_total', 'Updates started by swupdate')
+        m.counter('updates_installed_total', 'Updates installed')
+        m.counter('updates_skipped_total', 'Updates skipped as already installed')
+        m.counter('updates_failed_total', 'Updates that failed to install')
+        m.counter('bad_commands_total', 'Commands rejected by swupdate')
+        m.counter('artifact_downloads_failed_total', 'Cached downloads that failed')
+        m.counter('delta_fallbacks_total', 'Deltas given up on for the full image')
+        m.counter('snoozes_total', 'Reboots snoozed')
+        m.counter('migrations_failed_total', 'Data migrations that failed')
+        m.counter('boots_verified_total', 'Boots into an update that succeeded')
+        m.counter('boots_fallback_total', 'Boots into an update that fell back')
+        m.counter('swupdate_restarts_total', 'swupdate restarts with a new command')
+        for phase in ('update', 'download', 'install', 'artifact_download',
+                      'reboot_wait', 'migration', 'reboot'):
+            m.histogram(phase + '_seconds', 'Time spent in the {} phase'.format(phase))
+        m.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        m = self.metrics
+        m.gauge('update_state', 'The state returned by CheckUpdate').set(self.update_state)
+        if self.swupdate_client is not None:
+            stats = self.swupdate_client.supervisor.stats()
+            m.counter('swupdate_exits_total', 'Exits of swupdate').value = stats['restarts']
+            m.counter('swupdate_failures_total', 'Exits of swupdate with an error').value = stats['failures']
+            m.counter('swupdate_circuit_trips_total', 'Times the circuit breaker opened').value = \
+                stats['circuit_trips']
+            m.gauge('swupdate_circuit_open', '1 if swupdate restarts are held off').set(
+                1 if stats['circuit_open'] else 0)
+            m.set_stats('swupdate', dict((key, value) for key, value in
+                self.swupdate_client.get_supervisor_stats().items() if key not in stats))
+        m.set_stats('', uboot_env.write_stats())
+        for name, proc_stats in procrun.get_stats().items():
+            m.set_stats('proc_' + name, proc_stats)
+        if self.data_migration is not None:
+            m.set_stats('migrate', self.data_migration.stats)
+        m.set_stats('', self.startup.stats())
+        m.set_stats('delta', self.delta_stats)
+        m.set_stats('cache', {'used_bytes' : self.artifact_cache.used_bytes(),
+                              'budget' : self.artifact_cache.budget})
+        m.set_stats('cache', self.artifact_cache.stats)
+        if self.peer_cache is not None:
+            m.set_stats('peer', self.peer_cache.stats)
+        if self.relay is not None:
+            m.set_stats('shaper', self.relay.get_stats())
+        if self.stream_install is not None:
+            m.set_stats('stream', self.stream_install.stats)
+        if self.cached_download is not None:
+            offset, size = self.cached_download.progress()
+            m.set_stats('cache', {'offset' : offset, 'size' : size or 0})
+            m.set_stats('cache', self.cached_download.stats)
+        m.set_stats('journal', self.journal.stats)
+        m.set_stats('properties', self.properties.stats())
+        m.set_stats('timers', mainloop.scheduler.stats())
+
+    def get_metrics(self):
+        return dbus.Dictionary(self.metrics.snapshot(), signature='sv')
+
+    def write_metrics(self):
+        '''
+        Write the metrics file for the Prometheus textfile collector.
+        Best kept on a tmpfs; it is only rewritten when they change.
+        '''
+        try:
+            self.metrics.write_prometheus(self.metrics_file)
+        except (IOError, OSError) as e:
+            syslog('Failed to write metrics to {}: {}'.format(self.metrics_file, e))
+        mainloop.call_later(METRICS_WRITE_INTERVAL, self.write_metrics)
+
+    def device_id_path(self):
+        return os.path.join(self.write_cfg_path, startup.DEVICE_ID_NAME)
+
+    def start_update_service(self):
+        '''
+        Start swupdate, or report the result of the last update, once
+        the device ID is known
+        '''
+        with self.startup.phase('start'):
+            if self.swupdate_client is not None:
+                # Already started by a USB update
+                pass
+            elif get_uboot_env_value(UPGRADE_AVAILABLE) == '1':
+                self.verify_startup()
+            elif not self.restore_state():
+                self.start_swupdate(False)
+                pending = self.artifact_cache.pending()
+                if pending:
+                    # Carry on with a download cut short by a restart
+                    self.start_cached_download(pending[0])
+        self.update_properties()
+        self.startup.ready()
+
+    def start_local_update(self):
+        with self.startup.phase('usb_monitor'):
+            self.local_update = LocalUpdate(self.process_config, self.start_swupdate, self.device_svc)
 
     def get_wlan_hw_address(self):
+        '''
+        Ask NetworkManager for the WLAN MAC address without blocking the
+        main loop; wlan_hw_address() is called with the result.
+        '''
+        self.startup.begin('mac_address')
+        try:
+            bus = dbus.SystemBus()
+            nm = dbus.Interface(bus.get_object(NM_IFACE, NM_OBJ, introspect=False), NM_IFACE)
+            nm.GetDeviceByIpIface("wlan0", timeout=NM_QUERY_TIMEOUT,
+                reply_handler=self.wlan_device, error_handler=self.wlan_hw_address_failed)
+        except dbus.exceptions.DBusException as e:
+            self.wlan_hw_address_failed(e)
+
+    def wlan_device(self, device_path):
         bus = dbus.SystemBus()
-        nm = dbus.Interface(bus.get_object(NM_IFACE, NM_OBJ), NM_IFACE)
-        wifi_dev_obj = bus.get_object(NM_IFACE, nm.GetDeviceByIpIface("wlan0"))
-        wifi_dev_props = dbus.Interface(wifi_dev_obj, DBUS_PROP_IFACE)
-        self.mac_addr = str(wifi_dev_props.Get(NM_WIFI_DEVICE_IFACE, 'HwAddress'))
+        wifi_dev_props = dbus.Interface(bus.get_object(NM_IFACE, device_path, introspect=False),
+            DBUS_PROP_IFACE)
+        wifi_dev_props.Get(NM_WIFI_DEVICE_IFACE, 'HwAddress', timeout=NM_QUERY_TIMEOUT,
+            reply_handler=self.wlan_hw_address, error_handler=self.wlan_hw_address_failed)
+
+    def wlan_hw_address_failed(self, e):
+        syslog("igupd: get_wlan_hw_address failed, retrying: %s" % e)
+        mainloop.call_later(NM_RETRY_DELAY, self.get_wlan_hw_address)
+
+    def wlan_hw_address(self, address):
+        self.startup.end('mac_address')
+        self.mac_addr = str(address)
         syslog("igupd: get_wlan_hw_address : %s" % self.mac_addr)
+        device_name = self.device_name_prefix + self.mac_addr
+        if device_name == self.device_name:
+            return
+        started = self.device_name is not None
+        self.device_name = device_name
+        syslog('Secure update device ID: ' + self.device_name)
+        startup.save_device_id(self.device_id_path(), self.device_name)
+        if not started:
+            self.start_update_service()
+        elif self.update_state != UPDATES_IN_PROGRESS and self.swupdate_client is not None \
+                and not self.usb_local_update and not self.stream_installing:
+            # The cached ID was stale; restart swupdate with the new one
+            self.start_swupdate(False)
 
     def gen_sw_version(self):
         """
@@ -152,7 +433,7 @@ class SoftwareUpdate(UpdateService):
         """
         try:
             bus = dbus.SystemBus()
-            proxy = bus.get_object(DEVICE_SERVICE_INTERFACE, DEVICE_SERVICE_OBJ_PATH)
+            proxy = bus.get_object(DEVICE_SERVICE_INTERFACE, DEVICE_SERVICE_OBJ_PATH, introspect=False)
             self.device_svc = dbus.Interface(proxy, PUBLIC_API_INTERFACE)
 
         except dbus.exceptions.DBusException as e:
@@ -164,14 +445,65 @@ class SoftwareUpdate(UpdateService):
         a fallback, and update Hawkbit accordingly.
         '''
         if int(get_uboot_env_value(BOOTCOUNT)) > 5:
+            self.metrics.counter('boots_fallback_total').inc()
+            self.last_result = RESULT_FALLBACK
             self.start_swupdate(True, SWUPDATE_FAILED)
         else:
+            self.metrics.counter('boots_verified_total').inc()
+            self.last_result = RESULT_VERIFIED
             self.start_swupdate(True, SWUPDATE_SUCCESS)
+        try:
+            # Without an RTC the clock may not be set yet this early
+            downtime = time.time() - int(get_uboot_env_value(REBOOT_TIME))
+            if downtime >= 0:
+                self.metrics.histogram('reboot_seconds').observe(downtime)
+        except (TypeError, ValueError):
+            pass
 
-        set_env(UPGRADE_AVAILABLE, '0')
-        set_env(BOOTCOUNT, '0')
+        set_env_batch([(UPGRADE_AVAILABLE, '0'), (BOOTCOUNT, '0')])
+        # The journal was migrated with /data and is for the other side
+        self.journal.reset()
         return True
 
+    def restore_state(self):
+        '''
+        If igupd was restarted after an update was installed, go back to
+        waiting for the scheduled reboot recorded in the journal rather
+        than starting swupdate, which would download the update again.
+        Returns True if the state was restored.
+        '''
+        state = self.journal.replay()
+        if state.get('update_state') != UPDATES_AVAILABLE or \
+                state.get('bootside') != self.current_boot_side:
+            if state:
+                self.journal.reset()
+            return False
+        self.switch_side = state.get('switch_side', False)
+        self.update_generation = state.get('update_generation', 0)
+        self.update_state = UPDATES_AVAILABLE
+        delay = max(state.get('reboot_deadline', 0) - time.time(), 0)
+        syslog('Restored installed update of {}, rebooting in {:.0f} seconds.'.format(
+            ', '.join(state.get('components', [])), delay))
+        self.reboot_timer = mainloop.call_later(delay, self.reboot)
+        self.reboot_at = self.reboot_deadline()
+        if self.switch_side:
+            self.start_data_prestage(restored=True)
+        self.UpdatePending(UPDATE_SCHEDULED)
+        return True
+
+    def reboot_deadline(self):
+        '''
+        Return the wall clock time the reboot timer will fire, allowing
+        for a snooze in progress
+        '''
+        timer = self.reboot_timer
+        if timer is None or not timer.active():
+            return None
+        delay = timer.time_left()
+        if timer.paused() and timer.resume_handle is not None:
+            delay += timer.resume_handle.time_left()
+        return time.time() + delay
+
     def update_available(self):
         '''
         Reset the update_available uboot var to '1'.  Set the 'bootcmd' and
@@ -180,6 +512,234 @@ class SoftwareUpdate(UpdateService):
         self.schedule_reboot(self.config.get(UPDATE_SCHEDULE))
         self.UpdatePending(UPDATE_SCHEDULED)
         self.update_state = UPDATES_AVAILABLE
+        self.metrics.begin('reboot_wait')
+        # Installing is the costly part, so this is synced at once
+        self.journal.record({'update_state' : self.update_state, 'switch_side' : self.switch_side,
+            'update_generation' : self.update_generation, 'bootside' : self.current_boot_side,
+            'components' : sorted(self.updated_component),
+            'reboot_deadline' : self.reboot_deadline()}, sync=True)
+
+    def installed_volumes(self):
+        '''
+        Return the volumes of the side an update is installed to
+        '''
+        side = 'b' if self.current_boot_side == 'a' else 'a'
+        return [components_dict[c][side] for c in sorted(components_dict)]
+
+    def verify_installed_volumes(self):
+        '''
+        Read back the newly installed volumes and check them against the
+        digests in the sw-description of the image they were installed
+        from.  The volumes are hashed concurrently off the main loop and
+        the result handed back to installed_volumes_checked(); a
+        mismatch fails the update.  Updates from the server are not
+        stored, so there is nothing to check them against and they are
+        not read back.
+        '''
+        image = self.installed_image
+        self.verifying = None
+        if image is None:
+            syslog('No local image to verify the installed volumes against')
+            return
+        side = 'b' if self.current_boot_side == 'a' else 'a'
+        generation = self.update_generation
+
+        def read_back():
+            good = True
+            try:
+                expected = {}
+                for name, (size, sha256) in swuimage.swu_images(image).items():
+                    if name in image_components:
+                        expected[components_dict[image_components[name]][side]] = (size, sha256)
+                if not expected:
+                    syslog('No digests in {} to verify the installed volumes against'.format(image))
+                else:
+                    sizes = dict((v, size) for v, (size, sha256) in expected.items())
+                    digests = self.digest_cache.get_many(sorted(expected), generation, sizes=sizes)
+                    for v, (size, sha256) in sorted(expected.items()):
+                        if digests[v]['sha256'] != sha256:
+                            syslog('Installed volume {} does not match the image: sha256 {}, expected {}'.format(
+                                v, digests[v]['sha256'], sha256))
+                            good = False
+                        else:
+                            syslog('Installed volume {} verified'.format(v))
+            except (EnvironmentError, swuimage.VerifyError) as e:
+                syslog('Failed to read back installed volumes: {}'.format(e))
+            glib.idle_add(self.installed_volumes_checked, generation, good)
+
+        self.verifying = generation
+        t = threading.Thread(target=read_back)
+        t.daemon = True
+        t.start()
+
+    def installed_volumes_checked(self, generation, good):
+        '''
+        The read back of the installed volumes has finished.  A reboot
+        held up waiting for it goes ahead if they were good.
+        '''
+        if generation != self.verifying:
+            return False
+        self.verifying = None
+        if self.update_state != UPDATES_AVAILABLE:
+            return False
+        if not good:
+            self.abandon_update(RESULT_VERIFY_FAILED)
+        elif self.reboot_waiting:
+            self.reboot_waiting = False
+            self.reboot()
+        return False
+
+    def start_data_prestage(self, restored=False):
+        '''
+        Start copying /data to the other side in the background, so that
+        only the final changes need to be copied at reboot time.  Without
+        a configured destination the migrate script is used at reboot.
+        restored is True when carrying on with an update restored from
+        the journal, whose staging can be kept.
+        '''
+        if not self.migrate_dest or not os.path.isdir(self.migrate_dest):
+            self.data_migration = None
+            return
+        if self.data_migration is None:
+            self.data_migration = migrate.DataMigration(DATA_PATH, self.migrate_dest,
+                MIGRATE_MANIFEST_PATH)
+        if self.prestage_thread is not None and self.prestage_thread.is_alive():
+            return
+        if not restored and self.prestaged_generation != self.update_generation:
+            # Nothing staged for an earlier update can be trusted
+            self.data_migration.reset()
+        self.prestaged_generation = self.update_generation
+
+        def prestage():
+            try:
+                self.data_migration.prestage()
+            except (IOError, OSError) as e:
+                syslog('Data pre-staging failed: {}'.format(e))
+
+        self.prestage_thread = threading.Thread(target=prestage)
+        self.prestage_thread.daemon = True
+        self.prestage_thread.start()
+
+    def swupdate_connected(self):
+        if self.pending_delta:
+            path = self.pending_delta
+            self.pending_delta = None
+            self.install_delta(path)
+        elif self.pending_stream:
+            url = self.pending_stream
+            self.pending_stream = None
+            self.install_url(url)
+        elif self.pending_artifact:
+            path = self.pending_artifact
+            fallback_url = self.pending_fallback
+            self.pending_artifact = None
+            self.pending_fallback = None
+            if delta.is_delta(path):
+                self.install_delta(path, fallback_url)
+            else:
+                self.install_artifact(path)
+
+    def install_artifact(self, path):
+        '''
+        Stream a downloaded image from the artifact cache to swupdate
+        '''
+        def copy(out):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, artifactcache.CACHE_CHUNK_SIZE)
+
+        self.stream_to_swupdate(path, copy)
+
+    def artifact_installed(self):
+        '''
+        swupdate has reported the result of installing a cached artifact,
+        which may be evicted from now on.  Returns True if there was one.
+        '''
+        key = self.installing_artifact
+        if key is None:
+            return False
+        self.installing_artifact = None
+        self.artifact_cache.release(key)
+        return True
+
+    def stream_installed(self):
+        '''
+        swupdate has reported the result of a streamed install.  Returns
+        True if there was one.
+        '''
+        streamed = self.stream_installing
+        self.stream_installing = False
+        return streamed
+
+    def install_delta(self, path, fallback_url=None):
+        '''
+        Rebuild the update image from a delta artifact and the volumes
+        of the running side, and stream it to swupdate.  If the volumes
+        take too long to scan, the full image is streamed from
+        fallback_url instead, if there is one.
+        '''
+        sources = [components_dict[c][self.current_boot_side] for c in sorted(components_dict)]
+        proxy = self.download_proxy()
+
+        def rebuild(out):
+            with open(path, 'rb') as artifact:
+                try:
+                    self.delta_stats = delta.DeltaReconstructor(sources).apply(artifact, out)
+                except delta.DeltaScanLimit as e:
+                    if fallback_url is None:
+                        raise
+                    syslog('{}, installing {} instead'.format(e, fallback_url))
+                    self.metrics.counter('delta_fallbacks_total').inc()
+                    self.stream_install = streaminstall.StreamInstall(fallback_url, proxy=proxy)
+                    self.stream_install.run(out)
+
+        self.stream_to_swupdate(path, rebuild)
+
+    def install_url(self, url):
+        '''
+        Stream the update image from a URL to swupdate, without
+        storing it
+        '''
+        self.stream_install = streaminstall.StreamInstall(url, proxy=self.download_proxy())
+        self.stream_to_swupdate(url, self.stream_install.run)
+
+    def stream_to_swupdate(self, name, write_image):
+        '''
+        Call write_image(out) off the main loop, with out a stream to
+        swupdate's install socket.  swupdate reports the result as usual.
+        '''
+        def install():
+            stream = swuctrl.InstallStream()
+            try:
+                stream.open()
+                write_image(stream)
+            except Exception as e:
+                # Closing the stream part way fails the install in swupdate
+                syslog('Install of {} failed: {}'.format(name, e))
+                if stream.sock is None:
+                    glib.idle_add(self.swupdate_handler, swuclient.SWU_STATUS_FAILURE, None, None)
+            finally:
+                stream.close()
+
+        t = threading.Thread(target=install)
+        t.daemon = True
+        t.start()
+
+    def migrate_data(self):
+        '''
+        Complete the migration of /data to the other side
+        '''
+        self.metrics.begin('migration')
+        if self.data_migration is None:
+            success = data_migration()
+        else:
+            if self.prestage_thread is not None:
+                self.prestage_thread.join()
+                self.prestage_thread = None
+            success = self.data_migration.finalize()
+        self.metrics.end('migration')
+        if not success:
+            self.metrics.counter('migrations_failed_total').inc()
+        return success
 
     def check_update(self, perform_update):
         return self.update_state
@@ -198,26 +758,50 @@ class SoftwareUpdate(UpdateService):
 
             self.UpdatePending(UPDATE_DOWNLOADING)
             self.update_state = UPDATES_IN_PROGRESS
+            self.journal.record({'update_state' : self.update_state})
+            self.metrics.counter('updates_started_total').inc()
+            self.metrics.begin('update')
+            self.properties.set(PROP_PROGRESS, dbus.Int32(0))
 
         elif status == swuclient.SWU_STATUS_SUCCESS:
+            self.metrics.end('update')
+            from_cache = self.artifact_installed()
+            streamed = self.stream_installed()
             if self.updated_component:
+                self.metrics.counter('updates_installed_total').inc()
+                self.last_result = RESULT_INSTALLED
                 if 'kernel.itb' in self.updated_component and 'rootfs.bin' in self.updated_component:
                     for keys in self.updated_component:
                         syslog("swupdate_handler: Components updated are : %s" % keys)
                     self.switch_side = True
+                    self.update_generation += 1
+                    self.verify_installed_volumes()
+                    self.start_data_prestage()
                 self.update_available()
                 self.updated_component.clear()
             else:
                 #case when update is skipped
+                self.metrics.counter('updates_skipped_total').inc()
+                self.last_result = RESULT_SKIPPED
                 self.update_state = NO_UPDATE_AVAILABLE
+                self.journal.record({'update_state' : self.update_state})
                 self.updated_component.clear()
                 if self.usb_local_update is True:
                     self.local_update_state_change(DEVICE_LED_RESET)
+                elif from_cache or streamed:
+                    # Not a hawkBit action, so there is nothing to answer
+                    self.start_swupdate(False)
                 else:
                     self.start_swupdate(True, SWUPDATE_SUCCESS)
 
         elif status == swuclient.SWU_STATUS_FAILURE:
+            self.metrics.end('update')
+            self.metrics.counter('updates_failed_total').inc()
+            self.artifact_installed()
+            self.stream_installed()
+            self.last_result = RESULT_FAILED
             self.update_state = NO_UPDATE_AVAILABLE
+            self.journal.record({'update_state' : self.update_state})
             self.updated_component.clear()
             if self.usb_local_update is True:
                 self.local_update_state_change(DEVICE_LED_FAILED)
@@ -225,9 +809,87 @@ class SoftwareUpdate(UpdateService):
                 self.start_swupdate()
 
         elif status == swuclient.SWU_STATUS_BAD_CMD:
+            self.metrics.counter('bad_commands_total').inc()
             self.updated_component.clear()
+            from_cache = self.artifact_installed()
+            streamed = self.stream_installed()
             if self.usb_local_update is True:
                 self.local_update_state_change(DEVICE_LED_FAILED)
+            elif from_cache or streamed:
+                self.start_swupdate(False)
+
+        self.update_properties()
+
+    def swupdate_progress(self, progress):
+        '''
+        Track detailed swupdate progress; the UpdateProgress signal is
+        rate limited, except on a change of status.
+        '''
+        self.progress_messages.inc()
+        self.progress_estimator.update(progress)
+        self.progress = progress.as_dict(self.progress_estimator)
+        urgent = progress.status != self.progress_status
+        if urgent:
+            self.progress_phase(self.progress_status, progress.status)
+        self.progress_status = progress.status
+        self.progress_throttle.update(self.progress, urgent)
+
+    def progress_phase(self, previous, status):
+        '''
+        Time the download and install phases from the progress status.
+        Only called when the status changes, to keep progress cheap.
+        '''
+        phase = PROGRESS_PHASES.get(previous)
+        if phase:
+            self.metrics.end(phase)
+        phase = PROGRESS_PHASES.get(status)
+        if phase:
+            self.metrics.begin(phase)
+
+    def progress_changed(self, progress):
+        '''
+        Signal progress, at the rate allowed by the progress throttle
+        '''
+        self.UpdateProgress(progress)
+        if progress['status'] == swuprogress.SWU_STATUS_DOWNLOAD:
+            self.properties.set(PROP_PROGRESS, dbus.Int32(progress['download_percent']))
+        elif progress['status'] == swuprogress.SWU_STATUS_RUN:
+            self.properties.set(PROP_PROGRESS, dbus.Int32(progress['install_percent']))
+
+    def get_progress(self):
+        return dbus.Dictionary(self.progress, signature='sv')
+
+    def update_properties(self):
+        '''
+        Refresh the cached properties of the public interface; those
+        that changed are signalled together with PropertiesChanged
+        '''
+        self.properties.update({
+            PROP_STATUS : dbus.Int32(self.update_state),
+            PROP_WINDOW_START : dbus.Int64(self.window_start),
+            PROP_WINDOW_END : dbus.Int64(self.window_end),
+            PROP_REBOOT_DEADLINE : dbus.Int64(int(self.reboot_at) if self.reboot_at else 0),
+            PROP_SNOOZE_REMAINING : dbus.Int32(self.snooze_remaining),
+            PROP_LAST_RESULT : dbus.String(self.last_result),
+        })
+
+    def swupdate_circuit_handler(self, circuit_open):
+        '''
+        Report swupdate crash looping (or recovery from it)
+        '''
+        syslog('swupdate circuit breaker {}'.format('open' if circuit_open else 'closed'))
+        self.SwupdateCircuitBreaker(circuit_open)
+
+    def get_timers(self):
+        return mainloop.pending_timers()
+
+    def get_swupdate_status(self):
+        '''
+        Return the swupdate restart counters
+        '''
+        if self.swupdate_client is None:
+            return dbus.Dictionary({}, signature='sv')
+        return self.swupdate_client.supervisor.stats()
 
     def process_config(self, config=None):
         '''
@@ -243,12 +905,11 @@ class SoftwareUpdate(UpdateService):
 
         if config is None:
             try:
+                import pylibconfig
                 c = pylibconfig.Config()
                 c.readFile(SW_CONF_FILE_PATH)
                 if c.exists(ID_CFG_KEY):
                     self.device_name_prefix, is_valid = c.value(ID_CFG_KEY)
-                self.device_name = self.device_name_prefix + self.mac_addr
-                syslog('Secure update device ID: ' + self.device_name)
                 if c.exists(WRITE_CFG_KEY):
                     self.write_cfg_path, is_valid = c.value(WRITE_CFG_KEY)
                 syslog('Secure update config write path: ' + self.write_cfg_path)
@@ -256,6 +917,36 @@ class SoftwareUpdate(UpdateService):
                     self.public_key_file, is_valid = c.value('globals.public-key-file')
                 if c.exists('suricatta.sslkey'):
                     self.sslkey, is_valid = c.value('suricatta.sslkey')
+                if c.exists(MIGRATE_DEST_CFG_KEY):
+                    self.migrate_dest, is_valid = c.value(MIGRATE_DEST_CFG_KEY)
+                if c.exists(SCHEDULE_SPREAD_CFG_KEY):
+                    spread, is_valid = c.value(SCHEDULE_SPREAD_CFG_KEY)
+                    if spread >= 0:
+                        self.schedule_spread = spread
+                if c.exists(CACHE_DIR_CFG_KEY):
+                    self.cache_dir, is_valid = c.value(CACHE_DIR_CFG_KEY)
+                if c.exists(CACHE_BUDGET_CFG_KEY):
+                    budget, is_valid = c.value(CACHE_BUDGET_CFG_KEY)
+                    if budget > 0:
+                        self.cache_budget = budget
+                if c.exists(DOWNLOAD_RATE_CFG_KEY):
+                    rate, is_valid = c.value(DOWNLOAD_RATE_CFG_KEY)
+                    if rate >= 0:
+                        self.download_rate = rate
+                if c.exists(PEER_CACHE_CFG_KEY):
+                    self.peer_cache_enabled, is_valid = c.value(PEER_CACHE_CFG_KEY)
+                if c.exists(PEER_INTERFACE_CFG_KEY):
+                    self.peer_interface, is_valid = c.value(PEER_INTERFACE_CFG_KEY)
+                if c.exists(METRICS_FILE_CFG_KEY):
+                    self.metrics_file, is_valid = c.value(METRICS_FILE_CFG_KEY)
+                if c.exists(PROGRESS_LAYOUT_CFG_KEY):
+                    layout, is_valid = c.value(PROGRESS_LAYOUT_CFG_KEY)
+                    if layout in swuprogress.PROGRESS_LAYOUTS:
+                        self.progress_layout = layout
+                if c.exists(PROGRESS_RATE_CFG_KEY):
+                    rate, is_valid = c.value(PROGRESS_RATE_CFG_KEY)
+                    if rate > 0:
+                        self.progress_throttle.set_rate(rate)
                 # Convert update_schedule from cfg format to dict
                 update_schedule = []
                 i = 0
@@ -264,7 +955,11 @@ class SoftwareUpdate(UpdateService):
                     day_str, day_valid = c.value(key + DAY_CFG_KEY)
                     hours_str, hours_valid = c.value(key + HOURS_CFG_KEY)
                     if day_valid and hours_valid:
-                        update_schedule.append({ day_str : hours_str })
+                        if c.exists(key + TZ_CFG_KEY):
+                            tz_str, tz_valid = c.value(key + TZ_CFG_KEY)
+                            update_schedule.append({ 'days' : day_str, 'hours' : hours_str, 'tz' : tz_str })
+                        else:
+                            update_schedule.append({ day_str : hours_str })
                         i = i + 1
                         key = UPDATE_SCHEDULE_CFG_KEY + '.[{}]'.format(i)
                     else:
@@ -284,7 +979,14 @@ class SoftwareUpdate(UpdateService):
                     self.config[DOWNLOAD_SCHEDULE] = download_schedule
                     syslog('Download schedule: {}'.format(self.config[DOWNLOAD_SCHEDULE]))
 
+                # Override the download rates if config file exists
+                rates = shaper.load_rates(self.write_cfg_path)
+                if rates:
+                    self.download_rate, self.download_rates = rates
+                    syslog('Download rate: {}, {}'.format(self.download_rate, self.download_rates))
+
             except (RuntimeError, IOError):
+                import traceback
                 syslog('Failed to parse secure update configuration file: {}'.format(traceback.format_exc()))
                 return False
         else:
@@ -295,6 +997,16 @@ class SoftwareUpdate(UpdateService):
             elif self.config is not None:
                 ret = False
                 try:
+                    if shaper.DOWNLOAD_RATE in config or shaper.DOWNLOAD_RATES in config:
+                        self.set_download_rates(int(config.get(shaper.DOWNLOAD_RATE, self.download_rate)),
+                            config.get(shaper.DOWNLOAD_RATES, self.download_rates))
+                        ret = True
+                    if DOWNLOAD in config:
+                        if config[DOWNLOAD].get('stream'):
+                            self.start_stream_install(config[DOWNLOAD])
+                        else:
+                            self.start_cached_download(config[DOWNLOAD])
+                        ret = True
                     if check_schedule(config.get(UPDATE_SCHEDULE)):
                         self.config[UPDATE_SCHEDULE] = config[UPDATE_SCHEDULE]
                         save_schedule(self.write_cfg_path, UPDATE_SCHEDULE, self.config[UPDATE_SCHEDULE])
@@ -305,11 +1017,21 @@ class SoftwareUpdate(UpdateService):
                         save_schedule(self.write_cfg_path, DOWNLOAD_SCHEDULE, self.config[DOWNLOAD_SCHEDULE])
                         syslog('igupd: process_config: download schedule modified successfully: {}'.format(self.config[DOWNLOAD_SCHEDULE]))
                         # Restart download window
-                        now = datetime.datetime.now()
-                        self.schedule_download_window(now)
+                        self.schedule_download_window(time.time())
+                        ret = True
+                    if PROGRESS_RATE in config and float(config[PROGRESS_RATE]) > 0:
+                        self.progress_throttle.set_rate(float(config[PROGRESS_RATE]))
+                        syslog('igupd: process_config: progress rate modified successfully: {}'.format(config[PROGRESS_RATE]))
+                        ret = True
+                    if SCHEDULE_SPREAD in config and int(config[SCHEDULE_SPREAD]) >= 0:
+                        self.schedule_spread = int(config[SCHEDULE_SPREAD])
+                        syslog('igupd: process_config: schedule spread modified successfully: {}'.format(self.schedule_spread))
+                        self.schedule_download_window(time.time())
                         ret = True
                     return ret
-                except (TypeError, AttributeError, ValueError):
+                except (TypeError, AttributeError, ValueError, KeyError,
+                        IOError, OSError) as e:
+                    syslog('igupd: process_config: {}'.format(e))
                     return False
         return True
 
@@ -329,45 +1051,84 @@ class SoftwareUpdate(UpdateService):
 
         # Check we are using swupdate's suricatta mode or updating locally on the device.
         # If local, don't save the config
+        # Suricatta downloads through the relay when they are shaped
+        proxy = self.download_proxy()
+        proxy = ' -y ' + proxy if proxy else ''
+        self.installed_image = None
         if reply:
-            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select, "-u", '-i '+  self.device_name + ' -c ' + result]
+            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select, "-u", '-i '+  self.device_name + ' -c ' + result + proxy]
             syslog("CONFIG: REPLYING TO HAWKBIT")
+        elif self.pending_artifact:
+            # swupdate waits for the downloaded image, streamed to it
+            # from the cache once it is up
+            syslog("CONFIG: CACHED IMAGE")
+            if not delta.is_delta(self.pending_artifact):
+                self.installed_image = self.pending_artifact
+            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select]
+        elif self.pending_stream:
+            # swupdate waits for the image streamed from the URL
+            syslog("CONFIG: STREAMED IMAGE")
+            self.stream_installing = True
+            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select]
+        elif IMAGE in self.config and delta.is_delta(self.config[IMAGE]):
+            # swupdate waits for the image rebuilt from the delta, which
+            # is streamed to it once it is up
+            syslog("CONFIG: LOCAL DELTA IMAGE")
+            self.usb_local_update = True
+            self.pending_delta = self.config[IMAGE]
+            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select]
         elif IMAGE in self.config:
             syslog("CONFIG: LOCAL IMAGE")
+            self.installed_image = self.config[IMAGE]
             self.usb_local_update = True
             cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select, "-i", self.config[IMAGE]]
         else:
             syslog("CONFIG: SURICATTA MODE")
-            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select, "-u", '-i '+  self.device_name]
+            cmd = [SWUPDATE, "-f", SW_CONF_FILE_PATH, "-e", select, "-u", '-i '+  self.device_name + proxy]
 
         # If we've already started the swupdate thread, pass in the new command and
         # and restart swupdate.
         if self.swupdate_client == None:
-            self.swupdate_client = swuclient.SWUpdateClient(self.swupdate_handler, cmd)
+            self.swupdate_client = swuclient.SWUpdateClient(mainloop, self.swupdate_handler, cmd,
+                self.swupdate_circuit_handler, self.swupdate_progress, self.progress_layout,
+                self.swupdate_connected)
             self.swupdate_client.start()
         else:
             self.swupdate_client.set_command(cmd)
             self.swupdate_client.restart_swupdate()
-        if not self.usb_local_update:
-            now = datetime.datetime.now()
-            self.schedule_download_window(now)
+            self.metrics.counter('swupdate_restarts_total').inc()
+        if not self.usb_local_update and not self.stream_installing and self.installing_artifact is None:
+            self.schedule_download_window(time.time())
         return True
 
 
+    def schedule_window(self, schedule_list, ts_from):
+        '''
+        Return the deltas to the start and end of the next window of a
+        schedule, with the start spread by a stable per-device offset so
+        that a fleet sharing the schedule does not start at once.
+        '''
+        schedule = compile_schedule(schedule_list)
+        if self.schedule_spread > 0 and self.device_name:
+            return schedule.spread_window_at(ts_from,
+                spread_fraction(self.device_name), self.schedule_spread)
+        return schedule.window_at(ts_from)
+
     def schedule_reboot(self, update_list):
         '''
         Parse the update schedule to determine the delta of seconds
         until the next update window.
         '''
-        now = datetime.datetime.now()
-        delta_start, delta_end = next_schedule_window(now, update_list)
+        delta_start, delta_end = self.schedule_window(update_list, time.time())
         '''
         Start the reboot timer.  The snooze command will use this timer
         to snooze the reboot
         '''
         syslog('Rebooting in {} seconds.'.format(delta_start))
-        self.reboot_timer = resumetimer.ResumableTimer(delta_start, self.reboot)
-        self.reboot_timer.start()
+        if self.reboot_timer:
+            self.reboot_timer.cancel()
+        self.reboot_timer = mainloop.call_later(delta_start, self.reboot)
+        self.reboot_at = self.reboot_deadline()
         self.UpdatePending(UPDATE_SCHEDULED)
 
     def snooze_reboot(self, snooze_seconds):
@@ -375,46 +1136,107 @@ class SoftwareUpdate(UpdateService):
         If a reboot is schedule, stall the reboot for the specified time
         '''
         # No update if the reboot_timer isn't instantiated
-        if self.reboot_timer is None:
+        if self.reboot_timer is None or not self.reboot_timer.active():
             return -1
 
-        ret = self.reboot_timer.pause(snooze_seconds)
-        if ret == 0: # Snooze
-            self.UpdatePending(UPDATE_SNOOZED)
-        return ret
+        if snooze_seconds == 0:
+            # End the snooze
+            self.reboot_timer.resume()
+            self.journal.record({'reboot_deadline' : self.reboot_deadline()})
+            self.snooze_ended()
+            return 0
+        if self.reboot_timer.time_paused() + snooze_seconds > MAX_SNOOZE_SECONDS:
+            return -2
+        self.reboot_timer.pause(snooze_seconds)
+        self.journal.record({'reboot_deadline' : self.reboot_deadline()})
+        self.metrics.counter('snoozes_total').inc()
+        self.UpdatePending(UPDATE_SNOOZED)
+        if self.snooze_timer:
+            self.snooze_timer.cancel()
+        # Runs just after the reboot timer resumes
+        self.snooze_timer = mainloop.call_later(snooze_seconds, self.snooze_ended)
+        self.snooze_remaining = snooze_seconds
+        self.reboot_at = self.reboot_deadline()
+        self.update_properties()
+        return 0
+
+    def snooze_ended(self):
+        if self.snooze_timer:
+            self.snooze_timer.cancel()
+            self.snooze_timer = None
+        self.snooze_remaining = 0
+        self.reboot_at = self.reboot_deadline()
+        self.update_properties()
 
     def reboot(self):
         '''
         Use the IG's reboot command to initiate the reboot
         '''
 
+        if self.verifying is not None:
+            syslog('Rebooting once the installed volumes are verified')
+            self.reboot_waiting = True
+            return
+        self.metrics.end('reboot_wait')
+
+        # All environment changes are written together, so that a power
+        # loss cannot leave only some of them applied.
+        env = uboot_env.transaction()
         if self.switch_side:
-            self.data_migrate_success = data_migration()
+            self.data_migrate_success = self.migrate_data()
             if self.data_migrate_success:
                 if self.current_boot_side == 'a':
-                    set_env(BOOTSIDE, 'b')
-                    set_env(ALTBOOTCMD, 'setenv bootside a; saveenv; run bootcmd')
+                    env.set(BOOTSIDE, 'b')
+                    env.set(ALTBOOTCMD, 'setenv bootside a; saveenv; run bootcmd')
                 else:
-                    set_env(BOOTSIDE, 'a')
-                    set_env(ALTBOOTCMD, 'setenv bootside b; saveenv; run bootcmd')
+                    env.set(BOOTSIDE, 'a')
+                    env.set(ALTBOOTCMD, 'setenv bootside b; saveenv; run bootcmd')
 
 
         if self.data_migrate_success:
             self.UpdatePending(UPDATE_REBOOT)
-            set_env(UPGRADE_AVAILABLE, '1')
-            set_env(BOOTLIMIT, '5')
+            env.set(UPGRADE_AVAILABLE, '1')
+            env.set(BOOTLIMIT, '5')
+            env.set(REBOOT_TIME, str(int(time.time())))
+            if not env.commit():
+                # Some of the changes may have been written; make sure
+                # this side still boots, without the update
+                syslog('Failed to write the boot environment, not rebooting')
+                if not set_env_batch([(BOOTSIDE, self.current_boot_side), (UPGRADE_AVAILABLE, '0')]):
+                    syslog('Failed to restore the boot environment')
+                self.abandon_update(RESULT_ENV_FAILED)
+                return
+            syslog('Environment written in {:.3f} seconds, {} flash writes saved'.format(
+                uboot_env.last_write_latency, uboot_env.saved_writes))
+            self.journal.reset()
             reboot()
         else:
-            self.data_migrate_success = True
-            self.switch_side = False
-            self.update_state = NO_UPDATE_AVAILABLE
-            self.UpdatePending(UPDATE_FAILED)
-            self.updated_component.clear()
-            self.reboot_timer = None
-            if self.usb_local_update is True:
-                self.local_update_state_change(DEVICE_LED_FAILED)
-            else:
-                self.start_swupdate(True, SWUPDATE_FAILED)
+            self.abandon_update(RESULT_MIGRATION_FAILED)
+
+    def abandon_update(self, result):
+        '''
+        The installed update cannot be booted; stay on this side and
+        report the failure
+        '''
+        if self.reboot_timer is not None:
+            self.reboot_timer.cancel()
+        self.data_migrate_success = True
+        self.switch_side = False
+        self.verifying = None
+        self.reboot_waiting = False
+        self.update_state = NO_UPDATE_AVAILABLE
+        self.journal.reset()
+        self.UpdatePending(UPDATE_FAILED)
+        self.updated_component.clear()
+        self.reboot_timer = None
+        self.reboot_at = None
+        self.last_result = result
+        self.metrics.cancel('reboot_wait')
+        self.update_properties()
+        if self.usb_local_update is True:
+            self.local_update_state_change(DEVICE_LED_FAILED)
+        else:
+            self.start_swupdate(True, SWUPDATE_FAILED)
 
     def local_update_state_change(self, handler):
         if handler == DEVICE_LED_RESET and self.device_svc:
@@ -428,16 +1250,18 @@ class SoftwareUpdate(UpdateService):
     def download_start(self):
         syslog('Starting suricatta download.')
         self.swupdate_client.suricatta_enable(True)
+        self.resume_cached_download()
 
     def download_end(self):
         syslog('Stopping suricatta download.')
         self.swupdate_client.suricatta_enable(False)
+        if self.cached_download is not None:
+            self.cached_download.stop()
         # Schedule next window; add 30 seconds to make sure
         # the current window has ended
-        nowish = datetime.datetime.now() + datetime.timedelta(seconds=30)
-        self.schedule_download_window(nowish)
+        self.schedule_download_window(time.time() + 30)
 
-    def schedule_download_window(self, date_from):
+    def schedule_download_window(self, ts_from):
         # Stop existing timers
         if self.download_start_timer:
             self.download_start_timer.cancel()
@@ -445,17 +1269,194 @@ class SoftwareUpdate(UpdateService):
         if self.download_end_timer:
             self.download_end_timer.cancel()
             self.download_end_timer = None
+        if self.swupdate_client is None:
+            # Waiting to reboot into an update restored from the journal
+            return
         # Determine the window start and stop based on the current time
-        delta_start, delta_end = next_schedule_window(date_from, self.config.get(DOWNLOAD_SCHEDULE))
+        delta_start, delta_end = self.schedule_window(self.config.get(DOWNLOAD_SCHEDULE), ts_from)
         if delta_end > 0:
             self.swupdate_client.suricatta_enable(False)
             syslog('Scheduling download window from {} to {}.'.format(delta_start, delta_end))
-            self.download_start_timer = threading.Timer(delta_start,
-                self.download_start)
-            self.download_start_timer.start()
-            self.download_end_timer = threading.Timer(delta_end,
-                self.download_end)
-            self.download_end_timer.start()
+            self.download_start_timer = mainloop.call_later(delta_start, self.download_start)
+            self.download_end_timer = mainloop.call_later(delta_end, self.download_end)
+            now = time.time()
+            self.window_start = int(now + delta_start)
+            self.window_end = int(now + delta_end)
         else:
             syslog('Enabling suricatta.')
             self.swupdate_client.suricatta_enable(True)
+            self.resume_cached_download()
+            self.window_start = self.window_end = 0
+        self.update_properties()
+
+    def start_cached_download(self, download):
+        '''
+        Download an update image into the artifact cache during the
+        download windows, carrying on from where the last window (or
+        run) left off.  download is the 'download' block of a
+        configuration: url, and optionally sha256, the sha256 of each
+        chunk, the chunk size and, for a delta, fallback_url, the full
+        image to install if the delta cannot be rebuilt in time.
+        '''
+        url = download_url(download)
+        fallback_url = download.get('fallback_url')
+        if fallback_url is not None:
+            download_url({'url' : fallback_url})
+        chunks = download.get('chunks')
+        if chunks is not None and not isinstance(chunks, list):
+            raise ValueError('chunks must be a list of digests')
+        if self.cached_download is not None:
+            if self.cached_download.state['url'] == url:
+                return
+            self.cached_download.stop()
+        self.cached_download = artifactcache.RangeDownload(self.artifact_cache, url,
+            download.get('sha256'), chunks,
+            int(download.get('chunk_size', artifactcache.CACHE_CHUNK_SIZE)),
+            proxy=self.download_proxy(), fallback_url=fallback_url)
+        syslog('Caching download of {}'.format(url))
+        self.metrics.cancel('artifact_download')
+        self.metrics.begin('artifact_download')
+        self.update_state = UPDATES_IN_PROGRESS
+        self.UpdatePending(UPDATE_DOWNLOADING)
+        self.schedule_download_window(time.time())
+
+    def start_stream_install(self, download):
+        '''
+        Install the image at the URL of a 'download' block straight
+        away, streaming it into swupdate rather than storing it first
+        '''
+        url = download_url(download)
+        if self.update_state == UPDATES_IN_PROGRESS or self.swupdate_client is None:
+            raise ValueError('Cannot start an update now')
+        syslog('Streaming install of {}'.format(url))
+        self.pending_stream = url
+        self.start_swupdate()
+
+    def resume_cached_download(self):
+        download = self.cached_download
+        if download is None:
+            return
+        download.resume()
+        if self.cached_download_thread is not None and self.cached_download_thread.is_alive():
+            return
+
+        def fetch():
+            try:
+                if self.peer_cache is not None and not download.mirrors and download.state['sha256']:
+                    mirror = self.peer_cache.find(download.key)
+                    if mirror:
+                        syslog('Downloading {} from {}'.format(download.state['url'], mirror))
+                        download.mirrors.append(mirror)
+                path = download.run()
+            except artifactcache.CacheError as e:
+                syslog('Download of {} failed: {}'.format(download.state['url'], e))
+                glib.idle_add(self.cached_download_done, download, None)
+                return
+            if path is None:
+                return
+            if self.peer_cache is not None:
+                self.peer_cache.stats['bytes_from_peers'] += download.stats['mirror_bytes']
+                # Whatever it came from, it is checked before it is used
+                # or served to other gateways
+                if not self.peer_cache.verify(download.key):
+                    self.artifact_cache.remove(download.key)
+                    path = None
+            glib.idle_add(self.cached_download_done, download, path)
+
+        self.cached_download_thread = threading.Thread(target=fetch)
+        self.cached_download_thread.daemon = True
+        self.cached_download_thread.start()
+
+    def cached_download_done(self, download, path):
+        '''
+        Hand a completed download to swupdate
+        '''
+        if download is not self.cached_download:
+            return False
+        self.cached_download = None
+        if path is None:
+            self.artifact_cache.release(download.key)
+            self.metrics.cancel('artifact_download')
+            self.metrics.counter('artifact_downloads_failed_total').inc()
+            self.last_result = RESULT_FAILED
+            self.update_state = NO_UPDATE_AVAILABLE
+            self.update_properties()
+            return False
+        self.metrics.end('artifact_download')
+        # Released once swupdate reports the result, so that it cannot be
+        # evicted before swupdate has read it
+        self.pending_artifact = path
+        self.pending_fallback = download.state.get('fallback_url')
+        self.installing_artifact = download.key
+        self.start_swupdate()
+        return False
+
+    def start_peer_cache(self):
+        '''
+        Serve verified artifacts to, and find artifacts on, other
+        gateways on the LAN interface.  Artifacts from peers must pass
+        signature verification, so this needs the public key.
+        '''
+        if not self.public_key_file:
+            syslog('Peer cache needs globals.public-key-file; not started')
+            return
+        if not self.peer_interface:
+            syslog('Peer cache needs {}; not started'.format(PEER_INTERFACE_CFG_KEY))
+            return
+        try:
+            address = peercache.interface_address(self.peer_interface)
+            self.peer_cache = peercache.PeerCache(self.artifact_cache, self.public_key_file, address)
+            self.peer_cache.start()
+        except (IOError, OSError) as e:
+            syslog('Failed to start the peer cache on {}: {}'.format(self.peer_interface, e))
+            if self.peer_cache is not None:
+                self.peer_cache.stop()
+            self.peer_cache = None
+
+    def download_proxy(self):
+        '''
+        Return the URL of the relay that shapes downloads, starting it
+        the first time downloads are limited, or None
+        '''
+        if self.relay is None and (self.download_rate or self.download_rates):
+            try:
+                self.relay = shaper.RelayProxy(self.rate_bucket)
+                self.relay.start()
+            except (IOError, OSError) as e:
+                syslog('Failed to start the download relay: {}'.format(e))
+                return None
+        return self.relay.url() if self.relay is not None else None
+
+    def set_download_rates(self, rate, rates):
+        '''
+        Change the download rates, including for downloads in progress
+        '''
+        shaper.check_rates(rates)
+        if rate < 0:
+            raise ValueError('Download rate must be 0 or more')
+        self.download_rate = rate
+        self.download_rates = rates
+        shaper.save_rates(self.write_cfg_path, rate, rates)
+        syslog('igupd: process_config: download rate modified successfully: {}, {}'.format(rate, rates))
+        started = self.relay is None
+        self.apply_download_rate()
+        if started and self.download_proxy() and self.swupdate_client is not None and \
+                self.update_state != UPDATES_IN_PROGRESS and not self.usb_local_update and \
+                not self.stream_installing:
+            # Restart swupdate to download through the relay
+            self.start_swupdate(False)
+
+    def apply_download_rate(self):
+        '''
+        Set the rate for the current download rate window, and again
+        when the next window starts or ends
+        '''
+        if self.rate_timer:
+            self.rate_timer.cancel()
+            self.rate_timer = None
+        rate, change = shaper.scheduled_rate(self.download_rates, self.download_rate, time.time())
+        if rate != self.rate_bucket.rate:
+            syslog('Download rate: {}'.format('{} bytes/s'.format(rate) if rate else 'unlimited'))
+            self.rate_bucket.set_rate(rate)
+        if change is not None:
+            self.rate_timer = mainloop.call_later(change, self.apply_download_rate)
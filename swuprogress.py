@@ -0,0 +1,287 @@
+#
+# swuprogress.py - Decoding of the swupdate progress socket stream
+#
+import time
+import struct
+import collections
+
+import sys
+PYTHON3 = sys.version_info >= (3, 0)
+
+SWU_STATUS_IDLE=0
+SWU_STATUS_START=1
+SWU_STATUS_RUN=2
+SWU_STATUS_SUCCESS=3
+SWU_STATUS_FAILURE=4
+SWU_STATUS_DOWNLOAD=5
+SWU_STATUS_DONE=6
+SWU_STATUS_SUBPROCESS=7
+SWU_STATUS_BAD_CMD=8
+
+# struct progress_msg from swupdate's progress_ipc.h:
+#   magic, status, dwl_percent, nsteps, cur_step, cur_percent,
+#   cur_image[256], hnd_name[64], source, infolen, info[2048]
+PROGRESS_MSG = struct.Struct('=IiIIII256s64siI2048s')
+PROGRESS_MSG_SIZE = PROGRESS_MSG.size
+PROGRESS_FIELDS = ('magic', 'status', 'dwl_percent', 'nsteps', 'cur_step',
+    'cur_percent', 'cur_image', 'hnd_name', 'source', 'infolen', 'info')
+
+# Later swupdate releases add the total download size after dwl_percent
+PROGRESS_MSG_DWL_BYTES = struct.Struct('=IiI4xQIII256s64siI2048s4x')
+PROGRESS_FIELDS_DWL_BYTES = ('magic', 'status', 'dwl_percent', 'dwl_bytes', 'nsteps',
+    'cur_step', 'cur_percent', 'cur_image', 'hnd_name', 'source', 'infolen', 'info')
+
+PROGRESS_LAYOUT_LEGACY = 'legacy'
+PROGRESS_LAYOUT_DWL_BYTES = 'dwl_bytes'
+PROGRESS_LAYOUTS = {
+    PROGRESS_LAYOUT_LEGACY : (PROGRESS_MSG, PROGRESS_FIELDS),
+    PROGRESS_LAYOUT_DWL_BYTES : (PROGRESS_MSG_DWL_BYTES, PROGRESS_FIELDS_DWL_BYTES),
+}
+
+PROGRESS_FIELD_STATUS = 1
+PROGRESS_FIELD_CUR_IMAGE = 6
+PROGRESS_FIELD_INFOLEN = 9
+PROGRESS_FIELD_INFO = 10
+
+# Number of whole messages the receive buffer can hold
+PROGRESS_BUFFER_FRAMES = 8
+
+# Samples older than this (seconds) are dropped from the rate estimate
+ESTIMATOR_WINDOW = 30
+# Default maximum number of progress signals per second
+PROGRESS_RATE = 1.0
+
+
+def decode_string(raw, length=None):
+    '''
+    Convert a fixed size, NUL padded C string field to a str
+    '''
+    if length is not None:
+        raw = raw[:length]
+    raw = raw.split(b'\x00', 1)[0]
+    if PYTHON3:
+        return raw.decode('utf-8', 'replace')
+    return raw
+
+
+class ProgressReader(object):
+    '''
+    Reassemble whole progress messages from the swupdate progress
+    socket.  The stream has no framing of its own, so a single read
+    may return part of a message or several of them.  Data is received
+    with recv_into directly into a preallocated buffer and messages are
+    unpacked in place with a precompiled Struct.
+    '''
+    def __init__(self, sock, frames=PROGRESS_BUFFER_FRAMES, msg=PROGRESS_MSG):
+        self.sock = sock
+        self.msg = msg
+        self.buf = bytearray(msg.size * frames)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        '''
+        Return the number of buffered bytes not yet forming a message
+        '''
+        return self.end - self.start
+
+    def read_frames(self):
+        '''
+        Perform a single receive and return the list of raw field tuples
+        for every message completed by it.  Returns None when the peer
+        has closed the connection.
+        '''
+        size = self.msg.size
+        if len(self.buf) - self.end < size:
+            # Move the trailing partial message to the front of the buffer
+            remain = self.end - self.start
+            self.view[0:remain] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remain
+
+        nbytes = self.sock.recv_into(self.view[self.end:])
+        if not nbytes:
+            return None
+        self.end += nbytes
+
+        frames = []
+        while self.end - self.start >= size:
+            frames.append(self.msg.unpack_from(self.buf, self.start))
+            self.start += size
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frames
+
+
+class Progress(object):
+    '''
+    Decoded swupdate progress message.  dwl_bytes is None unless
+    swupdate reports the download size.
+    '''
+    def __init__(self, status=SWU_STATUS_IDLE, dwl_percent=0, dwl_bytes=None,
+                 nsteps=0, cur_step=0, cur_percent=0, cur_image='',
+                 hnd_name='', source=0, info=''):
+        self.status = status
+        self.dwl_percent = dwl_percent
+        self.dwl_bytes = dwl_bytes
+        self.nsteps = nsteps
+        self.cur_step = cur_step
+        self.cur_percent = cur_percent
+        self.cur_image = cur_image
+        self.hnd_name = hnd_name
+        self.source = source
+        self.info = info
+
+    @classmethod
+    def from_fields(cls, fields, names=PROGRESS_FIELDS):
+        values = dict(zip(names, fields))
+        return cls(status=values['status'],
+            dwl_percent=values['dwl_percent'],
+            dwl_bytes=values.get('dwl_bytes'),
+            nsteps=values['nsteps'],
+            cur_step=values['cur_step'],
+            cur_percent=values['cur_percent'],
+            cur_image=decode_string(values['cur_image']),
+            hnd_name=decode_string(values['hnd_name']),
+            source=values['source'],
+            info=decode_string(values['info'], values['infolen']))
+
+    def install_percent(self):
+        '''
+        Return the overall install progress across all steps
+        '''
+        if not self.nsteps:
+            return 0.0
+        step = max(self.cur_step - 1, 0)
+        return min(100.0 * (step + self.cur_percent / 100.0) / self.nsteps, 100.0)
+
+    def downloaded_bytes(self):
+        if not self.dwl_bytes:
+            return None
+        return self.dwl_bytes * self.dwl_percent // 100
+
+    def as_dict(self, estimator=None):
+        '''
+        Return the progress as a dict suitable for a D-Bus a{sv}
+        '''
+        progress = {
+            'status' : self.status,
+            'step' : self.cur_step,
+            'steps' : self.nsteps,
+            'percent' : self.cur_percent,
+            'install_percent' : self.install_percent(),
+            'download_percent' : self.dwl_percent,
+            'download_bytes' : self.dwl_bytes if self.dwl_bytes is not None else -1,
+            'image' : self.cur_image,
+            'handler' : self.hnd_name,
+        }
+        if estimator is not None:
+            progress['rate'] = estimator.rate()
+            progress['eta'] = estimator.eta()
+        return progress
+
+
+class ProgressEstimator(object):
+    '''
+    Rolling throughput and ETA estimate for the current phase.  While
+    downloading the rate is in bytes per second if swupdate reports the
+    download size, otherwise in percent per second; while installing it
+    is in percent of the overall install per second.
+    '''
+    def __init__(self, window=ESTIMATOR_WINDOW, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.samples = collections.deque()
+        self.phase = None
+        self.total = 0
+
+    def measure(self, progress):
+        if progress.status == SWU_STATUS_DOWNLOAD:
+            if progress.dwl_bytes:
+                return 'download', progress.downloaded_bytes(), progress.dwl_bytes
+            return 'download', progress.dwl_percent, 100
+        if progress.status == SWU_STATUS_RUN and progress.nsteps:
+            return 'install', progress.install_percent(), 100
+        return None, 0, 0
+
+    def update(self, progress):
+        phase, done, total = self.measure(progress)
+        if phase != self.phase:
+            self.samples.clear()
+            self.phase = phase
+        if phase is None:
+            return
+        now = self.clock()
+        self.total = total
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def rate(self):
+        '''
+        Return the progress rate per second, or 0.0 if unknown
+        '''
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, d0), (t1, d1) = self.samples[0], self.samples[-1]
+        if t1 <= t0 or d1 <= d0:
+            return 0.0
+        return float(d1 - d0) / (t1 - t0)
+
+    def eta(self):
+        '''
+        Return the estimated seconds until the phase completes, or -1.0
+        if unknown
+        '''
+        rate = self.rate()
+        if rate <= 0:
+            return -1.0
+        return max(self.total - self.samples[-1][1], 0) / rate
+
+
+class ProgressThrottle(object):
+    '''
+    Coalesce progress updates so that the handler is called at most
+    rate times a second.  The latest update is always delivered, either
+    immediately or from a main loop timer; urgent updates (e.g. a status
+    change) are delivered immediately.
+    '''
+    def __init__(self, loop, handler, rate=PROGRESS_RATE, clock=time.time):
+        self.loop = loop
+        self.handler = handler
+        self.clock = clock
+        self.interval = 1.0 / rate
+        self.last_emit = 0
+        self.latest = None
+        self.timer_id = None
+        self.updates = 0
+        self.emitted = 0
+
+    def set_rate(self, rate):
+        self.interval = 1.0 / rate
+
+    def update(self, value, urgent=False):
+        self.updates += 1
+        self.latest = value
+        now = self.clock()
+        if urgent or now - self.last_emit >= self.interval:
+            if self.timer_id is not None:
+                self.loop.cancel(self.timer_id)
+                self.timer_id = None
+            self.emit(now)
+        elif self.timer_id is None:
+            self.timer_id = self.loop.call_later(self.last_emit + self.interval - now, self.flush)
+
+    def flush(self):
+        self.timer_id = None
+        if self.latest is not None:
+            self.emit(self.clock())
+
+    def emit(self, now):
+        value = self.latest
+        self.latest = None
+        self.last_emit = now
+        self.emitted += 1
+        self.handler(value)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import artifactcache
+
+CHUNK = 4096
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    '''
+    Serve the artifacts of the server, dropping each connection after
+    drop_after bytes
+    '''
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        data = server.artifacts.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and server.ranges:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(data).hexdigest()))
+        self.end_headers()
+        body = data[start:]
+        if server.corrupt:
+            # Flip a byte in the first chunk sent, once
+            server.corrupt = False
+            body = bytearray(body)
+            body[10] ^= 0xff
+            body = bytes(body)
+        if server.drop_after:
+            body = body[:server.drop_after]
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FlakyServer(HTTPServer):
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FlakyHandler)
+        self.artifacts = {}
+        self.drop_after = 0
+        self.ranges = True
+        self.corrupt = False
+        self.requests = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def chunk_digests(data, chunk_size=CHUNK):
+    return [hashlib.sha256(data[i:i + chunk_size]).hexdigest()
+            for i in range(0, len(data), chunk_size)]
+
+
+class ArtifactCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = FlakyServer()
+        self.data = os.urandom(10 * CHUNK + 123)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.server.artifacts['/update.swu'] = self.data
+        self.url = self.server.url('/update.swu')
+        self.cache = artifactcache.ArtifactCache(self.tmpdir, 64 * CHUNK)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, **kwargs):
+        kwargs.setdefault('sha256', self.sha256)
+        kwargs.setdefault('chunks', chunk_digests(self.data))
+        return artifactcache.RangeDownload(self.cache, self.url, chunk_size=CHUNK, timeout=5, **kwargs)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_resume_after_drops(self):
+        self.server.drop_after = 3 * CHUNK + 100
+        download = self.download()
+        path = download.run(retry_min=0, retry_max=0)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(download.stats['resumes'], 3)
+        self.assertEqual(download.stats['requests'], 4)
+        # Only the partial chunk at each drop is downloaded twice
+        self.assertEqual(download.stats['downloaded_bytes'], len(self.data) + 3 * 100)
+        self.assertEqual(self.cache.pending()[0]['key'], self.sha256)
+
+    def test_resume_after_restart(self):
+        self.server.drop_after = 4 * CHUNK
+        download = self.download()
+        download.offset = download.recover()
+        self.assertRaises(IOError, download.fetch)
+        self.assertEqual(download.offset, 4 * CHUNK)
+
+        # A power loss tore the last chunk written
+        with open(download.path, 'r+b') as f:
+            f.seek(3 * CHUNK + 5)
+            f.write(b'torn')
+        self.server.drop_after = 0
+        download = self.download()
+        path = download.run(retry_min=0)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(download.stats['resumed_bytes'], 3 * CHUNK)
+        self.assertEqual(download.stats['downloaded_bytes'], len(self.data) - 3 * CHUNK)
+
+    def test_fallback_url(self):
+        # The full image for a delta is kept for a download resumed
+        # after a restart
+        self.download(fallback_url=self.server.url('/update-full.swu'))
+        self.assertEqual(self.cache.pending()[0]['fallback_url'], self.server.url('/update-full.swu'))
+
+    def test_bad_chunk(self):
+        self.server.corrupt = True
+        download = self.download()
+        path = download.run(retry_min=0)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(download.stats['chunk_failures'], 1)
+
+    def test_no_ranges(self):
+        # Without range support each attempt starts again
+        self.server.drop_after = 4 * CHUNK
+        self.server.ranges = False
+        download = self.download(chunks=None)
+        download.offset = download.recover()
+        self.assertRaises(IOError, download.fetch)
+        self.server.drop_after = 0
+        path = download.run(retry_min=0)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(download.stats['restarts'], 1)
+
+    def test_digest_mismatch(self):
+        download = self.download(sha256='0' * 64, chunks=None)
+        self.assertRaises(artifactcache.CacheError, download.run, 0)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_not_found(self):
+        self.url = self.server.url('/missing.swu')
+        self.assertRaises(artifactcache.CacheError, self.download(sha256=None).run, 0)
+
+    def test_stop(self):
+        download = self.download()
+        download.stop()
+        self.assertIsNone(download.run())
+        self.assertEqual(self.server.requests, 0)
+        download.resume()
+        self.assertEqual(self.read(download.run()), self.data)
+
+    def test_lru_eviction(self):
+        self.cache.budget = 2 * len(self.data)
+        paths = {}
+        for name in ('a', 'b', 'c'):
+            self.server.artifacts['/' + name] = os.urandom(len(self.data))
+            download = artifactcache.RangeDownload(self.cache, self.server.url('/' + name), chunk_size=CHUNK)
+            paths[name] = download.run()
+            self.cache.release(download.key)
+            if name == 'b':
+                # Use a again, so that b is the least recently used
+                artifactcache.RangeDownload(self.cache, self.server.url('/a'), chunk_size=CHUNK).run()
+        self.assertTrue(os.path.exists(paths['a']))
+        self.assertFalse(os.path.exists(paths['b']))
+        self.assertTrue(os.path.exists(paths['c']))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.assertLessEqual(self.cache.used_bytes(), self.cache.budget)
+
+        self.cache.budget = len(self.data) - 1
+        self.assertRaises(artifactcache.CacheError, self.download().run, 0)
+
+    def test_installing_not_evicted(self):
+        self.cache.budget = len(self.data)
+        self.server.artifacts['/b'] = os.urandom(len(self.data))
+        # Downloaded, but swupdate has not reported the result of its install
+        path = self.download().run()
+        artifactcache.RangeDownload(self.cache, self.server.url('/b'), chunk_size=CHUNK).run()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.cache.stats['evictions'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import hashlib
+import io
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import delta
+import swuctrl
+
+BLOCK = 1024
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class FakeSwupdate(threading.Thread):
+    '''
+    Accept one install request on a control socket and collect the image
+    '''
+    def __init__(self, address, ack=True):
+        super(FakeSwupdate, self).__init__()
+        self.daemon = True
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(1)
+        self.ack = ack
+        self.request = None
+        self.image = b''
+
+    def run(self):
+        conn, addr = self.server.accept()
+        data = b''
+        while len(data) < swuctrl.SWUPDATE_MSG.size:
+            data += conn.recv(swuctrl.SWUPDATE_MSG.size - len(data))
+        self.request = swuctrl.SWUPDATE_MSG.unpack(data)
+        reply = swuctrl.SWUPDATE_MSG_ACK if self.ack else swuctrl.SWUPDATE_MSG_NACK
+        conn.sendall(swuctrl.SWUPDATE_MSG.pack(swuctrl.SWUPDATE_MAGIC, reply, 0, 0, 0, 0, b''))
+        while self.ack:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            self.image += chunk
+        conn.close()
+        self.server.close()
+
+
+class DeltaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rnd = random.Random(19)
+        self.kernel = os.path.join(self.tmpdir, 'ubi0_0')
+        self.rootfs = os.path.join(self.tmpdir, 'ubi0_1')
+        kernel = bytes(rnd.getrandbits(8) for i in range(64 * BLOCK))
+        rootfs = bytearray(rnd.getrandbits(8) for i in range(256 * BLOCK))
+        # The volumes are larger than their images
+        write(self.kernel, kernel + b'\xff' * 16 * BLOCK)
+        write(self.rootfs, bytes(rootfs) + b'\xff' * 16 * BLOCK)
+
+        # The new .swu: an unaligned header, the rootfs with a few blocks
+        # changed and some bytes inserted, and the unchanged kernel
+        rootfs[10 * BLOCK:12 * BLOCK] = os.urandom(2 * BLOCK)
+        rootfs[100 * BLOCK:100 * BLOCK] = b'inserted'
+        self.target_data = b'070701' + os.urandom(301) + bytes(rootfs) + b'\0\0' + kernel + b'TRAILER!!!'
+        self.target = os.path.join(self.tmpdir, 'update.swu')
+        write(self.target, self.target_data)
+        self.sources = [self.kernel, self.rootfs]
+
+        self.artifact = os.path.join(self.tmpdir, 'update' + delta.DELTA_SUFFIX)
+        with open(self.artifact, 'wb') as f:
+            self.literal_bytes = delta.make_delta(self.sources, self.target, f, BLOCK)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rolling_hash(self):
+        data = os.urandom(3 * BLOCK)
+        a, b = delta.weak_parts(data[:BLOCK])
+        for pos in range(1, 2 * BLOCK):
+            x_out = data[pos - 1]
+            a = (a - x_out + data[pos + BLOCK - 1]) % delta.WEAK_MOD
+            b = (b - BLOCK * x_out + a) % delta.WEAK_MOD
+            if pos % 97 == 0:
+                self.assertEqual((b << 16) | a, delta.weak_hash(data[pos:pos + BLOCK]))
+
+    def test_reconstruct(self):
+        self.assertTrue(delta.is_delta(self.artifact))
+        self.assertFalse(delta.is_delta(self.target))
+        # Only the changed blocks, those around the changes and the
+        # unaligned ends are sent
+        self.assertLess(self.literal_bytes, 12 * BLOCK)
+
+        # Once every block has been found the other volumes are not read
+        spare = os.path.join(self.tmpdir, 'ubi0_2')
+        write(spare, os.urandom(64 * BLOCK))
+        out = io.BytesIO()
+        with open(self.artifact, 'rb') as f:
+            stats = delta.DeltaReconstructor(self.sources + [spare]).apply(f, out)
+        self.assertEqual(out.getvalue(), self.target_data)
+        self.assertEqual(stats['target_bytes'], len(self.target_data))
+        self.assertEqual(stats['downloaded_bytes'], os.path.getsize(self.artifact))
+        self.assertEqual(stats['saved_bytes'], len(self.target_data) - os.path.getsize(self.artifact))
+        self.assertGreater(stats['saved_bytes'], 0.9 * len(self.target_data))
+        self.assertEqual(stats['scanned_bytes'], os.path.getsize(self.kernel) + os.path.getsize(self.rootfs))
+
+    def test_missing_blocks(self):
+        # The running side is not what the delta was made against
+        with open(self.rootfs, 'r+b') as f:
+            f.seek(200 * BLOCK)
+            f.write(os.urandom(BLOCK))
+        with open(self.artifact, 'rb') as f:
+            self.assertRaises(delta.DeltaError,
+                delta.DeltaReconstructor(self.sources).apply, f, io.BytesIO())
+
+        # Missing blocks can be fetched instead
+        fetched = []
+        def fetch(index, strong):
+            fetched.append(index)
+            return self.target_data[index * BLOCK:(index + 1) * BLOCK]
+        out = io.BytesIO()
+        with open(self.artifact, 'rb') as f:
+            stats = delta.DeltaReconstructor(self.sources, fetch).apply(f, out)
+        self.assertEqual(out.getvalue(), self.target_data)
+        self.assertTrue(1 <= len(fetched) <= 2)
+        self.assertEqual(stats['downloaded_bytes'],
+            os.path.getsize(self.artifact) + len(fetched) * BLOCK)
+
+    def test_roll_window(self):
+        # Data that has moved, far from any match, is not rolled
+        # through; it is sent in the artifact instead
+        moved = os.urandom(32 * BLOCK)
+        write(self.rootfs, self.target_data[:32 * BLOCK] + os.urandom(128 * BLOCK + 13) + moved)
+        write(self.target, self.target_data[:32 * BLOCK] + moved)
+        with open(self.artifact, 'wb') as f:
+            literal_bytes = delta.make_delta([self.rootfs], self.target, f, BLOCK)
+        self.assertEqual(literal_bytes, 32 * BLOCK)
+        out = io.BytesIO()
+        with open(self.artifact, 'rb') as f:
+            delta.DeltaReconstructor([self.rootfs]).apply(f, out)
+        self.assertEqual(out.getvalue(), self.target_data[:32 * BLOCK] + moved)
+
+    def test_scan_time_limit(self):
+        out = io.BytesIO()
+        with open(self.artifact, 'rb') as f:
+            self.assertRaises(delta.DeltaScanLimit,
+                delta.DeltaReconstructor(self.sources, time_limit=0).apply, f, out)
+        # Nothing was written, so the full image can be sent instead
+        self.assertEqual(out.getvalue(), b'')
+
+    def test_scan_rate(self):
+        # A volume with nothing in common with the target, hashed at
+        # every offset in Python, took seconds per megabyte
+        volume = os.path.join(self.tmpdir, 'ubi0_2')
+        write(volume, os.urandom(8 << 20))
+        wanted = {}
+        for i in range(2048):
+            data = os.urandom(delta.DELTA_BLOCK_SIZE)
+            wanted.setdefault(delta.weak_hash(data), set()).add(hashlib.sha256(data).digest())
+        index = delta.ChunkIndex()
+        start = time.time()
+        index.scan(volume, wanted)
+        elapsed = time.time() - start
+        self.assertEqual(index.scanned_bytes, 8 << 20)
+        self.assertEqual(index.found, {})
+        # At least 4 MB/s
+        self.assertLess(elapsed, 2.0)
+
+    def test_stream_to_swupdate(self):
+        address = os.path.join(self.tmpdir, 'sockinstctrl')
+        server = FakeSwupdate(address)
+        server.start()
+        stream = swuctrl.InstallStream(address).open()
+        with open(self.artifact, 'rb') as f:
+            delta.DeltaReconstructor(self.sources).apply(f, stream)
+        stream.close()
+        server.join(5)
+        self.assertEqual(server.request[1], swuctrl.SWUPDATE_MSG_REQ_INSTALL)
+        self.assertEqual(server.request[2], swuctrl.SWUPDATE_SRC_LOCAL)
+        self.assertEqual(server.image, self.target_data)
+        self.assertEqual(stream.bytes_written, len(self.target_data))
+
+    def test_install_refused(self):
+        address = os.path.join(self.tmpdir, 'sockinstctrl')
+        server = FakeSwupdate(address, ack=False)
+        server.start()
+        self.assertRaises(IOError, swuctrl.InstallStream(address).open)
+        server.join(5)
+
+if __name__ == '__main__':
+    unittest.main()
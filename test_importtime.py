@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+# Budgets for the cumulative import time of each module, in
+# microseconds, measured with python -X importtime.  Set
+# IGUPD_IMPORT_BUDGET_SCALE to scale them on slower targets.
+IMPORT_TIME_BUDGET = {
+    'swupd' : 400000,
+    'schedule' : 100000,
+    'multihash' : 100000,
+    'procrun' : 100000,
+    'artifactcache' : 100000,
+    'streaminstall' : 100000,
+    'peercache' : 100000,
+    'metrics' : 100000,
+}
+
+# Only loaded on first use, never by importing the entry point
+LAZY_MODULES = ('psutil', 'pyudev', 'pylibconfig', 'concurrent.futures', 'urllib.request')
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module):
+    '''
+    Import module in a fresh interpreter and return a dict of the
+    cumulative import time of every module loaded, or None if the import
+    failed (e.g. missing dependencies)
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=here, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    times = {}
+    for line in err.decode('utf-8', 'replace').splitlines():
+        m = IMPORT_LINE.match(line)
+        if m:
+            times[m.group(4)] = int(m.group(2))
+    return times
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def check_budget(self, module):
+        times = import_times(module)
+        if times is None:
+            self.skipTest('{} cannot be imported here'.format(module))
+        scale = float(os.environ.get('IGUPD_IMPORT_BUDGET_SCALE', '1'))
+        budget = IMPORT_TIME_BUDGET[module] * scale
+        self.assertLessEqual(times[module], budget,
+            '{} took {} us to import (budget {:.0f} us)'.format(module, times[module], budget))
+        for lazy in LAZY_MODULES:
+            self.assertNotIn(lazy, times, '{} imports {}'.format(module, lazy))
+
+    def test_entry_point(self):
+        self.check_budget('swupd')
+
+    def test_helpers(self):
+        for module in ('schedule', 'multihash', 'procrun', 'artifactcache', 'streaminstall', 'peercache', 'metrics'):
+            self.check_budget(module)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+
+
+class FakeLoop(object):
+    def __init__(self):
+        self.timers = {}
+        self.next_id = 1
+
+    def call_later(self, seconds, callback, *args):
+        timer_id = self.next_id
+        self.next_id += 1
+        self.timers[timer_id] = (callback, args)
+        return timer_id
+
+    def cancel(self, timer_id):
+        del self.timers[timer_id]
+
+    def run_timers(self):
+        timers = list(self.timers.values())
+        self.timers.clear()
+        for callback, args in timers:
+            callback(*args)
+
+
+class StateJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'igupd', journal.JOURNAL_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        j = journal.StateJournal(self.path)
+        self.assertEqual(j.replay(), {})
+        j.record({'update_state' : 2})
+        j.record({'update_state' : 3, 'switch_side' : True, 'reboot_deadline' : 1700000000.5})
+        state = journal.StateJournal(self.path).replay()
+        self.assertEqual(state, {'update_state' : 3, 'switch_side' : True,
+                                 'reboot_deadline' : 1700000000.5})
+
+    def test_batched_sync(self):
+        loop = FakeLoop()
+        j = journal.StateJournal(self.path, loop)
+        for i in range(5):
+            j.record({'count' : i})
+        # Nothing written until the sync timer runs, which syncs once
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(len(loop.timers), 1)
+        loop.run_timers()
+        self.assertEqual(j.stats['syncs'], 1)
+        self.assertEqual(journal.StateJournal(self.path).replay(), {'count' : 4})
+        # An urgent change is synced at once
+        j.record({'installed' : True}, sync=True)
+        self.assertEqual(loop.timers, {})
+        self.assertEqual(journal.StateJournal(self.path).replay(), {'count' : 4, 'installed' : True})
+
+    def test_torn_tail(self):
+        j = journal.StateJournal(self.path)
+        j.record({'a' : 1})
+        j.record({'b' : 2})
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # Power lost part way through the last record
+        with open(self.path, 'wb') as f:
+            f.write(data[:-5])
+        j = journal.StateJournal(self.path)
+        self.assertEqual(j.replay(), {'a' : 1})
+        self.assertEqual(j.stats['damaged'], 1)
+        j.record({'c' : 3})
+        self.assertEqual(journal.StateJournal(self.path).replay(), {'a' : 1, 'c' : 3})
+
+        # A corrupted checksum is also rejected
+        with open(self.path, 'ab') as f:
+            f.write(journal.encode_record({'d' : 4}).replace(b'4', b'5'))
+        self.assertEqual(journal.StateJournal(self.path).replay(), {'a' : 1, 'c' : 3})
+
+    def test_compaction_and_reset(self):
+        j = journal.StateJournal(self.path, max_records=4)
+        for i in range(10):
+            j.record({'count' : i, 'key%d' % (i % 2) : i})
+        with open(self.path, 'rb') as f:
+            self.assertLessEqual(len(f.readlines()), 4)
+        self.assertGreater(j.stats['compactions'], 0)
+        self.assertEqual(journal.StateJournal(self.path).replay(),
+                         {'count' : 9, 'key0' : 8, 'key1' : 9})
+        j.reset()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(journal.StateJournal(self.path).replay(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import metrics
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = metrics.Registry(clock=self.clock)
+
+    def test_counters(self):
+        counter = self.registry.counter('updates_total', 'Updates')
+        counter.inc()
+        # The same metric is returned on later use
+        self.registry.counter('updates_total').inc(2)
+        gauge = self.registry.gauge('state')
+        gauge.set(3)
+        gauge.dec()
+        self.assertEqual(self.registry.snapshot(), {'igupd_updates_total' : 3, 'igupd_state' : 2})
+        self.assertRaises(ValueError, self.registry.gauge, 'updates_total')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('phase_seconds', buckets=(1, 10, 100))
+        for value in (0.5, 1, 5, 50, 500):
+            histogram.observe(value)
+        snapshot = self.registry.snapshot()
+        # Buckets are cumulative and include their bound
+        self.assertEqual(snapshot['igupd_phase_seconds_bucket.le.1'], 2)
+        self.assertEqual(snapshot['igupd_phase_seconds_bucket.le.10'], 3)
+        self.assertEqual(snapshot['igupd_phase_seconds_bucket.le.100'], 4)
+        self.assertEqual(snapshot['igupd_phase_seconds_bucket.le.+Inf'], 5)
+        self.assertEqual(snapshot['igupd_phase_seconds_count'], 5)
+        self.assertAlmostEqual(snapshot['igupd_phase_seconds_sum'], 556.5)
+
+    def test_phases(self):
+        self.registry.begin('install')
+        self.clock.now += 42
+        self.assertEqual(self.registry.end('install'), 42)
+        self.assertIsNone(self.registry.end('install'))
+        self.registry.begin('download')
+        self.registry.cancel('download')
+        self.assertIsNone(self.registry.end('download'))
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['igupd_install_seconds_count'], 1)
+        self.assertEqual(snapshot['igupd_install_seconds_bucket.le.30'], 0)
+        self.assertEqual(snapshot['igupd_install_seconds_bucket.le.60'], 1)
+        self.assertNotIn('igupd_download_seconds_count', snapshot)
+
+    def test_collector(self):
+        restarts = [0]
+        self.registry.add_collector(lambda: setattr(self.registry.counter('restarts_total'),
+            'value', restarts[0]))
+        restarts[0] = 4
+        self.assertEqual(self.registry.snapshot()['igupd_restarts_total'], 4)
+
+        def broken():
+            raise KeyError('gone')
+
+        # A failing collector does not stop the others being read
+        self.registry.add_collector(broken)
+        self.assertEqual(self.registry.snapshot()['igupd_restarts_total'], 4)
+
+    def test_set_stats(self):
+        self.registry.set_stats('proc_fw_printenv', {'calls' : 3, 'max_duration' : 0.5})
+        self.registry.set_stats('', {'startup.time_to_ready' : 2.5, 'active' : True, 'url' : 'x'})
+        self.assertEqual(self.registry.snapshot(), {
+            'igupd_proc_fw_printenv_calls' : 3,
+            'igupd_proc_fw_printenv_max_duration' : 0.5,
+            'igupd_startup_time_to_ready' : 2.5,
+            'igupd_active' : 1,
+        })
+        self.assertEqual(self.registry.metrics['igupd_active'].kind, metrics.GAUGE)
+
+    def test_prometheus(self):
+        self.registry.counter('updates_total', 'Updates installed').inc()
+        self.registry.histogram('update_seconds', buckets=(10, 60)).observe(12.5)
+        self.assertEqual(self.registry.prometheus_text().splitlines(), [
+            '# HELP igupd_updates_total Updates installed',
+            '# TYPE igupd_updates_total counter',
+            'igupd_updates_total 1',
+            '# TYPE igupd_update_seconds histogram',
+            'igupd_update_seconds_bucket{le="10"} 0',
+            'igupd_update_seconds_bucket{le="60"} 1',
+            'igupd_update_seconds_bucket{le="+Inf"} 1',
+            'igupd_update_seconds_sum 12.5',
+            'igupd_update_seconds_count 1',
+        ])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'igupd.prom')
+            self.assertTrue(self.registry.write_prometheus(path))
+            # Unchanged metrics are not written again
+            self.assertFalse(self.registry.write_prometheus(path))
+            self.registry.counter('updates_total').inc()
+            self.assertTrue(self.registry.write_prometheus(path))
+            with open(path) as f:
+                self.assertIn('igupd_updates_total 2\n', f.read())
+            self.assertEqual(os.listdir(tmpdir), ['igupd.prom'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_overhead(self):
+        # Counting a progress message must be cheap next to handling it
+        counter = self.registry.counter('progress_messages_total')
+        start = time.time()
+        for i in range(100000):
+            counter.inc()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(counter.value, 100000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import migrate
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def tree(root):
+    result = {}
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                result[os.path.relpath(path, root)] = f.read()
+    return result
+
+
+class DataMigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'data')
+        self.dst = os.path.join(self.tmpdir, 'other')
+        os.makedirs(self.dst)
+        write(os.path.join(self.src, 'public', 'igupd', 'update_schedule.conf'), b'{}')
+        write(os.path.join(self.src, 'secret', 'big.db'), os.urandom(256 * 1024))
+        write(os.path.join(self.src, 'secret', 'small'), b'small')
+        os.symlink('secret/small', os.path.join(self.src, 'link'))
+        self.manifest = os.path.join(self.src, 'public', 'igupd', 'migrate.manifest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prestage_then_delta(self):
+        migration = migrate.DataMigration(self.src, self.dst, self.manifest)
+        stats = migration.prestage()
+        self.assertEqual(stats['files_copied'], 4)
+        self.assertGreater(stats['bytes_copied'], 256 * 1024)
+        staged = tree(self.src)
+        del staged['public/igupd/migrate.manifest']
+        self.assertEqual(tree(self.dst), staged)
+
+        # Changes made between install and reboot
+        write(os.path.join(self.src, 'secret', 'small'), b'changed')
+        write(os.path.join(self.src, 'new', 'file'), b'new')
+        os.remove(os.path.join(self.src, 'public', 'igupd', 'update_schedule.conf'))
+        big = os.path.join(self.src, 'secret', 'big.db')
+        os.utime(big, (1, 1))
+
+        # A fresh instance picks up the persisted manifest
+        migration = migrate.DataMigration(self.src, self.dst, self.manifest)
+        self.assertTrue(migration.finalize())
+        stats = migration.stats
+        self.assertEqual(stats['files_copied'], 2)
+        self.assertEqual(stats['bytes_copied'], len(b'changed') + len(b'new'))
+        self.assertEqual(stats['files_removed'], 1)
+        # big.db was touched but not changed, so it is not copied again
+        self.assertGreaterEqual(stats['files_skipped'], 2)
+        self.assertEqual(os.stat(os.path.join(self.dst, 'secret', 'big.db')).st_mtime, 1)
+
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'secret/small')
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'public', 'igupd', 'update_schedule.conf')))
+        self.assertEqual(tree(self.dst)['secret/small'], b'changed')
+        self.assertNotIn('public/igupd/migrate.manifest', tree(self.dst))
+
+    def test_destination_changed(self):
+        manifest = os.path.join(self.tmpdir, 'run', 'migrate.manifest')
+        migration = migrate.DataMigration(self.src, self.dst, manifest)
+        migration.prestage()
+        # The other side ran since, changing its copy and adding files,
+        # and an earlier cycle's manifest was left behind
+        small = os.path.join(self.dst, 'secret', 'small')
+        write(small, b'SMALL')
+        os.utime(small, (5, 5))
+        write(os.path.join(self.dst, 'secret', 'stray'), b'stray')
+        write(os.path.join(self.dst, 'straydir', 'file'), b'stray')
+        migration = migrate.DataMigration(self.src, self.dst, manifest)
+        self.assertTrue(migration.finalize())
+        self.assertEqual(tree(self.dst), tree(self.src))
+        self.assertEqual(migration.stats['files_copied'], 1)
+        self.assertEqual(migration.stats['files_removed'], 2)
+
+        migration.reset()
+        self.assertFalse(os.path.exists(manifest))
+        self.assertEqual(migration.prestage()['files_copied'], 4)
+
+    def test_owner_and_mode(self):
+        secret = os.path.join(self.src, 'secret')
+        os.chmod(secret, 0o700)
+        os.chmod(os.path.join(secret, 'small'), 0o600)
+        if os.geteuid() == 0:
+            os.lchown(os.path.join(secret, 'big.db'), 1234, 5678)
+        migration = migrate.DataMigration(self.src, self.dst, os.path.join(self.tmpdir, 'manifest'))
+        migration.prestage()
+        for rel in ('secret', 'secret/small', 'secret/big.db'):
+            src_st = os.lstat(os.path.join(self.src, rel))
+            dst_st = os.lstat(os.path.join(self.dst, rel))
+            self.assertEqual(dst_st.st_mode, src_st.st_mode)
+            self.assertEqual((dst_st.st_uid, dst_st.st_gid), (src_st.st_uid, src_st.st_gid))
+
+        # A change of mode alone is picked up
+        os.chmod(os.path.join(secret, 'small'), 0o640)
+        migration.finalize()
+        self.assertEqual(os.stat(os.path.join(self.dst, 'secret', 'small')).st_mode & 0o777, 0o640)
+
+if __name__ == '__main__':
+    unittest.main()
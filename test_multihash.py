@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import multihash
+
+SPARSE_SIZE = 64 * 1024 * 1024
+
+
+def reference_digests(path, algorithm):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MultiHashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.volumes = []
+        for i, name in enumerate(('kernel', 'rootfs')):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as f:
+                # Mostly holes, with some data at either end
+                f.write(os.urandom(4096) * (i + 1))
+                f.truncate(SPARSE_SIZE)
+                f.seek(SPARSE_SIZE - 1000)
+                f.write(b'end of volume')
+            self.volumes.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_digests_match(self):
+        for use_mmap in (False, True):
+            digests = multihash.file_digests(self.volumes[0], use_mmap=use_mmap)
+            self.assertEqual(digests['md5'], reference_digests(self.volumes[0], 'md5'))
+            self.assertEqual(digests['sha256'], reference_digests(self.volumes[0], 'sha256'))
+
+    def test_size_limit(self):
+        digests = multihash.file_digests(self.volumes[1], ('sha256',), size=5000)
+        with open(self.volumes[1], 'rb') as f:
+            self.assertEqual(digests['sha256'], hashlib.sha256(f.read(5000)).hexdigest())
+
+    def test_sizes(self):
+        digests = multihash.files_digests(self.volumes, ('sha256',), sizes={self.volumes[0] : 4096})
+        with open(self.volumes[0], 'rb') as f:
+            self.assertEqual(digests[self.volumes[0]]['sha256'], hashlib.sha256(f.read(4096)).hexdigest())
+        self.assertEqual(digests[self.volumes[1]]['sha256'], reference_digests(self.volumes[1], 'sha256'))
+
+    def test_cache(self):
+        cache = multihash.DigestCache()
+        first = cache.get_many(self.volumes, 1)
+        with open(self.volumes[0], 'r+b') as f:
+            f.write(b'changed')
+        # Same generation is served from the cache, a new one is reread
+        self.assertEqual(cache.get_many(self.volumes, 1), first)
+        self.assertNotEqual(cache.get(self.volumes[0], 2), first[self.volumes[0]])
+
+if __name__ == '__main__':
+    unittest.main()
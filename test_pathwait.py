@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import pathwait
+
+
+def bind(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    return sock
+
+
+class PathWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'swupdateprog')
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        shutil.rmtree(self.tmpdir)
+
+    def readable(self, watcher, timeout=0):
+        return bool(select.select([watcher.fileno()], [], [], timeout)[0])
+
+    def test_inotify(self):
+        watcher = pathwait.PathWatcher(self.path)
+        self.assertIsNotNone(watcher.fileno())
+        self.assertFalse(watcher.exists())
+        self.assertFalse(self.readable(watcher))
+
+        # Other entries wake the watch but are not the one wanted
+        with open(os.path.join(self.tmpdir, 'other'), 'w'):
+            pass
+        self.assertTrue(self.readable(watcher, 5))
+        self.assertFalse(watcher.check_events())
+        self.assertFalse(self.readable(watcher))
+
+        # Binding the socket creates it
+        self.sockets.append(bind(self.path))
+        self.assertTrue(self.readable(watcher, 5))
+        self.assertTrue(watcher.check_events())
+        self.assertTrue(watcher.exists())
+        self.assertTrue(watcher.wait(0))
+        watcher.close()
+        self.assertIsNone(watcher.fileno())
+
+    def test_moved_into_place(self):
+        watcher = pathwait.PathWatcher(self.path)
+        tmp_path = os.path.join(self.tmpdir, 'swupdateprog.tmp')
+        self.sockets.append(bind(tmp_path))
+        self.assertTrue(self.readable(watcher, 5))
+        self.assertFalse(watcher.check_events())
+        os.rename(tmp_path, self.path)
+        self.assertTrue(self.readable(watcher, 5))
+        self.assertTrue(watcher.check_events())
+        watcher.close()
+
+    def test_wait(self):
+        watcher = pathwait.PathWatcher(self.path)
+        start = time.time()
+        self.assertFalse(watcher.wait(0.05))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+        timer = threading.Timer(0.1, lambda: self.sockets.append(bind(self.path)))
+        timer.start()
+        start = time.time()
+        self.assertTrue(watcher.wait(5))
+        # Woken by the watch, not by the timeout
+        self.assertLess(time.time() - start, 2)
+        timer.join()
+        watcher.close()
+
+    def test_backoff(self):
+        # inotify cannot watch a directory that is not there yet, so the
+        # path is polled instead
+        path = os.path.join(self.tmpdir, 'run', 'swupdateprog')
+        watcher = pathwait.PathWatcher(path)
+        self.assertIsNone(watcher.fileno())
+        delays = [watcher.next_backoff() for i in range(8)]
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.5, 0.5])
+
+        watcher = pathwait.PathWatcher(path)
+        self.assertFalse(watcher.wait(0.05))
+
+        def create():
+            os.mkdir(os.path.dirname(path))
+            self.sockets.append(bind(path))
+
+        timer = threading.Timer(0.1, create)
+        timer.start()
+        self.assertTrue(watcher.wait(5))
+        timer.join()
+        # Closing a watcher without inotify does nothing
+        watcher.close()
+
+if __name__ == '__main__':
+    unittest.main()
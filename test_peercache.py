@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import artifactcache
+import peercache
+from test_artifactcache import FlakyServer
+from test_swuimage import make_swu
+
+CHUNK = 64 * 1024
+
+
+def have_openssl():
+    try:
+        return subprocess.call(['openssl', 'version'], stdout=subprocess.PIPE) == 0
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(have_openssl(), 'openssl is not available')
+class PeerCacheTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.keydir = tempfile.mkdtemp()
+        cls.private_key = os.path.join(cls.keydir, 'priv.pem')
+        cls.public_key = os.path.join(cls.keydir, 'public.pem')
+        subprocess.check_call(['openssl', 'genrsa', '-out', cls.private_key, '2048'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        subprocess.check_call(['openssl', 'rsa', '-in', cls.private_key, '-pubout',
+            '-out', cls.public_key], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.keydir)
+
+    def sign(self, description):
+        path = os.path.join(self.tmpdir, 'sw-description')
+        with open(path, 'wb') as f:
+            f.write(description)
+        return subprocess.check_output(['openssl', 'dgst', '-sha256', '-sign', self.private_key, path])
+
+    def description(self, image):
+        return ('software = {{ version = "1.0"; images: ( {{ filename = "rootfs.bin"; '
+                'sha256 = "{}"; }} ); }}\n'.format(hashlib.sha256(image).hexdigest())).encode('ascii')
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = os.urandom(5 * CHUNK + 1000)
+        description = self.description(self.image)
+        self.swu = make_swu(description, self.sign(description), [('rootfs.bin', self.image)])
+        self.sha256 = hashlib.sha256(self.swu).hexdigest()
+        self.server = FlakyServer()
+        self.server.artifacts['/update.swu'] = self.swu
+        self.url = self.server.url('/update.swu')
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.stop()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_verify(self):
+        peercache.verify_swu(self.write('good.swu', self.swu), self.public_key)
+
+        description = self.description(self.image)
+        signature = self.sign(description)
+        bad = {
+            # The image does not match the signed sw-description
+            'image.swu' : make_swu(description, signature, [('rootfs.bin', os.urandom(100))]),
+            # sw-description changed after signing
+            'description.swu' : make_swu(description.replace(b'1.0', b'6.6'), signature,
+                [('rootfs.bin', self.image)]),
+            'unsigned.swu' : make_swu(description, None, [('rootfs.bin', self.image)]),
+            'garbage.swu' : os.urandom(1000),
+        }
+        for name, data in bad.items():
+            self.assertRaises(peercache.VerifyError, peercache.verify_swu,
+                self.write(name, data), self.public_key)
+        self.assertRaises(peercache.VerifyError, peercache.verify_swu,
+            self.write('good.swu', self.swu), None)
+
+    def start_peers(self, count):
+        for i in range(count):
+            cache = artifactcache.ArtifactCache(os.path.join(self.tmpdir, 'cache{}'.format(i)))
+            peer = peercache.PeerCache(cache, self.public_key, '127.0.0.1', http_port=0,
+                discovery_port=0, group=None, targets=[])
+            peer.start()
+            self.peers.append(peer)
+        for peer in self.peers:
+            peer.targets = [('127.0.0.1', p.discovery_port()) for p in self.peers if p is not peer]
+
+    def download(self, peer, mirror=None):
+        download = artifactcache.RangeDownload(peer.cache, self.url, self.sha256, chunk_size=CHUNK)
+        if mirror:
+            download.mirrors.append(mirror)
+        path = download.run(retry_min=0)
+        self.assertTrue(peer.verify(download.key))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.swu)
+        return download
+
+    def test_site(self):
+        self.start_peers(3)
+        first, second, third = self.peers
+        self.assertIsNone(second.find(self.sha256, 0.3))
+
+        self.download(first)
+        self.assertEqual(self.server.requests, 1)
+        wan_bytes_avoided = 0
+        for peer in (second, third):
+            mirror = peer.find(self.sha256)
+            self.assertIsNotNone(mirror)
+            download = self.download(peer, mirror)
+            wan_bytes_avoided += download.stats['mirror_bytes']
+        # Only the first gateway used the server
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(wan_bytes_avoided, 2 * len(self.swu))
+        self.assertEqual(sum(p.stats['bytes_served'] for p in self.peers), 2 * len(self.swu))
+        self.assertEqual(second.stats['hits'], 1)
+
+    def test_unverified_not_served(self):
+        self.start_peers(2)
+        first, second = self.peers
+        download = artifactcache.RangeDownload(first.cache, self.url, self.sha256, chunk_size=CHUNK)
+        download.run(retry_min=0)
+        self.assertIsNone(second.find(self.sha256, 0.3))
+        # A tampered artifact fails verification and stays unserved
+        with open(download.path, 'r+b') as f:
+            f.seek(len(self.swu) - 2000)
+            f.write(b'tampered')
+        self.assertFalse(first.verify(download.key))
+        self.assertIsNone(second.find(self.sha256, 0.3))
+        self.assertEqual(first.stats['verify_failures'], 1)
+
+    def test_lan_only(self):
+        self.start_peers(1)
+        peer = self.peers[0]
+        self.assertEqual(peer.http_server.server_address[0], '127.0.0.1')
+        self.assertEqual(peer.sock.getsockname()[0], '127.0.0.1')
+        cache = artifactcache.ArtifactCache(os.path.join(self.tmpdir, 'nolan'))
+        # Not started on every interface for want of an address
+        self.assertRaises(ValueError, peercache.PeerCache, cache, self.public_key, '')
+        self.assertEqual(peercache.interface_address('lo'), '127.0.0.1')
+        self.assertRaises(IOError, peercache.interface_address, 'nosuchif0')
+
+    def test_fallback(self):
+        self.start_peers(1)
+        peer = self.peers[0]
+        # A peer that went away
+        download = self.download(peer, 'http://127.0.0.1:1/artifacts/' + self.sha256)
+        self.assertEqual(download.stats['mirror_bytes'], 0)
+        self.assertEqual(self.server.requests, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import os
+import time
+import unittest
+
+import procrun
+
+
+class ProcRunTestCase(unittest.TestCase):
+    def test_output_and_exit_code(self):
+        result = procrun.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout, b'out\n')
+        self.assertEqual(result.stderr, b'err\n')
+        self.assertFalse(result.truncated)
+        self.assertFalse(result.timed_out)
+
+    def test_timeout_kills(self):
+        start = time.time()
+        result = procrun.run(['sleep', '10'], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertLess(time.time() - start, 5)
+
+    def test_output_limit(self):
+        result = procrun.run(['sh', '-c', 'yes | head -c 100000'], output_limit=1000)
+        self.assertEqual(len(result.stdout), 1000)
+        self.assertTrue(result.truncated)
+        self.assertEqual(result.returncode, 0)
+
+    def test_line_callback(self):
+        lines = []
+        procrun.run(['sh', '-c', 'printf "one\\ntwo\\nthree"'], line_callback=lines.append)
+        self.assertEqual(lines, ['one', 'two', 'three'])
+
+    def test_exit_with_background_child(self):
+        # A child left holding stdout must not hold up the result
+        start = time.time()
+        result = procrun.run(['sh', '-c', 'sleep 3 & echo done'], timeout=5)
+        self.assertEqual(result.returncode, 0)
+        pidfd = procrun.open_pidfd(os.getpid())
+        if pidfd is not None:
+            os.close(pidfd)
+            self.assertLess(time.time() - start, 2)
+
+    def test_missing_command(self):
+        result = procrun.run(['/nonexistent/command'])
+        self.assertIsNone(result.returncode)
+        self.assertGreater(procrun.get_stats()['command']['failures'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
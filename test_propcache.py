@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import unittest
+
+import propcache
+from test_swuprogress import FakeLoop
+
+
+class PropertyCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.signals = []
+        self.cache = propcache.PropertyCache(self.loop, self.signals.append)
+
+    def test_coalesce(self):
+        self.cache.update({'Status' : 2, 'LastResult' : ''})
+        self.cache.set('Progress', 10)
+        self.cache.set('Progress', 20)
+        # One timer for the whole batch
+        self.assertEqual(len(self.loop.timers), 1)
+        self.assertEqual(self.signals, [])
+        self.loop.fire_all()
+        self.assertEqual(self.signals, [{'Status' : 2, 'LastResult' : '', 'Progress' : 20}])
+        self.assertEqual(self.cache.get_all(), {'Status' : 2, 'LastResult' : '', 'Progress' : 20})
+
+    def test_unchanged(self):
+        self.cache.update({'Status' : 2, 'Progress' : 0})
+        self.loop.fire_all()
+        # Refreshing with the same values is not signalled
+        self.cache.update({'Status' : 2, 'Progress' : 0})
+        self.assertEqual(self.loop.timers, {})
+        self.cache.update({'Status' : 1, 'Progress' : 0})
+        self.loop.fire_all()
+        self.assertEqual(self.signals[1:], [{'Status' : 1}])
+        self.assertEqual(self.cache.stats(), {'updates' : 6, 'emitted' : 2, 'pending' : 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+import random
+import time
+import unittest
+
+import schedule
+
+
+def legacy_next_schedule_window(date_from, schedule_list):
+    '''
+    The list based implementation next_schedule_window replaced
+    '''
+    schedule_hours = [0 for i in range(0, schedule.HOURS_PER_WEEK)]
+    for d in schedule_list:
+        day = list(d.keys())[0]
+        hours_list = list(d.values())[0].split('-')
+        hour_low = int(hours_list[0])
+        hour_high = int(hours_list[1]) if len(hours_list) > 1 else hour_low
+        days = range(0, schedule.DAYS_PER_WEEK) if day == '*' else [int(day)]
+        for i in days:
+            day_offset = i * schedule.HOURS_PER_DAY
+            schedule_hours[day_offset+hour_low:day_offset+hour_high+1] = [1] * (hour_high - hour_low + 1)
+
+    delta_start = None
+    delta_end = None
+    start_hour = (date_from.weekday() * schedule.HOURS_PER_DAY) + date_from.hour
+    if schedule_hours[start_hour] > 0:
+        delta_start = 0
+    for w in range(0, schedule.HOURS_PER_WEEK):
+        is_window = schedule_hours[(w + start_hour) % schedule.HOURS_PER_WEEK] > 0
+        if delta_start is None:
+            if is_window:
+                date_start = (date_from + datetime.timedelta(hours=w)).replace(minute=0)
+                delta_start = (date_start - date_from).total_seconds()
+        elif delta_end is None:
+            if not is_window:
+                date_end = (date_from + datetime.timedelta(hours=w)).replace(minute=0)
+                delta_end = (date_end - date_from).total_seconds()
+    if delta_end is None:
+        if delta_start is None or delta_start == 0:
+            delta_start = 0
+            delta_end = 0
+        else:
+            delta_end = schedule.HOURS_PER_WEEK * 3600 - (date_from.minute * 60)
+    return (delta_start, delta_end)
+
+
+def random_schedule(rnd):
+    entries = []
+    for i in range(rnd.randint(1, 4)):
+        low = rnd.randint(0, 23)
+        high = rnd.randint(low, 23)
+        day = rnd.choice(['*', str(rnd.randint(0, 6))])
+        entries.append({day : '{}-{}'.format(low, high) if high != low else str(low)})
+    return entries
+
+
+def set_local_zone(name):
+    if name is None:
+        os.environ.pop('TZ', None)
+    else:
+        os.environ['TZ'] = name
+    time.tzset()
+    # Compiled windows of local time schedules depend on the zone
+    schedule._schedule_cache.clear()
+
+
+class ScheduleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved_tz = os.environ.get('TZ')
+        set_local_zone('UTC')
+
+    def tearDown(self):
+        set_local_zone(self.saved_tz)
+
+    def test_check_schedule(self):
+        self.assertTrue(schedule.check_schedule([{'*' : '2-4'}, {'6' : '23'}]))
+        self.assertFalse(schedule.check_schedule([]))
+        self.assertFalse(schedule.check_schedule(None))
+        self.assertFalse(schedule.check_schedule([{'7' : '2-4'}]))
+        self.assertFalse(schedule.check_schedule([{'*' : '4-2'}]))
+        self.assertFalse(schedule.check_schedule([{'*' : '0-24'}]))
+        self.assertTrue(schedule.check_schedule([{'*' : '02:30-03:15'}, {'5' : '23:00-00:30'}]))
+        self.assertTrue(schedule.check_schedule([{'days' : [0, 2], 'hours' : '22:00-24:00'}]))
+        self.assertFalse(schedule.check_schedule([{'*' : '03:00-03:00'}]))
+        self.assertFalse(schedule.check_schedule([{'*' : '03:00-24:01'}]))
+        self.assertFalse(schedule.check_schedule([{'*' : '03:00'}]))
+        self.assertFalse(schedule.check_schedule([{'days' : [], 'hours' : '1'}]))
+        self.assertFalse(schedule.check_schedule([{'hours' : '1', 'tz' : 'Not/A_Zone'}]))
+
+    def test_matches_legacy(self):
+        rnd = random.Random(7)
+        for i in range(500):
+            schedule_list = random_schedule(rnd)
+            date_from = datetime.datetime(2024, 1, 1) + datetime.timedelta(
+                minutes=rnd.randint(0, 7 * 24 * 60 - 1))
+            self.assertEqual(schedule.next_schedule_window(date_from, schedule_list),
+                legacy_next_schedule_window(date_from, schedule_list),
+                '{} at {}'.format(schedule_list, date_from))
+
+    def test_always_on(self):
+        now = datetime.datetime(2024, 1, 3, 12, 30)
+        self.assertEqual(schedule.next_schedule_window(now, None), (0, 0))
+        self.assertEqual(schedule.next_schedule_window(now, [{'*' : '0-23'}]), (0, 0))
+        self.assertEqual(schedule.next_schedule_window(now, [{'x' : '1'}]), (0, 0))
+
+    def test_in_window(self):
+        s = schedule.compile_schedule([{'2' : '10-11'}])
+        self.assertIs(s, schedule.compile_schedule([{'2' : '10-11'}]))
+        # 2024-01-03 is a Wednesday (day 2)
+        self.assertTrue(s.in_window(datetime.datetime(2024, 1, 3, 11, 59)))
+        self.assertFalse(s.in_window(datetime.datetime(2024, 1, 3, 12, 0)))
+        self.assertEqual(s.next_window(datetime.datetime(2024, 1, 3, 12, 0)),
+            (7 * 24 * 3600 - 2 * 3600, 7 * 24 * 3600))
+
+    def test_minutes(self):
+        s = schedule.compile_schedule([{'*' : '23:30-00:15'}])
+        self.assertEqual(s.next_window(datetime.datetime(2024, 1, 3, 12, 0)),
+            (11.5 * 3600, 12.25 * 3600))
+        self.assertEqual(s.next_window(datetime.datetime(2024, 1, 4, 0, 10)), (0, 300))
+        # Adjacent windows merge
+        s = schedule.compile_schedule([{'*' : '02:30-03:15'}, {'*' : '03:15-04:00'}])
+        self.assertEqual(s.next_window(datetime.datetime(2024, 1, 3, 2, 0)), (1800, 7200))
+
+
+class SpreadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved_tz = os.environ.get('TZ')
+        set_local_zone('UTC')
+        self.schedule = schedule.compile_schedule([{'*' : '2-3'}])
+        self.midnight = datetime.datetime(2024, 1, 3, tzinfo=datetime.timezone.utc).timestamp()
+
+    def tearDown(self):
+        set_local_zone(self.saved_tz)
+
+    def test_fraction(self):
+        self.assertEqual(schedule.spread_fraction('Laird_c0ee40aabbcc'),
+            schedule.spread_fraction('Laird_c0ee40aabbcc'))
+        self.assertNotEqual(schedule.spread_fraction('Laird_c0ee40aabbcc'),
+            schedule.spread_fraction('Laird_c0ee40aabbcd'))
+        for i in range(100):
+            self.assertTrue(0 <= schedule.spread_fraction(str(i)) < 1)
+
+    def test_spread_window(self):
+        s = self.schedule
+        self.assertEqual(s.spread_window_at(self.midnight, 0.5, 1800), (2 * 3600 + 900, 4 * 3600))
+        # The delay is limited to half the window
+        self.assertEqual(s.spread_window_at(self.midnight, 1 - 1e-9, 86400)[0] // 1, 3 * 3600 - 1)
+        # Before the device's start in the window it waits; after it, it starts now
+        self.assertEqual(s.spread_window_at(self.midnight + 2 * 3600 + 600, 0.5, 1800), (300, 6600))
+        self.assertEqual(s.spread_window_at(self.midnight + 2 * 3600 + 1200, 0.5, 1800), (0, 6000))
+        self.assertEqual(schedule.compile_schedule(None).spread_window_at(self.midnight, 0.5, 1800), (0, 0))
+
+    def test_fleet_simulation(self):
+        '''
+        Start times of 10000 devices with the same schedule, as requests
+        per minute seen by the server
+        '''
+        devices = ['Laird_c0ee40%06x' % i for i in range(10000)]
+        max_spread = 3600
+        for spread in (0, max_spread):
+            per_minute = {}
+            for d in devices:
+                delta_start, delta_end = self.schedule.spread_window_at(self.midnight,
+                    schedule.spread_fraction(d), spread)
+                minute = int(delta_start // 60)
+                per_minute[minute] = per_minute.get(minute, 0) + 1
+            rates = sorted(per_minute.values())
+            if spread == 0:
+                self.assertEqual(rates, [len(devices)])
+            else:
+                self.assertEqual(len(per_minute), 60)
+                self.assertEqual(min(per_minute), 120)
+                self.assertEqual(max(per_minute), 179)
+                # Close to uniform: 10000 devices over 60 minutes
+                self.assertLess(rates[-1], 1.3 * len(devices) / 60)
+
+
+def fast_forward(sched, ts, until):
+    '''
+    Follow a schedule the way the download timers do, jumping to each
+    window start and end, and return the windows seen
+    '''
+    windows = []
+    while ts < until:
+        delta_start, delta_end = sched.window_at(ts)
+        if delta_end == 0 or ts + delta_start >= until:
+            break
+        windows.append((ts + delta_start, ts + delta_end))
+        ts += delta_end + 1
+    return windows
+
+
+@unittest.skipIf(schedule.zoneinfo is None, 'zoneinfo not available')
+class DaylightSavingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved_tz = os.environ.get('TZ')
+        self.zone = schedule.zoneinfo.ZoneInfo('America/New_York')
+
+    def tearDown(self):
+        set_local_zone(self.saved_tz)
+
+    def at(self, *args):
+        return datetime.datetime(*args, tzinfo=self.zone).timestamp()
+
+    def test_spring_forward(self):
+        s = schedule.compile_schedule([{'days' : '*', 'hours' : '02:30-03:15',
+                                        'tz' : 'America/New_York'}])
+        # 02:30 does not exist on 2024-03-10; the window opens at the change
+        # to 03:00 EDT instead of being dropped
+        now = self.at(2024, 3, 10, 0, 0)
+        self.assertEqual(s.window_at(now), (2 * 3600, 2 * 3600 + 15 * 60))
+        # The next day it is back at 02:30 local time, 45 minutes long
+        now = self.at(2024, 3, 11, 0, 0)
+        self.assertEqual(s.window_at(now), (2.5 * 3600, 3.25 * 3600))
+
+    def test_fall_back(self):
+        s = schedule.compile_schedule([{'days' : '6', 'hours' : '1',
+                                        'tz' : 'America/New_York'}])
+        # 01:00 - 02:00 on 2024-11-03 is two real hours
+        now = self.at(2024, 11, 3, 0, 0)
+        self.assertEqual(s.window_at(now), (3600, 3 * 3600))
+
+    def test_year_fast_forward(self):
+        s = schedule.compile_schedule([{'days' : '*', 'hours' : '02:30-03:15',
+                                        'tz' : 'America/New_York'}])
+        windows = fast_forward(s, self.at(2024, 1, 1), self.at(2025, 1, 1))
+        self.assertEqual(len(windows), 366)
+        for start, end in windows:
+            local_start = datetime.datetime.fromtimestamp(start, self.zone)
+            local_end = datetime.datetime.fromtimestamp(end, self.zone)
+            self.assertEqual(local_end.time(), datetime.time(3, 15))
+            if local_start.date() == datetime.date(2024, 3, 10):
+                self.assertEqual(local_start.time(), datetime.time(3, 0))
+            else:
+                self.assertEqual(local_start.time(), datetime.time(2, 30))
+                self.assertEqual(end - start, 45 * 60)
+
+    def test_local_zone(self):
+        set_local_zone('Europe/London')
+        s = schedule.compile_schedule([{'*' : '1'}, {'*' : '23:00-23:30'}])
+        utc = datetime.timezone.utc
+        # 01:00 - 02:00 is skipped on 2024-03-31; the window is kept at the
+        # change, for an hour
+        now = datetime.datetime(2024, 3, 31, 0, 0, tzinfo=utc).timestamp()
+        self.assertEqual(s.window_at(now), (3600, 2 * 3600))
+        # Naive datetimes are local time; 23:00 BST is 22:00 UTC
+        self.assertEqual(s.next_window(datetime.datetime(2024, 4, 1, 22, 0)), (3600, 5400))
+        windows = fast_forward(s, now, now + 365 * schedule.SECONDS_PER_DAY)
+        self.assertEqual(len(windows), 2 * 365)
+
+if __name__ == '__main__':
+    unittest.main()
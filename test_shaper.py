@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+import shaper
+from test_artifactcache import FlakyServer
+from test_schedule import set_local_zone
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = shaper.TokenBucket(1000, burst=500, clock=clock, sleep=clock.sleep)
+        # The burst goes straight through, then data is paced at the rate
+        self.assertEqual(bucket.consume(500), 0)
+        self.assertAlmostEqual(bucket.consume(250), 0.25)
+        for i in range(8):
+            bucket.consume(250)
+        self.assertAlmostEqual(clock.now, 102.25)
+        self.assertEqual(bucket.stats['bytes'], 2750)
+        self.assertEqual(bucket.stats['delays'], 9)
+        self.assertAlmostEqual(bucket.stats['max_delay'], 0.25)
+
+    def test_set_rate(self):
+        clock = FakeClock()
+        bucket = shaper.TokenBucket(1000, burst=1000, clock=clock, sleep=clock.sleep)
+        bucket.consume(1000)
+        bucket.set_rate(0)
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+        bucket.set_rate(2000, burst=1000)
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertAlmostEqual(bucket.consume(1000), 0.5)
+
+
+class ScheduledRateTestCase(unittest.TestCase):
+    def setUp(self):
+        set_local_zone('UTC')
+
+    def tearDown(self):
+        set_local_zone(None)
+
+    def test_windows(self):
+        rates = [{'days' : '*', 'hours' : '08:00-18:00', 'rate' : 20000},
+                 {'days' : '*', 'hours' : '06:00-20:00', 'rate' : 50000}]
+        shaper.check_rates(rates)
+        day = 1704067200  # Monday 1 January 2024 00:00 UTC
+        self.assertEqual(shaper.scheduled_rate(rates, 0, day + 3600), (0, 5 * 3600))
+        self.assertEqual(shaper.scheduled_rate(rates, 0, day + 7 * 3600), (50000, 3600))
+        self.assertEqual(shaper.scheduled_rate(rates, 0, day + 12 * 3600), (20000, 6 * 3600))
+        self.assertEqual(shaper.scheduled_rate(rates, 0, day + 19 * 3600), (50000, 3600))
+        self.assertEqual(shaper.scheduled_rate([], 1000, day), (1000, None))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, shaper.check_rates, [{'*' : '8-18'}])
+        self.assertRaises(ValueError, shaper.check_rates, [{'hours' : '8-18', 'rate' : -1}])
+        self.assertRaises(ValueError, shaper.check_rates, [{'hours' : '8-25', 'rate' : 1}])
+        self.assertRaises(ValueError, shaper.check_rates, {'hours' : '8-18', 'rate' : 1})
+
+
+class RelayProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FlakyServer()
+        self.data = os.urandom(256 * 1024)
+        self.server.artifacts['/update.swu'] = self.data
+        self.bucket = shaper.TokenBucket()
+        self.relay = shaper.RelayProxy(self.bucket)
+        self.relay.start()
+
+    def tearDown(self):
+        self.relay.stop()
+        self.server.stop()
+
+    def fetch(self):
+        response = shaper.open_url(self.server.url('/update.swu'), 5, self.relay.url())
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def test_shaped(self):
+        rate = 512 * 1024
+        self.bucket.set_rate(rate)
+        start = time.time()
+        self.assertEqual(self.fetch(), self.data)
+        elapsed = time.time() - start
+        # All but the burst is paced at the rate
+        self.assertGreater(elapsed, (len(self.data) - self.bucket.burst) / float(rate) * 0.9)
+        # The relay closes its side just after the client has the data
+        deadline = time.time() + 2
+        while self.relay.get_stats()['active'] and time.time() < deadline:
+            time.sleep(0.01)
+        stats = self.relay.get_stats()
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['active'], 0)
+        self.assertGreater(stats['bytes_down'], len(self.data))
+        self.assertGreater(stats['bucket_delays'], 0)
+        self.assertGreater(stats['mean_delay'], 0)
+        self.assertLess(stats['throughput'], rate * 1.5)
+
+    def test_live_rate_change(self):
+        self.server.artifacts['/update.swu'] = self.data = os.urandom(1024 * 1024)
+        # 16 seconds at this rate, unless it is lifted part way
+        self.bucket.set_rate(64 * 1024)
+        timer = threading.Timer(0.3, self.bucket.set_rate, (0,))
+        timer.start()
+        start = time.time()
+        self.assertEqual(self.fetch(), self.data)
+        self.assertLess(time.time() - start, 5)
+        timer.join()
+
+    def test_connect_tunnel(self):
+        host, port = self.relay.sock.getsockname()
+        sock = socket.create_connection((host, port), 5)
+        target = '127.0.0.1:{}'.format(self.server.server_address[1])
+        sock.sendall('CONNECT {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(target, target).encode('ascii'))
+        f = sock.makefile('rb')
+        self.assertIn(b' 200 ', f.readline())
+        self.assertEqual(f.readline(), b'\r\n')
+        sock.sendall(b'GET /update.swu HTTP/1.0\r\n\r\n')
+        response = f.read()
+        f.close()
+        sock.close()
+        self.assertTrue(response.endswith(self.data))
+
+    def test_bad_gateway(self):
+        self.assertRaises(IOError, shaper.open_url, 'http://127.0.0.1:1/', 5, self.relay.url())
+        self.assertEqual(self.relay.get_stats()['failed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
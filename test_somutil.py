@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+
+import somutil
+
+ENV_SIZE = 0x4000
+ENV_VARS = {'bootside' : 'a', 'upgrade_available' : '0', 'bootcount' : '0',
+            'altbootcmd' : 'setenv bootside b; saveenv; run bootcmd'}
+LOOKUPS = 50
+
+
+def make_env_image(env, redundant_flags=None):
+    data = b'\x00'.join(('{}={}'.format(k, v)).encode('utf-8') for k, v in sorted(env.items()))
+    size = ENV_SIZE - 4 - (1 if redundant_flags is not None else 0)
+    data = data + b'\x00' * (size - len(data))
+    header = struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+    if redundant_flags is not None:
+        header += struct.pack('B', redundant_flags)
+    return header + data
+
+
+def write_script(path, body):
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n' + body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+class UBootEnvTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.tmpdir + os.pathsep + self.path
+        self.env_file = os.path.join(self.tmpdir, 'printenv.txt')
+        with open(self.env_file, 'w') as f:
+            for k, v in sorted(ENV_VARS.items()):
+                f.write('{}={}\n'.format(k, v))
+        write_script(os.path.join(self.tmpdir, somutil.CMD_FW_PRINTENV), 'cat {}\n'.format(self.env_file))
+        self.setenv_log = os.path.join(self.tmpdir, 'setenv.log')
+        write_script(os.path.join(self.tmpdir, somutil.CMD_FW_SETENV),
+            'echo "$@" >> {0}\nif [ "$1" = "-s" ]; then cat "$2" >> {0}; fi\n'.format(self.setenv_log))
+        self.config = os.path.join(self.tmpdir, 'fw_env.config')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, images):
+        with open(self.config, 'w') as f:
+            f.write('# Device offset size\n')
+            for i, image in enumerate(images):
+                dev = os.path.join(self.tmpdir, 'env{}'.format(i))
+                with open(dev, 'wb') as d:
+                    d.write(b'\xff' * 0x1000 + image)
+                f.write('{}\t0x1000\t0x{:x}\n'.format(dev, ENV_SIZE))
+
+    def test_native_read(self):
+        self.write_config([make_env_image(ENV_VARS)])
+        self.assertEqual(somutil.read_native_env(self.config), ENV_VARS)
+
+    def test_redundant_copy_selection(self):
+        newer = dict(ENV_VARS, bootside='b')
+        self.write_config([make_env_image(ENV_VARS, 255), make_env_image(newer, 0)])
+        self.assertEqual(somutil.read_native_env(self.config)['bootside'], 'b')
+        # A corrupt newer copy falls back to the older valid one
+        bad = bytearray(make_env_image(newer, 0))
+        bad[10] ^= 0xff
+        self.write_config([make_env_image(ENV_VARS, 255), bytes(bad)])
+        self.assertEqual(somutil.read_native_env(self.config)['bootside'], 'a')
+
+    def test_cache_and_set(self):
+        env = somutil.UBootEnv(self.config, native=False)
+        self.assertEqual(env.get('bootside'), 'a')
+        self.assertEqual(env.get('altbootcmd'), ENV_VARS['altbootcmd'])
+        self.assertTrue(env.set('bootside', 'b'))
+        self.assertEqual(env.get('bootside'), 'b')
+        self.assertEqual(env.fork_reads, 1)
+
+    def test_transaction_single_write(self):
+        env = somutil.UBootEnv(self.config, native=False)
+        env.get('bootside')
+        with env.transaction() as txn:
+            txn.set('bootside', 'b')
+            txn.set('altbootcmd', ENV_VARS['altbootcmd'].replace(' b;', ' a;'))
+            txn.set('upgrade_available', '1')
+            txn.set('bootlimit', '5')
+        self.assertTrue(txn.result)
+        self.assertEqual(env.writes, 1)
+        self.assertEqual(env.saved_writes, 3)
+        self.assertEqual(env.get('bootlimit'), '5')
+        with open(self.setenv_log) as f:
+            log = f.read().splitlines()
+        self.assertEqual(log[0].split()[0], '-s')
+        self.assertEqual(log[2], 'altbootcmd setenv bootside a; saveenv; run bootcmd')
+
+    def test_benchmark_lookups(self):
+        self.write_config([make_env_image(ENV_VARS)])
+        results = {}
+
+        start = time.time()
+        for i in range(LOOKUPS):
+            env = somutil.UBootEnv(self.config, native=False)
+            env.get('bootside')
+        results['fork per lookup'] = time.time() - start
+
+        env = somutil.UBootEnv(self.config, native=False)
+        start = time.time()
+        for i in range(LOOKUPS):
+            env.get('bootside')
+        results['cached'] = time.time() - start
+
+        start = time.time()
+        for i in range(LOOKUPS):
+            env = somutil.UBootEnv(self.config)
+            env.get('bootside')
+        results['native'] = time.time() - start
+        self.assertEqual(env.fork_reads, 0)
+
+        self.assertLess(results['cached'], results['fork per lookup'])
+        self.assertLess(results['native'], results['fork per lookup'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import startup
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 10.0
+
+    def __call__(self):
+        return self.now
+
+
+class PhaseTimerTestCase(unittest.TestCase):
+    def test_phases(self):
+        clock = FakeClock()
+        timer = startup.PhaseTimer(start=9.5, clock=clock)
+        with timer.phase('config'):
+            clock.now += 0.25
+        # An asynchronous phase overlapping others
+        timer.begin('mac_address')
+        with timer.phase('device_service'):
+            clock.now += 0.5
+        clock.now += 1
+        timer.end('mac_address')
+        timer.ready()
+        self.assertEqual(timer.stats(), {'startup.config' : 0.25,
+            'startup.device_service' : 0.5, 'startup.mac_address' : 1.5,
+            'startup.time_to_ready' : 2.25})
+        self.assertEqual(timer.summary(), 'config 0.250s, device_service 0.500s, mac_address 1.500s')
+        self.assertIsNone(timer.end('unknown'))
+
+
+class DeviceIdTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'igupd', startup.DEVICE_ID_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        self.assertIsNone(startup.load_device_id(self.path, 'Laird_'))
+        startup.save_device_id(self.path, 'Laird_c0:ee:40:00:00:01')
+        self.assertEqual(startup.load_device_id(self.path, 'Laird_'), 'Laird_c0:ee:40:00:00:01')
+        # A changed prefix means the cached ID is stale
+        self.assertIsNone(startup.load_device_id(self.path, 'Acme_'))
+
+if __name__ == '__main__':
+    unittest.main()
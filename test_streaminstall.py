@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import streaminstall
+import swuctrl
+from test_artifactcache import FlakyServer
+from test_delta import FakeSwupdate
+
+READ_SIZE = 4096
+
+
+class SlowSink(object):
+    '''
+    A consumer slower than the network
+    '''
+    def __init__(self, delay):
+        self.delay = delay
+        self.data = bytearray()
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.data += data
+
+
+class FailingSink(object):
+    def write(self, data):
+        raise IOError('swupdate went away')
+
+
+class StreamInstallTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = FlakyServer()
+        self.data = os.urandom(64 * READ_SIZE + 77)
+        self.server.artifacts['/update.swu'] = self.data
+        self.url = self.server.url('/update.swu')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def stream(self, **kwargs):
+        kwargs.setdefault('read_size', READ_SIZE)
+        return streaminstall.StreamInstall(self.url, timeout=5, resume_delay=0, **kwargs)
+
+    def test_install(self):
+        # End to end: the HTTP server to a fake swupdate, with no file
+        address = os.path.join(self.tmpdir, 'sockinstctrl')
+        swupdate = FakeSwupdate(address)
+        swupdate.start()
+        out = swuctrl.InstallStream(address).open()
+        stats = self.stream().run(out)
+        out.close()
+        swupdate.join(5)
+        self.assertEqual(swupdate.image, self.data)
+        self.assertEqual(stats['bytes'], len(self.data))
+        self.assertEqual(stats['size'], len(self.data))
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['throughput'], 0)
+        self.assertEqual(os.listdir(self.tmpdir), ['sockinstctrl'])
+
+    def test_backpressure(self):
+        sink = SlowSink(0.002)
+        stream = self.stream(queue_depth=4)
+        stats = stream.run(sink)
+        self.assertEqual(bytes(sink.data), self.data)
+        # The reader was held back by the full queue, which never grew
+        self.assertGreater(stats['backpressure_waits'], 0)
+        self.assertGreater(stats['backpressure_seconds'], 0)
+        self.assertLessEqual(stats['queue_high_water'], 4)
+
+    def test_resume(self):
+        self.server.drop_after = 20 * READ_SIZE + 5
+        sink = SlowSink(0)
+        stats = self.stream().run(sink)
+        self.assertEqual(bytes(sink.data), self.data)
+        self.assertEqual(stats['resumes'], 3)
+        self.assertEqual(stats['requests'], 4)
+
+    def test_cannot_resume(self):
+        # Without ranges the image would have to start again, but swupdate
+        # already has the start of it
+        self.server.drop_after = 20 * READ_SIZE
+        self.server.ranges = False
+        sink = SlowSink(0)
+        self.assertRaises(streaminstall.StreamError, self.stream().run, sink)
+        self.assertEqual(len(sink.data), 20 * READ_SIZE)
+
+    def test_not_found(self):
+        self.url = self.server.url('/missing.swu')
+        self.assertRaises(streaminstall.StreamError, self.stream().run, SlowSink(0))
+
+    def test_swupdate_fails(self):
+        stream = self.stream(queue_depth=2)
+        self.assertRaises(IOError, stream.run, FailingSink())
+        self.assertTrue(stream.stopped())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import unittest
+
+import supervisor
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RestartSupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sup = supervisor.RestartSupervisor(clock=self.clock, rand=lambda: 0.5)
+
+    def test_classify(self):
+        self.assertEqual(supervisor.classify_exit(0), supervisor.EXIT_SUCCESS)
+        self.assertEqual(supervisor.classify_exit(-15), supervisor.EXIT_TERMINATED)
+        self.assertEqual(supervisor.classify_exit(-9), supervisor.EXIT_FAILURE)
+        self.assertEqual(supervisor.classify_exit(1), supervisor.EXIT_BAD_CMD)
+        self.assertEqual(supervisor.classify_exit(None), supervisor.EXIT_BAD_CMD)
+
+    def test_terminate_restarts_promptly(self):
+        self.sup.started()
+        kind, delay = self.sup.exited(-15)
+        self.assertEqual(delay, supervisor.TERMINATED_RESTART_DELAY)
+        self.assertFalse(self.sup.circuit_open)
+
+    def test_backoff_and_circuit_breaker(self):
+        delays = []
+        for i in range(supervisor.CIRCUIT_TRIP_FAILURES):
+            self.sup.started()
+            self.clock.now += 1
+            kind, delay = self.sup.exited(1)
+            delays.append(delay)
+            self.clock.now += delay
+        self.assertEqual(delays[:3], [3, 6, 12])
+        self.assertTrue(self.sup.circuit_open)
+        self.assertEqual(delays[-1], supervisor.CIRCUIT_RESET_DELAY)
+        self.assertEqual(self.sup.stats()['circuit_trips'], 1)
+
+        # A healthy start closes the breaker and reports time to healthy
+        self.sup.started()
+        self.clock.now += 2
+        self.assertTrue(self.sup.healthy())
+        self.assertFalse(self.sup.circuit_open)
+        self.assertEqual(self.sup.stats()['last_time_to_healthy'], self.clock.now - 1000.0)
+
+    def test_connect_then_exit_trips(self):
+        # swupdate comes up and connects, then exits within seconds
+        for i in range(supervisor.CIRCUIT_TRIP_FAILURES):
+            self.sup.started()
+            self.clock.now += 1
+            self.sup.healthy()
+            self.clock.now += 2
+            kind, delay = self.sup.exited(1)
+            self.clock.now += delay
+        self.assertTrue(self.sup.circuit_open)
+        self.assertEqual(delay, supervisor.CIRCUIT_RESET_DELAY)
+
+        # A run past RAPID_FAILURE_SECONDS starts the count again
+        self.sup.started()
+        self.sup.healthy()
+        self.clock.now += supervisor.RAPID_FAILURE_SECONDS + 1
+        kind, delay = self.sup.exited(1)
+        self.assertEqual(delay, supervisor.RESTART_DELAY)
+        self.assertEqual(self.sup.consecutive_failures, 1)
+
+    def test_slow_failures_do_not_trip(self):
+        for i in range(supervisor.CIRCUIT_TRIP_FAILURES * 2):
+            self.sup.started()
+            self.clock.now += supervisor.RAPID_FAILURE_SECONDS + 1
+            kind, delay = self.sup.exited(-9)
+            self.assertEqual(delay, supervisor.RESTART_DELAY)
+        self.assertFalse(self.sup.circuit_open)
+
+if __name__ == '__main__':
+    unittest.main()
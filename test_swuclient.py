@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import binascii
+import errno
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+import swuclient
+from test_swuctrl import FakeMainLoop
+from test_swuprogress import make_frame
+
+SLEEPER = [sys.executable, '-c', 'import time; time.sleep(60)']
+
+# Stands in for swupdate: serves the progress socket, sends the frames
+# given and exits with the code given
+SWUPDATE_SCRIPT = '''
+import binascii, socket, sys
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(sys.argv[1])
+server.listen(1)
+conn, addr = server.accept()
+conn.sendall(binascii.unhexlify(sys.argv[2]))
+conn.close()
+sys.exit(int(sys.argv[3]))
+'''
+
+
+class ChildLoop(FakeMainLoop):
+    '''
+    FakeMainLoop with child watches, run by reaping the children
+    '''
+    def __init__(self):
+        super(ChildLoop, self).__init__()
+        self.children = {}
+
+    def watch_child(self, pid, callback):
+        self.children[pid] = callback
+
+    def reap(self):
+        children, self.children = self.children, {}
+        for pid, callback in children.items():
+            pid, status = os.waitpid(pid, 0)
+            callback(pid, status)
+
+    def fire_next(self):
+        source_id = min(self.timers, key=lambda i: self.timers[i][0])
+        seconds, callback, args = self.timers.pop(source_id)
+        callback(*args)
+
+
+class SWUpdateClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'swupdateprog')
+        self.loop = ChildLoop()
+        self.messages = []
+        self.connected = []
+        self.server = None
+
+    def tearDown(self):
+        for pid in self.loop.children:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        if self.client.sock is not None:
+            self.client.close_prog_sock()
+        if self.client.watcher is not None:
+            self.client.watcher.close()
+        if self.server is not None:
+            self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, cmd, address=None):
+        self.client = swuclient.SWUpdateClient(self.loop,
+            lambda status, image, info: self.messages.append((status, image, info)),
+            cmd, connected_handler=lambda: self.connected.append(True),
+            prog_address=address or self.address)
+        self.client.start()
+
+    def listen(self, address=None):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address or self.address)
+        self.server.listen(1)
+
+    def test_connect(self):
+        start = time.time()
+        self.start(SLEEPER)
+        # Waiting on the inotify watch, with a timeout
+        self.assertIsNotNone(self.client.watcher.fileno())
+        self.assertEqual(len(self.loop.watches), 1)
+        self.assertEqual(self.loop.delays(), [swuclient.SWU_PROG_CONNECT_TIMEOUT])
+        self.assertEqual(self.connected, [])
+
+        self.assertIsNone(self.client.get_connect_latency())
+        self.assertEqual(self.client.get_supervisor_stats()['connect_latency'], -1.0)
+
+        self.listen()
+        self.loop.dispatch()
+        self.assertEqual(self.connected, [True])
+        self.assertIsNone(self.client.watcher)
+        self.assertEqual(self.loop.timers, {})
+        # Timed from spawning swupdate to connecting
+        latency = self.client.get_connect_latency()
+        self.assertTrue(0 <= latency <= time.time() - start)
+        self.assertEqual(self.client.get_supervisor_stats()['connect_latency'], latency)
+
+        # Progress is read from an IO watch on the socket
+        conn, addr = self.server.accept()
+        conn.sendall(make_frame(1) + make_frame(2))
+        self.loop.dispatch()
+        self.assertEqual([info for status, image, info in self.messages], ['{"seq": 1}', '{"seq": 2}'])
+        self.assertEqual(self.messages[0][1], 'rootfs.bin')
+        conn.close()
+        self.loop.dispatch()
+        self.assertIsNone(self.client.sock)
+        self.assertEqual(self.loop.watches, {})
+
+        # A new command terminates swupdate, which removes its socket;
+        # the child watch restarts it
+        self.server.close()
+        self.server = None
+        os.unlink(self.address)
+        pid = self.client.proc.pid
+        self.client.set_command(SLEEPER)
+        self.client.restart_swupdate()
+        self.loop.reap()
+        self.assertEqual(self.client.proc.returncode, swuclient.SIGNAL_TERM)
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(len(self.loop.timers), 1)
+        self.loop.fire_next()
+        self.assertNotEqual(self.client.proc.pid, pid)
+        self.assertIn(self.client.proc.pid, self.loop.children)
+        # Not connected to the new swupdate yet
+        self.assertIsNone(self.client.get_connect_latency())
+
+    def test_restart_after_exit(self):
+        # swupdate has exited but its child watch has not run yet; the
+        # restart must leave it for the child watch to reap
+        self.start([sys.executable, '-c', 'pass'])
+        os.waitid(os.P_PID, self.client.proc.pid, os.WEXITED | os.WNOWAIT)
+        self.client.restart_swupdate()
+        self.loop.reap()
+        self.assertEqual(self.client.proc.returncode, 0)
+        self.assertEqual(self.messages, [])
+
+    def test_retry(self):
+        # Without inotify (here, the directory is not there yet) the
+        # socket is looked for with a growing backoff
+        address = os.path.join(self.tmpdir, 'run', 'swupdateprog')
+        self.start(SLEEPER, address)
+        self.assertIsNone(self.client.watcher.fileno())
+        self.assertEqual(self.loop.watches, {})
+        self.assertEqual(self.loop.delays(), [0.01, swuclient.SWU_PROG_CONNECT_TIMEOUT])
+        self.loop.fire_next()
+        self.assertEqual(self.loop.delays(), [0.02, swuclient.SWU_PROG_CONNECT_TIMEOUT])
+
+        os.mkdir(os.path.dirname(address))
+        self.listen(address)
+        self.loop.fire_next()
+        self.assertEqual(self.connected, [True])
+        self.assertEqual(self.loop.timers, {})
+
+    def test_connect_timeout(self):
+        self.start(SLEEPER)
+        self.loop.fire_all()
+        self.assertIsNone(self.client.watcher)
+        self.assertEqual(self.loop.watches, {})
+        self.assertEqual(self.loop.timers, {})
+        self.assertEqual(self.connected, [])
+        self.assertEqual(self.client.get_supervisor_stats()['connect_latency'], -1.0)
+
+    def test_drain_on_exit(self):
+        frames = b''.join(make_frame(i) for i in range(1, 6))
+        self.start([sys.executable, '-c', SWUPDATE_SCRIPT, self.address,
+                    binascii.hexlify(frames).decode('ascii'), '3'])
+        # The socket can appear before swupdate listens on it, which is
+        # retried from a timer
+        while not self.connected:
+            self.loop.dispatch(0.1)
+            if self.client.connect_retry_id is not None:
+                self.loop.fire_next()
+        # swupdate exits before the socket is read: everything it sent is
+        # delivered before its exit is
+        self.loop.reap()
+        self.assertEqual([info for status, image, info in self.messages[:5]],
+            ['{"seq": %d}' % i for i in range(1, 6)])
+        self.assertEqual(self.messages[5], (swuclient.SWU_STATUS_BAD_CMD, None, 3))
+        self.assertIsNone(self.client.sock)
+        self.assertEqual(self.loop.watches, {})
+        self.assertEqual(len(self.loop.timers), 1)
+
+    def test_bad_command(self):
+        self.start([os.path.join(self.tmpdir, 'swupdate')])
+        self.assertIsNone(self.client.proc)
+        self.assertEqual(self.messages, [(swuclient.SWU_STATUS_BAD_CMD, None, errno.ENOENT)])
+        # Tried again later, rather than connecting to nothing
+        self.assertIsNone(self.client.watcher)
+        self.assertEqual(len(self.loop.timers), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+import json
+import os
+import select
+import shutil
+import socket
+import tempfile
+import unittest
+
+import swuctrl
+from test_swuprogress import FakeClock, FakeLoop
+
+
+class FakeMainLoop(FakeLoop):
+    '''
+    FakeLoop with IO watches, dispatched with select()
+    '''
+    def __init__(self):
+        super(FakeMainLoop, self).__init__()
+        self.watches = {}
+
+    def watch_readable(self, fd, callback):
+        self.next_id += 1
+        self.watches[self.next_id] = (fd, callback)
+        return self.next_id
+
+    def cancel(self, source_id):
+        if source_id in self.watches:
+            del self.watches[source_id]
+        else:
+            del self.timers[source_id]
+
+    def delays(self):
+        return sorted(seconds for seconds, callback, args in self.timers.values())
+
+    def dispatch(self, timeout=5):
+        fds = [fd for fd, callback in self.watches.values()]
+        rd, wr, ex = select.select(fds, [], [], timeout)
+        for source_id, (fd, callback) in list(self.watches.items()):
+            if fd in rd and source_id in self.watches:
+                if not callback(fd, None):
+                    self.watches.pop(source_id, None)
+
+
+class FakeControlSocket(object):
+    '''
+    The swupdate end of the control socket, driven from the test
+    '''
+    def __init__(self, address):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(4)
+        self.conn = None
+        self.connections = 0
+
+    def receive(self):
+        '''
+        Return the enable state of the next suricatta message, taking a
+        new connection if the channel has closed the last one
+        '''
+        data = b''
+        while len(data) < swuctrl.SWUPDATE_MSG.size:
+            if self.conn is None:
+                self.conn, addr = self.server.accept()
+                self.conn.settimeout(5)
+                self.connections += 1
+            chunk = self.conn.recv(swuctrl.SWUPDATE_MSG.size - len(data))
+            if not chunk:
+                self.conn.close()
+                self.conn = None
+                data = b''
+            data += chunk
+        magic, msg_type, source, cmd, timeout, length, buf = swuctrl.SWUPDATE_MSG.unpack(data)
+        self.header = (msg_type, source, cmd)
+        return json.loads(buf[:length].decode('utf8'))['enable']
+
+    def pending(self):
+        '''
+        Return True if a message or a new connection is waiting
+        '''
+        if select.select([self.server], [], [], 0)[0]:
+            return True
+        if self.conn is None or not select.select([self.conn], [], [], 0)[0]:
+            return False
+        return self.conn.recv(1, socket.MSG_PEEK) != b''
+
+    def reply(self, msg_type=swuctrl.SWUPDATE_MSG_ACK):
+        self.conn.sendall(swuctrl.SWUPDATE_MSG.pack(swuctrl.SWUPDATE_MAGIC, msg_type, 0, 0, 0, 0, b''))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.server.close()
+
+
+class ControlChannelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'sockinstctrl')
+        self.swupdate = FakeControlSocket(self.address)
+        self.loop = FakeMainLoop()
+        self.clock = FakeClock()
+        self.channel = swuctrl.ControlChannel(self.loop, self.address, self.clock)
+
+    def tearDown(self):
+        self.channel.close()
+        self.swupdate.close()
+        shutil.rmtree(self.tmpdir)
+
+    def ack(self, msg_type=swuctrl.SWUPDATE_MSG_ACK):
+        self.swupdate.reply(msg_type)
+        self.loop.dispatch()
+
+    def test_enable(self):
+        self.channel.set_enable(True)
+        self.assertTrue(self.swupdate.receive())
+        self.assertEqual(self.swupdate.header, (swuctrl.SWUPDATE_MSG_SUBPROCESS,
+            swuctrl.SWUPDATE_SRC_SURICATTA, swuctrl.SWUPDATE_CMD_ENABLE))
+        # The response is awaited with a watch and a timeout
+        self.assertEqual(len(self.loop.watches), 1)
+        self.assertEqual(self.loop.delays(), [swuctrl.SURICATTA_RESPONSE_TIMEOUT])
+        self.ack()
+        self.assertIs(self.channel.acked, True)
+        self.assertEqual(self.loop.watches, {})
+        self.assertEqual(self.loop.timers, {})
+        # The state already acknowledged is not sent again
+        self.channel.set_enable(True)
+        self.assertFalse(self.swupdate.pending())
+        self.assertEqual(self.channel.stats()['suricatta_attempts'], 1)
+
+    def test_coalesce(self):
+        self.channel.set_enable(True)
+        self.assertTrue(self.swupdate.receive())
+        for enable in (False, True, False):
+            self.channel.set_enable(enable)
+        # One request at a time, on one connection
+        self.assertFalse(self.swupdate.pending())
+        self.assertEqual(len(self.loop.watches), 1)
+        self.ack()
+        # Only the latest state follows
+        self.assertFalse(self.swupdate.receive())
+        self.ack()
+        self.assertIs(self.channel.acked, False)
+        self.assertFalse(self.swupdate.pending())
+        self.assertEqual(self.swupdate.connections, 1)
+        self.assertEqual(self.channel.stats()['suricatta_attempts'], 2)
+        self.assertEqual(self.channel.stats()['suricatta_coalesced'], 3)
+
+    def test_backoff(self):
+        self.channel.set_enable(True)
+        self.swupdate.receive()
+        self.ack(swuctrl.SWUPDATE_MSG_NACK)
+        self.assertEqual(self.loop.delays(), [swuctrl.SURICATTA_RETRY_MIN])
+        # Nothing more is sent while waiting to retry
+        self.channel.set_enable(True)
+        self.assertFalse(self.swupdate.pending())
+        # Unanswered requests time out and back off up to the limit
+        for delay in (4, 8, 16, 32, 60, 60):
+            self.loop.fire_all()
+            self.assertTrue(self.swupdate.receive())
+            self.assertEqual(self.loop.delays(), [swuctrl.SURICATTA_RESPONSE_TIMEOUT])
+            self.loop.fire_all()
+            self.assertEqual(self.loop.delays(), [delay])
+        self.assertEqual(self.channel.stats()['suricatta_failures'], 7)
+        self.assertEqual(self.loop.watches, {})
+
+        # Success starts the backoff again
+        self.loop.fire_all()
+        self.swupdate.receive()
+        self.ack()
+        self.assertIs(self.channel.acked, True)
+        self.assertEqual(self.channel.retry_delay, swuctrl.SURICATTA_RETRY_MIN)
+        self.assertEqual(self.loop.timers, {})
+
+    def test_not_listening(self):
+        self.swupdate.close()
+        os.unlink(self.address)
+        self.channel.set_enable(True)
+        self.assertEqual(self.loop.delays(), [swuctrl.SURICATTA_RETRY_MIN])
+        self.assertIsNone(self.channel.sock)
+        self.assertEqual(self.channel.stats()['suricatta_failures'], 1)
+
+    def test_reset(self):
+        self.channel.set_enable(True)
+        self.swupdate.receive()
+        self.ack()
+        # swupdate restarted: the state is sent again, on a new connection
+        self.channel.reset()
+        self.assertIsNone(self.channel.acked)
+        self.assertTrue(self.swupdate.receive())
+        self.assertEqual(self.swupdate.connections, 2)
+        self.ack(swuctrl.SWUPDATE_MSG_NACK)
+        self.loop.fire_all()
+        self.swupdate.receive()
+        self.ack(swuctrl.SWUPDATE_MSG_NACK)
+        self.assertEqual(self.loop.delays(), [4])
+
+        # A restart also drops the retry and its backoff
+        self.channel.reset()
+        self.assertEqual(len(self.loop.watches), 1)
+        self.assertEqual(self.loop.delays(), [swuctrl.SURICATTA_RESPONSE_TIMEOUT])
+        self.assertEqual(self.channel.retry_delay, swuctrl.SURICATTA_RETRY_MIN)
+        self.assertTrue(self.swupdate.receive())
+        self.ack()
+        self.assertIs(self.channel.acked, True)
+
+        # Before anything is requested there is nothing to send
+        channel = swuctrl.ControlChannel(self.loop, self.address, self.clock)
+        channel.reset()
+        self.assertIsNone(channel.sock)
+
+    def test_enable_latency(self):
+        self.assertEqual(self.channel.stats()['suricatta_enable_latency'], -1.0)
+        self.channel.set_enable(True)
+        self.swupdate.receive()
+        self.clock.now += 2
+        self.ack(swuctrl.SWUPDATE_MSG_NACK)
+        # Asking again while the request stands does not restart the clock
+        self.channel.set_enable(True)
+        self.clock.now += 2
+        self.loop.fire_all()
+        self.swupdate.receive()
+        self.clock.now += 1
+        self.ack()
+        self.assertEqual(self.channel.stats()['suricatta_enable_latency'], 5.0)
+
+        # Disabling is not timed, and a later enable is timed afresh
+        self.channel.set_enable(False)
+        self.swupdate.receive()
+        self.ack()
+        self.assertEqual(self.channel.enable_latency, 5.0)
+        self.channel.set_enable(True)
+        self.assertIsNone(self.channel.enable_latency)
+        self.swupdate.receive()
+        self.clock.now += 0.5
+        self.ack()
+        self.assertEqual(self.channel.enable_latency, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
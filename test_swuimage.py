@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+
+import swuimage
+
+
+def cpio_entry(name, data):
+    namesize = len(name) + 1
+    fields = (0, 0o100644, 0, 0, 1, 0, len(data), 0, 0, 0, 0, namesize, 0)
+    entry = b'070701' + b''.join(b'%08X' % v for v in fields) + name.encode('ascii') + b'\0'
+    entry += b'\0' * (-len(entry) % 4) + data
+    return entry + b'\0' * (-len(entry) % 4)
+
+
+def make_swu(description, signature, images):
+    data = cpio_entry('sw-description', description)
+    if signature is not None:
+        data += cpio_entry('sw-description.sig', signature)
+    for name, image in images:
+        data += cpio_entry(name, image)
+    return data + cpio_entry('TRAILER!!!', b'')
+
+
+class SwuImagesTestCase(unittest.TestCase):
+    def test_images(self):
+        kernel = os.urandom(1000)
+        rootfs = os.urandom(3000)
+        description = ('software = {{ images: ( '
+            '{{ filename = "kernel.itb"; sha256 = "{}"; }}, '
+            '{{ filename = "rootfs.bin"; sha256 = "{}"; compressed = "zlib"; }}, '
+            '{{ filename = "boot.scr"; sha256 = "{}"; compressed = false; }} ); }}\n').format(
+            hashlib.sha256(kernel).hexdigest(), hashlib.sha256(rootfs).hexdigest(),
+            'AB' * 32).encode('ascii')
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(make_swu(description, b'sig', [('kernel.itb', kernel),
+                    ('rootfs.bin', rootfs), ('boot.scr', b'x' * 10)]))
+            # The compressed rootfs is not written as it is, so cannot be checked
+            self.assertEqual(swuimage.swu_images(path), {
+                'kernel.itb' : (1000, hashlib.sha256(kernel).hexdigest()),
+                'boot.scr' : (10, 'ab' * 32)})
+        finally:
+            os.remove(path)
+
+    def test_not_swu(self):
+        f = io.BytesIO(b'IGDELTA1' + b'\0' * 200)
+        self.assertRaises(swuimage.VerifyError, list, swuimage.cpio_entries(f))
+
+        data = make_swu(b'', None, [('rootfs.bin', b'x' * 100)])
+        f = io.BytesIO(data[:data.index(b'x' * 100) + 50])
+        entries = swuimage.cpio_entries(f)
+        self.assertEqual(next(entries)[0], 'sw-description')
+        name, offset, size = next(entries)
+        self.assertEqual((name, size), ('rootfs.bin', 100))
+        self.assertRaises(swuimage.VerifyError, swuimage.read_entry, f, offset, size)
+        self.assertRaises(swuimage.VerifyError, swuimage.hash_entry, f, offset, size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import swuprogress
+
+FLOOD_FRAMES = 20000
+
+
+def make_frame(seq):
+    image = 'rootfs.bin' if seq % 2 else 'kernel.itb'
+    info = '{"seq": %d}' % seq
+    return swuprogress.PROGRESS_MSG.pack(0, seq % 9, seq % 100, 4, seq % 4, seq % 100,
+        image.encode('utf-8'), b'raw', 2, len(info), info.encode('utf-8'))
+
+
+class ProgressStandIn(threading.Thread):
+    '''
+    Stand-in for the swupdate progress socket which floods frames
+    written in randomly sized pieces, so that reads come back short
+    and merged.
+    '''
+    def __init__(self, path, frames):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.payload = b''.join(make_frame(i) for i in range(frames))
+
+    def run(self):
+        conn, addr = self.server.accept()
+        rnd = random.Random(1)
+        pos = 0
+        while pos < len(self.payload):
+            size = rnd.choice((1, 17, 1000, swuprogress.PROGRESS_MSG_SIZE, 5000, 65536))
+            conn.sendall(self.payload[pos:pos + size])
+            pos += size
+        conn.close()
+        self.server.close()
+
+
+class ProgressReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'swupdateprog')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reassembly_flood(self):
+        server = ProgressStandIn(self.path, FLOOD_FRAMES)
+        server.start()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        reader = swuprogress.ProgressReader(sock)
+
+        count = 0
+        while True:
+            frames = reader.read_frames()
+            if frames is None:
+                break
+            for fields in frames:
+                self.assertEqual(fields[swuprogress.PROGRESS_FIELD_STATUS], count % 9)
+                info = swuprogress.decode_string(fields[swuprogress.PROGRESS_FIELD_INFO],
+                    fields[swuprogress.PROGRESS_FIELD_INFOLEN])
+                self.assertEqual(info, '{"seq": %d}' % count)
+                count += 1
+        sock.close()
+        server.join()
+
+        self.assertEqual(count, FLOOD_FRAMES)
+        self.assertEqual(reader.pending(), 0)
+
+    def test_partial_frame_is_held(self):
+        a, b = socket.socketpair()
+        reader = swuprogress.ProgressReader(b)
+        frame = make_frame(3)
+        a.sendall(frame[:100])
+        self.assertEqual(reader.read_frames(), [])
+        self.assertEqual(reader.pending(), 100)
+        a.sendall(frame[100:] + frame)
+        frames = []
+        while len(frames) < 2:
+            frames.extend(reader.read_frames())
+        self.assertEqual(swuprogress.decode_string(frames[0][swuprogress.PROGRESS_FIELD_CUR_IMAGE]), 'rootfs.bin')
+        a.close()
+        self.assertIsNone(reader.read_frames())
+        b.close()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLoop(object):
+    def __init__(self):
+        self.timers = {}
+        self.next_id = 1
+
+    def call_later(self, seconds, callback, *args):
+        self.next_id += 1
+        self.timers[self.next_id] = (seconds, callback, args)
+        return self.next_id
+
+    def cancel(self, source_id):
+        del self.timers[source_id]
+
+    def fire_all(self):
+        timers, self.timers = self.timers, {}
+        for seconds, callback, args in timers.values():
+            callback(*args)
+
+
+class ProgressTelemetryTestCase(unittest.TestCase):
+    def test_decode_dwl_bytes_layout(self):
+        msg = swuprogress.PROGRESS_MSG_DWL_BYTES
+        fields = msg.unpack(msg.pack(0, swuprogress.SWU_STATUS_DOWNLOAD, 50, 10 * 1024 * 1024,
+            3, 2, 25, b'rootfs.bin', b'ubivol', 2, 2, b'ok'))
+        progress = swuprogress.Progress.from_fields(fields, swuprogress.PROGRESS_FIELDS_DWL_BYTES)
+        self.assertEqual(progress.downloaded_bytes(), 5 * 1024 * 1024)
+        self.assertEqual(progress.cur_image, 'rootfs.bin')
+        self.assertEqual(progress.info, 'ok')
+        self.assertAlmostEqual(progress.install_percent(), 100.0 * 1.25 / 3)
+
+    def test_estimator_eta(self):
+        clock = FakeClock()
+        estimator = swuprogress.ProgressEstimator(clock=clock)
+        for percent in range(0, 41, 10):
+            estimator.update(swuprogress.Progress(status=swuprogress.SWU_STATUS_DOWNLOAD,
+                dwl_percent=percent, dwl_bytes=1000))
+            clock.now += 2
+        # 100 bytes every 2 seconds, 600 bytes to go
+        self.assertAlmostEqual(estimator.rate(), 50.0)
+        self.assertAlmostEqual(estimator.eta(), 12.0)
+        # A new phase starts a new estimate
+        estimator.update(swuprogress.Progress(status=swuprogress.SWU_STATUS_RUN, nsteps=2))
+        self.assertEqual(estimator.eta(), -1.0)
+
+    def test_throttle_coalesces(self):
+        clock = FakeClock()
+        loop = FakeLoop()
+        emitted = []
+        throttle = swuprogress.ProgressThrottle(loop, emitted.append, rate=2, clock=clock)
+        for i in range(40):
+            throttle.update(i)
+            clock.now += 0.01
+        self.assertEqual(emitted, [0])
+        self.assertEqual(len(loop.timers), 1)
+        loop.fire_all()
+        self.assertEqual(emitted, [0, 39])
+        throttle.update(100, urgent=True)
+        self.assertEqual(emitted, [0, 39, 100])
+
+if __name__ == '__main__':
+    unittest.main()
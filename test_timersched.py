@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import unittest
+
+import timersched
+
+
+class FakeLoop(object):
+    '''
+    Stands in for the GLib main loop: one-shot timeouts driven by a
+    fake monotonic clock
+    '''
+    def __init__(self):
+        self.now = 100.0
+        self.timeouts = {}
+        self.next_id = 1
+
+    def clock(self):
+        return self.now
+
+    def arm(self, seconds, callback):
+        source_id = self.next_id
+        self.next_id += 1
+        self.timeouts[source_id] = (self.now + seconds, callback)
+        return source_id
+
+    def disarm(self, source_id):
+        del self.timeouts[source_id]
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while True:
+            due = [(t, i) for i, (t, cb) in self.timeouts.items() if t <= end]
+            if not due:
+                break
+            t, source_id = min(due)
+            self.now = max(self.now, t)
+            deadline, callback = self.timeouts.pop(source_id)
+            callback()
+        self.now = end
+
+
+class TimerSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.sched = timersched.TimerScheduler(self.loop.arm, self.loop.disarm, self.loop.clock)
+        self.fired = []
+
+    def record(self, name):
+        self.fired.append((name, self.loop.now))
+
+    def test_order_and_single_source(self):
+        self.sched.call_later(30, self.record, 'c')
+        self.sched.call_later(10, self.record, 'a')
+        self.sched.call_later(20, self.record, 'b')
+        # Only the earliest deadline has a main loop timer
+        self.assertEqual(len(self.loop.timeouts), 1)
+        self.assertEqual([t['name'] for t in self.sched.pending()], ['record'] * 3)
+        self.loop.advance(60)
+        self.assertEqual(self.fired, [('a', 110.0), ('b', 120.0), ('c', 130.0)])
+        self.assertEqual(self.loop.timeouts, {})
+        self.assertEqual(self.sched.stats()['wakeups'], 3)
+
+    def test_cancel(self):
+        a = self.sched.call_later(10, self.record, 'a')
+        self.sched.call_later(20, self.record, 'b')
+        a.cancel()
+        self.assertFalse(a.active())
+        self.assertEqual(len(self.sched.pending()), 1)
+        self.loop.advance(60)
+        self.assertEqual(self.fired, [('b', 120.0)])
+
+    def test_callback_may_schedule(self):
+        def chain():
+            self.record('chain')
+            self.sched.call_later(0, self.record, 'next')
+        self.sched.call_later(5, chain)
+        self.loop.advance(10)
+        self.assertEqual(self.fired, [('chain', 105.0), ('next', 105.0)])
+
+    def test_failing_callback(self):
+        def fail():
+            raise RuntimeError('broken')
+        self.sched.call_later(1, fail)
+        self.sched.call_later(1, self.record, 'after')
+        self.loop.advance(2)
+        self.assertEqual(self.fired, [('after', 101.0)])
+
+    def test_pause_resume(self):
+        t = self.sched.schedule(100, self.record, ('reboot',), name='reboot')
+        self.loop.advance(40)
+        # Snooze for 30 seconds; the remaining 60 seconds run afterwards
+        t.pause(30)
+        self.assertTrue(t.paused())
+        self.assertEqual(t.time_left(), 60)
+        self.assertEqual([p['name'] for p in self.sched.pending()], ['resume reboot', 'reboot'])
+        self.loop.advance(20)
+        # Snoozing again restarts the snooze
+        t.pause(30)
+        self.assertEqual(t.time_paused(), 20)
+        self.loop.advance(89)
+        self.assertEqual(self.fired, [])
+        self.loop.advance(1)
+        self.assertEqual(self.fired, [('reboot', 250.0)])
+        self.assertEqual(t.time_paused(), 50)
+        self.assertEqual(self.sched.pending(), [])
+
+    def test_resume_early_and_cancel_paused(self):
+        t = self.sched.call_later(10, self.record, 'a')
+        t.pause(100)
+        self.loop.advance(5)
+        t.resume()
+        self.loop.advance(10)
+        self.assertEqual(self.fired, [('a', 115.0)])
+
+        t = self.sched.call_later(10, self.record, 'b')
+        t.pause()
+        t.cancel()
+        self.assertEqual(self.sched.pending(), [])
+        self.loop.advance(1000)
+        self.assertEqual(len(self.fired), 1)
+
+if __name__ == '__main__':
+    unittest.main()
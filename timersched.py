@@ -0,0 +1,208 @@
+#
+# timersched.py - One timer source for all of the daemon's timeouts
+#
+import time
+import heapq
+import itertools
+import traceback
+from syslog import syslog
+
+# Timers due within this many seconds of the wakeup are run with it
+TIMER_SLACK = 0.001
+
+
+class TimerHandle(object):
+    '''
+    A pending call made by TimerScheduler.  The call can be cancelled,
+    or paused and resumed; time spent paused does not count towards
+    the deadline.
+    '''
+    def __init__(self, scheduler, deadline, callback, args, name):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.seq = None
+        self.cancelled = False
+        self.fired = False
+        self.remaining = None
+        self.paused_since = None
+        self.paused_total = 0.0
+        self.resume_handle = None
+
+    def active(self):
+        return not (self.cancelled or self.fired)
+
+    def paused(self):
+        return self.remaining is not None
+
+    def time_left(self):
+        if self.paused():
+            return self.remaining
+        return max(self.deadline - self.scheduler.clock(), 0.0)
+
+    def time_paused(self):
+        '''
+        Total time spent paused, including the current pause
+        '''
+        if self.paused_since is None:
+            return self.paused_total
+        return self.paused_total + self.scheduler.clock() - self.paused_since
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def pause(self, duration=None):
+        '''
+        Stop the countdown; if duration is given it is resumed after that
+        many seconds.  Pausing a paused timer restarts the duration.
+        '''
+        self.scheduler.pause(self, duration)
+
+    def resume(self):
+        self.scheduler.resume(self)
+
+
+class TimerScheduler(object):
+    '''
+    Keep every pending timeout in one heap ordered by monotonic
+    deadline, with a single main loop timer armed for the earliest.
+
+    arm(seconds, callback) must call callback once after the delay and
+    return an id for disarm(id).  All methods are meant to be called
+    from the main loop.
+    '''
+    def __init__(self, arm, disarm, clock=time.monotonic):
+        self.arm = arm
+        self.disarm = disarm
+        self.clock = clock
+        self.heap = []
+        self.paused = set()
+        self.counter = itertools.count()
+        self.armed_id = None
+        self.armed_deadline = None
+        self.wakeups = 0
+        self.fired = 0
+
+    def call_later(self, seconds, callback, *args):
+        return self.schedule(seconds, callback, args)
+
+    def schedule(self, seconds, callback, args=(), name=None):
+        '''
+        Run callback(*args) from the main loop after the given delay.
+        Returns a TimerHandle.
+        '''
+        if name is None:
+            name = getattr(callback, '__name__', repr(callback))
+        handle = TimerHandle(self, self.clock() + max(seconds, 0), callback, args, name)
+        self.push(handle)
+        self.rearm()
+        return handle
+
+    def cancel(self, handle):
+        if not handle.active():
+            return
+        handle.cancelled = True
+        handle.seq = None
+        self.paused.discard(handle)
+        if handle.resume_handle is not None:
+            self.cancel(handle.resume_handle)
+            handle.resume_handle = None
+        self.rearm()
+
+    def pause(self, handle, duration=None):
+        if not handle.active():
+            return
+        if not handle.paused():
+            now = self.clock()
+            handle.remaining = max(handle.deadline - now, 0.0)
+            handle.paused_since = now
+            handle.seq = None
+            self.paused.add(handle)
+        if handle.resume_handle is not None:
+            self.cancel(handle.resume_handle)
+            handle.resume_handle = None
+        if duration is not None:
+            handle.resume_handle = self.schedule(duration, self.resume, (handle,),
+                'resume ' + handle.name)
+        self.rearm()
+
+    def resume(self, handle):
+        if not handle.active() or not handle.paused():
+            return
+        now = self.clock()
+        handle.deadline = now + handle.remaining
+        handle.paused_total += now - handle.paused_since
+        handle.remaining = None
+        handle.paused_since = None
+        self.paused.discard(handle)
+        if handle.resume_handle is not None:
+            self.cancel(handle.resume_handle)
+            handle.resume_handle = None
+        self.push(handle)
+        self.rearm()
+
+    def push(self, handle):
+        handle.seq = next(self.counter)
+        heapq.heappush(self.heap, (handle.deadline, handle.seq, handle))
+
+    def head(self):
+        '''
+        Return the earliest live entry, dropping cancelled and paused
+        ones from the top of the heap
+        '''
+        while self.heap:
+            deadline, seq, handle = self.heap[0]
+            if handle.seq == seq:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def rearm(self):
+        head = self.head()
+        deadline = head[0] if head else None
+        if deadline == self.armed_deadline:
+            return
+        if self.armed_id is not None:
+            self.disarm(self.armed_id)
+            self.armed_id = None
+        self.armed_deadline = deadline
+        if deadline is not None:
+            self.armed_id = self.arm(max(deadline - self.clock(), 0), self.run_due)
+
+    def run_due(self):
+        '''
+        Run every call that is due; called by the armed main loop timer
+        '''
+        self.armed_id = None
+        self.armed_deadline = None
+        self.wakeups += 1
+        while True:
+            head = self.head()
+            if head is None or head[0] > self.clock() + TIMER_SLACK:
+                break
+            heapq.heappop(self.heap)
+            handle = head[2]
+            handle.seq = None
+            handle.fired = True
+            self.fired += 1
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                syslog('Timer {} failed: {}'.format(handle.name, traceback.format_exc()))
+        self.rearm()
+        return False
+
+    def pending(self):
+        '''
+        Return a list of the pending timers, soonest first, for debugging
+        '''
+        handles = sorted([e[2] for e in self.heap if e[2].seq == e[1]], key=lambda h: h.deadline)
+        timers = []
+        for h in handles + sorted(self.paused, key=lambda h: h.remaining):
+            timers.append({'name' : h.name, 'remaining' : h.time_left(), 'paused' : h.paused()})
+        return timers
+
+    def stats(self):
+        return {'pending' : len(self.pending()), 'wakeups' : self.wakeups, 'fired' : self.fired}
@@ -7,6 +7,8 @@ import time
 import threading
 import json
 from syslog import syslog
+import mainloop
+import propcache
 #
 # Provisioning status/states
 #
@@ -20,9 +22,29 @@ PROV_FAILED_AUTH = -3
 PROV_FAILED_TIMEOUT = -4
 PROV_FAILED_NOT_FOUND = -5
 
+PUBLIC_INTERFACE = "com.lairdtech.security.public.UpdateInterface"
+# Properties only: the update pipeline metrics, read with GetAll
+METRICS_INTERFACE = "com.lairdtech.security.public.UpdateMetrics"
+
+#
+# Properties of the public interface
+#
+PROP_STATUS = 'Status'
+PROP_PROGRESS = 'Progress'
+PROP_WINDOW_START = 'NextWindowStart'
+PROP_WINDOW_END = 'NextWindowEnd'
+PROP_REBOOT_DEADLINE = 'RebootDeadline'
+PROP_SNOOZE_REMAINING = 'SnoozeRemaining'
+PROP_LAST_RESULT = 'LastResult'
+
 class UpdateService(dbus.service.Object):
     def __init__(self, bus_name):
         super(UpdateService, self).__init__(bus_name, "/com/lairdtech/security/UpdateService")
+        self.properties = propcache.PropertyCache(mainloop, self.properties_changed)
+
+    def properties_changed(self, changed):
+        self.PropertiesChanged(PUBLIC_INTERFACE, dbus.Dictionary(changed, signature='sv'),
+            dbus.Array([], signature='s'))
 
     @dbus.service.method("com.lairdtech.security.UpdateInterface",
                          in_signature='s', out_signature='i')
@@ -38,6 +60,11 @@ class UpdateService(dbus.service.Object):
         else:
             return -1
 
+    @dbus.service.method("com.lairdtech.security.UpdateInterface",
+                         in_signature='', out_signature='aa{sv}')
+    def GetTimers(self):
+        return self.get_timers()
+
     @dbus.service.method("com.lairdtech.security.public.UpdateInterface",
                          in_signature='b', out_signature='i')
     def CheckUpdate(self, perform_update):
@@ -52,6 +79,33 @@ class UpdateService(dbus.service.Object):
     def UpdatePending(self, update_action):
         return update_action
 
+    @dbus.service.signal("com.lairdtech.security.public.UpdateInterface", signature='a{sv}')
+    def UpdateProgress(self, progress):
+        return progress
+
+    @dbus.service.method("com.lairdtech.security.public.UpdateInterface",
+                         in_signature='', out_signature='a{sv}')
+    def GetProgress(self):
+        return self.get_progress()
+
+    @dbus.service.method("com.lairdtech.security.public.UpdateInterface",
+                         in_signature='', out_signature='a{sv}')
+    def GetSwupdateStatus(self):
+        return self.get_swupdate_status()
+
+    @dbus.service.signal("com.lairdtech.security.public.UpdateInterface", signature='b')
+    def SwupdateCircuitBreaker(self, circuit_open):
+        return circuit_open
+
+    @dbus.service.method("com.lairdtech.security.public.UpdateInterface",
+                         in_signature='', out_signature='a{sv}')
+    def GetMetrics(self):
+        return self.get_metrics()
+
+    @dbus.service.signal(dbus.PROPERTIES_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface_name, changed_properties, invalidated_properties):
+        pass
+
     @dbus.service.method(dbus.PROPERTIES_IFACE,
                          in_signature='ss', out_signature='v')
     def Get(self, interface_name, property_name):
@@ -60,8 +114,12 @@ class UpdateService(dbus.service.Object):
     @dbus.service.method(dbus.PROPERTIES_IFACE,
                          in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface_name):
-        if interface_name == "com.lairdtech.security.public.UpdateInterface":
-            return { 'Status' : self.result }
+        if interface_name == PUBLIC_INTERFACE:
+            # The cache is refreshed whenever the state changes, so a
+            # read never signals anything
+            return dbus.Dictionary(self.properties.get_all(), signature='sv')
+        elif interface_name == METRICS_INTERFACE:
+            return self.get_metrics()
         else:
             raise dbus.exceptions.DBusException(
                 'com.lairdtech.UnknownInterface',
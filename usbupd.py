@@ -2,10 +2,7 @@
           or already updated with the package in local usb update'''
 
 import os
-from psutil import disk_partitions
 from syslog import syslog
-from pyudev.glib import MonitorObserver
-from pyudev import Context, Monitor
 
 import sys
 PYTHON3 = sys.version_info >= (3, 0)
@@ -42,6 +39,8 @@ class LocalUpdate:
         Function looks for mount point and sends the swupdate config to Softwareupdate service
         """
         try:
+            # psutil is only loaded once a USB device is inserted
+            from psutil import disk_partitions
             if self.retry_count == RETRY_COUNT:
                 self.retry_count = 0
                 return False
@@ -111,6 +110,9 @@ class LocalUpdate:
             #if os.path.exists(DEVICE_PART1):
             #    syslog("start_usb_detection: Mount point exists")
             #    self.check_mount_point()
+            # pyudev is loaded here, after startup, not when igupd is imported
+            from pyudev.glib import MonitorObserver
+            from pyudev import Context, Monitor
             context = Context()
             monitor = Monitor.from_netlink(context)
             monitor.filter_by(subsystem='usb')